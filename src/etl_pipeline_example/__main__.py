@@ -1,36 +1,394 @@
+import argparse
 import logging
+import re
 import sys
 from pathlib import Path
 from tempfile import TemporaryDirectory
+from typing import Callable, Dict, Sequence
 
-from etl_pipeline_example.create_dataset import write_dataset
-from etl_pipeline_example.log_utils import setup_logging
-from etl_pipeline_example.pipeline import run_pipeline
+# the pipeline modules import pandas and pyarrow, so they are only imported by
+# the command that needs them, to keep the startup of other commands fast
 
 log = logging.getLogger(__name__)
 
+COMMANDS = {
+    "generate": "create a synthetic dataset",
+    "run": "run the pipeline",
+    "bench": "benchmark the pipeline stages",
+    "query": "look up or export the results of an indexed run",
+}
+"""The subcommands and their help, the first argument defaults to ``run``."""
+_SIZE_UNITS = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+"""Multipliers of the binary size suffixes."""
 
-def main():
-    """Run the script from the command line."""
-    setup_logging()
-    if len(sys.argv) > 1:
-        workdir = Path(sys.argv[1]).resolve()
+
+def parse_bytes(value: str) -> int:
+    """
+    Parse a size in bytes from the command line.
+
+    :param value: a number of bytes, with an optional K, M, G or T binary
+        suffix, e.g. ``2G`` or ``512MiB``.
+    :return: the number of bytes.
+    """
+    match = re.fullmatch(
+        r"\s*(\d+(?:\.\d*)?)\s*([KMGT]?)(?:i?B)?\s*", value, re.I
+    )
+    if match is None:
+        raise argparse.ArgumentTypeError(f"Invalid size: {value}")
+    number, unit = match.groups()
+    return int(float(number) * _SIZE_UNITS[unit.upper()])
+
+
+def _add_generate_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the dataset options to a command line parser."""
+    from etl_pipeline_example.create_dataset import (
+        DEFAULT_RANDOM_SEED,
+        SHARD_COMPANIES,
+    )
+    from etl_pipeline_example.dataset import DatasetFormat
+
+    parser.add_argument("workdir", type=Path, help="the data directory")
+    parser.add_argument("--n-companies", type=int, default=5000)
+    parser.add_argument(
+        "--n-dates",
+        type=int,
+        default=4000,
+        help="the number of dates with returns for each company",
+    )
+    parser.add_argument("--history-start", default="2000-01-01")
+    parser.add_argument(
+        "--history-end", help="the last date of the history, defaults to today"
+    )
+    parser.add_argument(
+        "--format",
+        choices=[f.value for f in DatasetFormat],
+        default=DatasetFormat.PARQUET.value,
+    )
+    parser.add_argument("--seed", type=int, default=DEFAULT_RANDOM_SEED)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="the number of processes writing company shards",
+    )
+    parser.add_argument(
+        "--shard-companies",
+        type=int,
+        default=SHARD_COMPANIES,
+        help="the companies in each shard, when there are more companies",
+    )
+
+
+def _add_run_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the pipeline options to a command line parser."""
+    from etl_pipeline_example.cache import CACHE_BYTES
+    from etl_pipeline_example.pipeline import (
+        PREFETCH_DEPTH,
+        Engine,
+        ResampleStrategy,
+    )
+    from etl_pipeline_example.rolling import Statistic
+    from etl_pipeline_example.sinks import OutputFormat
+    from etl_pipeline_example.store import PARTITION_ROWS
+
+    parser.add_argument(
+        "workdir",
+        type=Path,
+        nargs="?",
+        help="the data directory, data is created if there is none, in a "
+        "temporary directory if not given",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=[e.value for e in Engine],
+        default=Engine.DENSE.value,
+    )
+    parser.add_argument(
+        "--strategy",
+        choices=[s.value for s in ResampleStrategy],
+        default=ResampleStrategy.INTERPOLATE_LINEAR.value,
+        help="how to fill missing returns when resampling",
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        nargs="+",
+        default=[262 * 2],
+        help="the rolling windows, in business days",
+    )
+    parser.add_argument(
+        "--statistics",
+        choices=[s.value for s in Statistic],
+        nargs="+",
+        default=[Statistic.CORR.value],
+    )
+    parser.add_argument(
+        "--min-periods",
+        type=int,
+        help="the valid returns needed in a window, defaults to the window",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="the number of processes calculating statistics",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=PREFETCH_DEPTH,
+        help="the number of partitions read ahead and results written behind "
+        "the calculations, 0 to disable",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=[f.value for f in OutputFormat],
+        default=OutputFormat.CSV.value,
+    )
+    parser.add_argument("--partition-rows", type=int, default=PARTITION_ROWS)
+    parser.add_argument(
+        "--partition-bytes",
+        type=parse_bytes,
+        help="the in-memory size of each partition, e.g. 64M",
+    )
+    parser.add_argument(
+        "--memory-limit",
+        type=parse_bytes,
+        help="the peak memory of an out-of-core run, e.g. 2G",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only process the returns after the last stored dates",
+    )
+    parser.add_argument("--companies", type=int, nargs="+")
+    parser.add_argument("--start", help="the first date of the results")
+    parser.add_argument("--end", help="the last date of the results")
+    parser.add_argument(
+        "--no-cache",
+        dest="cache",
+        action="store_false",
+        help="rebuild the store and statistics of earlier runs",
+    )
+    parser.add_argument("--cache-bytes", type=parse_bytes, default=CACHE_BYTES)
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="record the time and memory used by each stage",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="also trace python allocations when profiling",
+    )
+    parser.add_argument(
+        "--validate-precision",
+        action="store_true",
+        help="compare the float32 statistics of a sample of companies to a "
+        "float64 reference",
+    )
+    parser.add_argument(
+        "--report",
+        type=Path,
+        help="json file for the profiling report, implies --profile",
+    )
+
+
+def _add_bench_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the benchmark suite options to a command line parser."""
+    from etl_pipeline_example.bench import add_bench_arguments
+
+    add_bench_arguments(parser)
+
+
+def _add_query_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the result lookup options to a command line parser."""
+    parser.add_argument("workdir", type=Path, help="the data directory")
+    parser.add_argument(
+        "--companies", type=int, nargs="+", help="defaults to all of them"
+    )
+    parser.add_argument("--start", help="the first date of the results")
+    parser.add_argument("--end", help="the last date of the results")
+    parser.add_argument(
+        "--output",
+        type=Path,
+        help="the csv file to write, defaults to the standard output",
+    )
+
+
+_ADD_ARGUMENTS: Dict[str, Callable[[argparse.ArgumentParser], None]] = {
+    "generate": _add_generate_arguments,
+    "run": _add_run_arguments,
+    "bench": _add_bench_arguments,
+    "query": _add_query_arguments,
+}
+"""The function adding the options of each subcommand to its parser."""
+
+
+def _parser(command: str | None = None) -> argparse.ArgumentParser:
+    """
+    Build the command line parser.
+
+    :param command: the subcommand to add the options of, the other
+        subcommands are only listed.
+    :return: the parser.
+    """
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument(
+        "--log-level",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        default="INFO",
+    )
+    parser = argparse.ArgumentParser(
+        prog="python -m etl_pipeline_example",
+        description="Calculate rolling statistics of company returns.",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name, help_text in COMMANDS.items():
+        subparser = commands.add_parser(name, parents=[common], help=help_text)
+        if name == command:
+            _ADD_ARGUMENTS[name](subparser)
+    return parser
+
+
+def generate(args: argparse.Namespace) -> int:
+    """
+    Create a synthetic dataset.
+
+    :param args: the parsed command line options.
+    :return: the exit code.
+    """
+    from etl_pipeline_example.create_dataset import write_dataset
+    from etl_pipeline_example.dataset import DatasetFormat
+
+    args.workdir.mkdir(parents=True, exist_ok=True)
+    log.info("Creating data in %s...", args.workdir)
+    write_dataset(
+        args.workdir,
+        history_start=args.history_start,
+        history_end=args.history_end,
+        n_companies=args.n_companies,
+        n_dates=args.n_dates,
+        random_seed=args.seed,
+        dataset_format=DatasetFormat(args.format),
+        n_workers=args.workers,
+        shard_companies=args.shard_companies,
+    )
+    return 0
+
+
+def run(args: argparse.Namespace) -> int:
+    """
+    Run the pipeline, creating a dataset first if there is none.
+
+    :param args: the parsed command line options.
+    :return: the exit code.
+    """
+    from etl_pipeline_example.dataset import detect_format
+    from etl_pipeline_example.pipeline import (
+        Engine,
+        ResampleStrategy,
+        run_pipeline,
+    )
+    from etl_pipeline_example.rolling import Statistic
+    from etl_pipeline_example.sinks import OutputFormat
+
+    if args.workdir is not None:
+        workdir = args.workdir.resolve()
         if not workdir.is_dir():
             raise SystemExit(f"Not a directory: {workdir}")
     else:
         workdir = Path(
             TemporaryDirectory(prefix="pipeline", suffix=".dir").name
         ).resolve()
-    if (
-        workdir.joinpath("company_returns.pkl").exists()
-        and workdir.joinpath("market_returns.pkl").exists()
-    ):
-        log.debug("Company and market data already exists in %s", workdir)
+    dataset_format = detect_format(workdir)
+    if dataset_format is not None:
+        log.debug(
+            "Company and market %s data already exists in %s",
+            dataset_format.value,
+            workdir,
+        )
     else:
+        from etl_pipeline_example.create_dataset import write_dataset
+
         log.info("Creating data in %s...", workdir)
         write_dataset(workdir)
-    run_pipeline(workdir)
+    run_pipeline(
+        workdir,
+        engine=Engine(args.engine),
+        n_workers=args.workers,
+        output_format=OutputFormat(args.output_format),
+        strategy=ResampleStrategy(args.strategy),
+        window=args.window,
+        incremental=args.incremental,
+        partition_rows=args.partition_rows,
+        partition_bytes=args.partition_bytes,
+        profile=args.profile or args.report is not None,
+        trace_memory=args.trace_memory,
+        statistics=[Statistic(s) for s in args.statistics],
+        companies=args.companies,
+        start=args.start,
+        end=args.end,
+        memory_limit=args.memory_limit,
+        cache=args.cache,
+        cache_bytes=args.cache_bytes,
+        report_path=args.report,
+        prefetch_depth=args.prefetch,
+        min_periods=args.min_periods,
+        validate_precision=args.validate_precision,
+    )
+    return 0
+
+
+def query(args: argparse.Namespace) -> int:
+    """
+    Write the indexed results of some companies and dates as csv.
+
+    :param args: the parsed command line options.
+    :return: the exit code.
+    """
+    from etl_pipeline_example.results import ResultStore
+
+    path = args.workdir / "store" / "result_corr"
+    try:
+        store = ResultStore(path)
+    except FileNotFoundError:
+        raise SystemExit(
+            f"No indexed results in {path}, run with --output-format indexed"
+        )
+    with store:
+        n_rows = store.to_csv(args.output, args.companies, args.start, args.end)
+    log.info("Exported %i rows of results", n_rows)
+    return 0
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    """
+    Run the script from the command line.
+
+    For backwards compatibility, the ``run`` command can be omitted, as in
+    ``python -m etl_pipeline_example workdir``.
+
+    :param argv: the command line arguments.
+    :return: the exit code.
+    """
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if not argv or argv[0] not in (*COMMANDS, "-h", "--help"):
+        argv.insert(0, "run")
+    args = _parser(argv[0]).parse_args(argv)
+    from etl_pipeline_example.log_utils import setup_logging
+
+    setup_logging(args.log_level)
+    if args.command == "generate":
+        return generate(args)
+    elif args.command == "bench":
+        from etl_pipeline_example.bench import run_bench
+
+        return run_bench(args)
+    elif args.command == "query":
+        return query(args)
+    return run(args)
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
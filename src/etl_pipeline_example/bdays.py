@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+
+BDAY_EPOCH = np.datetime64("1970-01-01", "D")
+"""The business day with offset zero."""
+_WEEK_OFFSETS = np.array([0, 1, 1, 1, 2, 3, 4], dtype=np.int32)
+"""Business days from the epoch, a Thursday, to each day of its week."""
+
+
+def to_bday_offsets(dates: pd.DatetimeIndex | np.ndarray) -> np.ndarray:
+    """
+    Convert dates to integer offsets on the business day grid.
+
+    Dates falling on a weekend are mapped to the previous business day, which
+    is the bin they fall into when resampling to business days.
+
+    :param dates: the dates to convert.
+    :return: int32 number of business days since :data:`BDAY_EPOCH`.
+    """
+    # datetime64 days count from 1970-01-01, which is the epoch, and weekend
+    # days count as the friday before them
+    days = np.asarray(dates, dtype="datetime64[D]").view(np.int64)
+    offsets, weekdays = np.divmod(days.astype(np.int32), 7)
+    offsets *= 5
+    offsets += _WEEK_OFFSETS[weekdays]
+    return offsets
+
+
+def from_bday_offsets(offsets: np.ndarray, unit: str = "ns") -> np.ndarray:
+    """
+    Convert integer offsets on the business day grid back to dates.
+
+    :param offsets: number of business days since :data:`BDAY_EPOCH`.
+    :param unit: the datetime64 unit of the dates, e.g. "D" for days.
+    :return: the dates, as datetime64[ns] values by default.
+    """
+    days = np.busday_offset(BDAY_EPOCH, offsets, roll="forward")
+    return days.astype(f"datetime64[{unit}]")
+
+
+def is_bday_freq(freq: str | pd.offsets.BaseOffset) -> bool:
+    """
+    Check if a frequency is the business day frequency.
+
+    :param freq: the frequency.
+    :return: True if the frequency is a single business day.
+    """
+    return pd.tseries.frequencies.to_offset(freq) == pd.offsets.BDay()
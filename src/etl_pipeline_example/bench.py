@@ -0,0 +1,403 @@
+import argparse
+import json
+import logging
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from enum import Enum
+from multiprocessing import get_context
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, Callable, Dict, List, Sequence, TypeVar
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from etl_pipeline_example.create_dataset import (
+    company_data,
+    date_index,
+    returns_data,
+    write_dataset,
+)
+from etl_pipeline_example.dataset import (
+    DatasetFormat,
+    read_company_returns,
+    read_market_returns,
+    write_returns,
+)
+from etl_pipeline_example.log_utils import (
+    max_rss_bytes,
+    reset_peak_rss,
+    setup_logging,
+)
+from etl_pipeline_example.panel import CompanyPanel
+from etl_pipeline_example.pipeline import (
+    REPORT_FILE,
+    Engine,
+    ResampleStrategy,
+    resample_company_returns,
+    rolling_corr,
+    run_pipeline,
+)
+from etl_pipeline_example.precision import to_value_dtype
+from etl_pipeline_example.store import (
+    PartitionManifest,
+    plan_partitions,
+    write_partitions,
+)
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+BENCH_SCALES = (100, 1000, 5000)
+"""Default numbers of companies in the benchmark datasets."""
+BENCH_HISTORY = ("2000-01-01", "2023-12-29")
+"""Fixed history of the benchmark datasets, for comparable runs."""
+BENCH_WINDOW = 262 * 2
+"""Rolling correlation window of the benchmarks."""
+
+
+class BenchStage(Enum):
+    """A pipeline stage measured on its own by the benchmark suite."""
+
+    GENERATE = "generate"
+    """Generate and write the synthetic dataset."""
+    LOAD = "load"
+    """Load the company and market returns."""
+    RESAMPLE = "resample"
+    """Resample the company returns to business days."""
+    STORE = "store"
+    """Write the resampled company returns to the partitioned store."""
+    CORRELATE = "correlate"
+    """Calculate the rolling correlations of all the companies."""
+    PIPELINE = "pipeline"
+    """Run the whole pipeline, with profiling of its stages."""
+
+
+def _measure(func: Callable[..., Any], *args: Any) -> Dict[str, float]:
+    """
+    Time a function call and record the growth of the process peak RSS.
+
+    The peak is reset first where supported, so that preparing the inputs in
+    the same process doesn't hide the peak of the function.
+    """
+    if not reset_peak_rss():
+        log.debug("Can't reset the peak RSS, earlier peaks may hide this one")
+    rss_before = max_rss_bytes()
+    start = time.perf_counter()
+    func(*args)
+    seconds = time.perf_counter() - start
+    return {
+        "seconds": seconds,
+        "peak_rss_mb": (max_rss_bytes() - rss_before) / 1e6,
+    }
+
+
+def measure(func: Callable[..., Any], *args: Any) -> Dict[str, float]:
+    """
+    Measure the wall time and peak memory of a function in a fresh process.
+
+    A new process is spawned for each measurement, so that memory peaks from
+    earlier measurements or from the caller don't hide the function's own.
+
+    :param func: the function to measure, must be picklable.
+    :param args: the function arguments.
+    :return: the wall time in seconds and the peak RSS increase in MB.
+    """
+    return _in_fresh_process(_measure, func, *args)
+
+
+def _in_fresh_process(func: Callable[..., T], *args: Any) -> T:
+    """Call a function in a newly spawned process."""
+    with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+        return pool.submit(func, *args).result()
+
+
+def load_dataset(data_dir: Path, fmt: DatasetFormat) -> None:
+    """Load the company and market returns in a data directory."""
+    read_company_returns(data_dir, fmt)
+    read_market_returns(data_dir, fmt)
+
+
+def bench_load(
+    data_dir: Path,
+    n_companies: int = 5000,
+    n_dates: int = 4000,
+    formats: List[DatasetFormat] | None = None,
+) -> List[Dict[str, Any]]:
+    """
+    Compare load time and peak memory of the dataset formats.
+
+    :param data_dir: the directory to write the datasets into.
+    :param n_companies: the number of companies in the dataset.
+    :param n_dates: the number of dates for which companies have returns.
+    :param formats: the formats to compare, defaults to all.
+    :return: a measurement for each format.
+    """
+    dates = date_index()
+    comp = company_data(dates, n_companies=n_companies, n_dates=n_dates)
+    market = returns_data(dates)
+    results = []
+    for fmt in formats or list(DatasetFormat):
+        log.info("Writing %s dataset to %s...", fmt.value, data_dir)
+        write_returns(comp, market, data_dir, fmt)
+        res = measure(load_dataset, data_dir, fmt)
+        log.info(
+            "Loaded %s dataset in %.02fs, peak mem usage: %.02f MB",
+            fmt.value,
+            res["seconds"],
+            res["peak_rss_mb"],
+        )
+        results.append({"format": fmt.value, **res})
+    return results
+
+
+def _run_profiled_pipeline(data_dir: Path) -> None:
+    """Run the pipeline with profiling of its stages, without caching."""
+    run_pipeline(data_dir, window=BENCH_WINDOW, profile=True, cache=False)
+
+
+def _store_partitions(panel: CompanyPanel) -> np.ndarray:
+    """Plan the store partitions of a panel, and get the partition of rows."""
+    row_counts = pd.Series(panel.counts, index=panel.company_ids)
+    manifest = PartitionManifest.from_plan(plan_partitions(row_counts))
+    return np.repeat(manifest.partition_of(panel.company_ids), panel.counts)
+
+
+def _bench_stage(
+    stage: BenchStage, data_dir: Path, n_companies: int, n_dates: int
+) -> Dict[str, Any]:
+    """Prepare the inputs of a stage, then measure the stage alone."""
+    if stage == BenchStage.GENERATE:
+        return _measure(
+            write_dataset,
+            data_dir,
+            *BENCH_HISTORY,
+            n_companies,
+            n_dates,
+        )
+    if stage == BenchStage.LOAD:
+        return _measure(load_dataset, data_dir, None)
+    if stage == BenchStage.PIPELINE:
+        res = _measure(_run_profiled_pipeline, data_dir)
+        report = json.loads((data_dir / "store" / REPORT_FILE).read_text())
+        return {**res, "stages": report["stages"]}
+    comp = read_company_returns(data_dir)
+    comp = to_value_dtype(comp)
+    strategy = ResampleStrategy.INTERPOLATE_LINEAR
+    if stage == BenchStage.RESAMPLE:
+        return _measure(
+            resample_company_returns, comp, "B", strategy, Engine.DENSE
+        )
+    comp = resample_company_returns(comp, "B", strategy, Engine.DENSE)
+    if stage == BenchStage.STORE:
+        panel = CompanyPanel.from_series(comp)
+        # away from the pipeline store, which the pipeline stage rebuilds
+        store_dir = data_dir / "bench_store"
+        partitions = _store_partitions(panel)
+        return _measure(
+            write_partitions, panel, store_dir / "company_data", partitions
+        )
+    market = read_market_returns(data_dir)
+    market = to_value_dtype(market)
+    return _measure(
+        rolling_corr, comp.to_frame(), market, BENCH_WINDOW, Engine.DENSE
+    )
+
+
+def environment() -> Dict[str, str]:
+    """
+    Describe the environment the benchmarks run in.
+
+    :return: the python, platform and library versions.
+    """
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "pyarrow": pa.__version__,
+    }
+
+
+def bench_suite(
+    data_dir: Path,
+    scales: Sequence[int] = BENCH_SCALES,
+    n_dates: int = 4000,
+    stages: Sequence[BenchStage] | None = None,
+) -> Dict[str, Any]:
+    """
+    Measure each pipeline stage, and the whole pipeline, at several scales.
+
+    Each stage runs in a fresh process, and its peak RSS is reset once its
+    inputs have been prepared, so that its peak memory is not hidden by
+    earlier stages or by the preparation.
+
+    :param data_dir: the directory to write the datasets into.
+    :param scales: the numbers of companies in the datasets.
+    :param n_dates: the number of dates for which companies have returns.
+    :param stages: the stages to measure, defaults to all.
+    :return: the environment and a measurement for each scale and stage.
+    """
+    stages = stages or list(BenchStage)
+    if BenchStage.GENERATE not in stages:
+        # the other stages need a dataset
+        stages = [BenchStage.GENERATE, *stages]
+    results = []
+    for n_companies in scales:
+        scale_dir = data_dir / f"companies-{n_companies}"
+        for stage in stages:
+            log.info(
+                "Measuring %s of %i companies...", stage.value, n_companies
+            )
+            res = _in_fresh_process(
+                _bench_stage, stage, scale_dir, n_companies, n_dates
+            )
+            log.info(
+                "Measured %s of %i companies in %.02fs, peak mem usage: "
+                "%.02f MB",
+                stage.value,
+                n_companies,
+                res["seconds"],
+                res["peak_rss_mb"],
+            )
+            results.append(
+                {"n_companies": n_companies, "stage": stage.value, **res}
+            )
+    return {"environment": environment(), "results": results}
+
+
+def _compare_metrics(
+    label: str,
+    base: Dict[str, Any],
+    res: Dict[str, Any],
+    metrics: Sequence[str],
+    tolerance: float,
+) -> List[str]:
+    """Describe the metrics of a measurement that grew beyond the tolerance."""
+    regressions = []
+    for metric in metrics:
+        # ignore noise on tiny measurements
+        floor = 1.0 if metric == "peak_rss_mb" else 0.05
+        limit = max(base[metric], floor) * (1 + tolerance)
+        if res[metric] > limit:
+            regressions.append(
+                f"{label}: {metric} {base[metric]:.02f} -> {res[metric]:.02f}"
+            )
+    return regressions
+
+
+def compare_results(
+    baseline: Dict[str, Any], current: Dict[str, Any], tolerance: float = 0.2
+) -> List[str]:
+    """
+    Find the stages that got slower or used more memory than a baseline.
+
+    The stages recorded within a pipeline run are compared as well, so that
+    a regression of one of them is not hidden by the rest of the pipeline.
+
+    :param baseline: the results of the baseline run, from :func:`bench_suite`.
+    :param current: the results of the current run.
+    :param tolerance: the relative increase tolerated before reporting.
+    :return: a description of each regression.
+    """
+    expected = {(r["n_companies"], r["stage"]): r for r in baseline["results"]}
+    regressions = []
+    for res in current["results"]:
+        base = expected.get((res["n_companies"], res["stage"]))
+        if base is None:
+            continue
+        label = f"{res['stage']} of {res['n_companies']} companies"
+        regressions += _compare_metrics(
+            label, base, res, ("seconds", "peak_rss_mb"), tolerance
+        )
+        base_stages = {s["name"]: s for s in base.get("stages", [])}
+        for stage in res.get("stages", []):
+            if stage["name"] not in base_stages:
+                continue
+            regressions += _compare_metrics(
+                f"{res['stage']}/{stage['name']} of {res['n_companies']} "
+                "companies",
+                base_stages[stage["name"]],
+                stage,
+                ("wall_seconds", "peak_rss_mb"),
+                tolerance,
+            )
+    return regressions
+
+
+def add_bench_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    Add the benchmark suite options to a command line parser.
+
+    :param parser: the parser.
+    """
+    parser.add_argument(
+        "--scales", type=int, nargs="+", default=list(BENCH_SCALES)
+    )
+    parser.add_argument("--n-dates", type=int, default=4000)
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=[s.value for s in BenchStage],
+        help="the stages to measure, defaults to all",
+    )
+    parser.add_argument("--output", type=Path, help="json file for results")
+    parser.add_argument(
+        "--baseline", type=Path, help="json results to compare against"
+    )
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument(
+        "--load",
+        action="store_true",
+        help="compare the dataset formats instead",
+    )
+
+
+def run_bench(args: argparse.Namespace) -> int:
+    """
+    Run the benchmark suite with parsed command line options.
+
+    :param args: the options, see :func:`add_bench_arguments`.
+    :return: the exit code, 1 if regressions were found.
+    """
+    with TemporaryDirectory(prefix="bench") as tmp:
+        if args.load:
+            bench_load(Path(tmp))
+            return 0
+        stages = args.stages and [BenchStage(s) for s in args.stages]
+        results = bench_suite(Path(tmp), args.scales, args.n_dates, stages)
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=1))
+        log.info("Saved benchmark results to %s", args.output)
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())
+        regressions = compare_results(baseline, results, args.tolerance)
+        for regression in regressions:
+            log.warning("Regression in %s", regression)
+        return 1 if regressions else 0
+    return 0
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    """
+    Run the benchmark suite from the command line.
+
+    :param argv: the command line arguments.
+    :return: the exit code, 1 if regressions were found.
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m etl_pipeline_example.bench",
+        description="Benchmark the pipeline stages at several scales.",
+    )
+    add_bench_arguments(parser)
+    args = parser.parse_args(argv)
+    setup_logging()
+    return run_bench(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,189 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+CACHE_DIR = "cache"
+"""Name of the stage cache directory, in the store directory."""
+CACHE_BYTES = 2**30
+"""Default size limit of the stage cache."""
+_HASH_BLOCK_SIZE = 2**20
+"""Number of bytes hashed at a time when hashing file contents."""
+
+
+def fingerprint(path: Path, content: bool = False) -> Dict[str, Any]:
+    """
+    Identify the version of a file, or of a directory of files.
+
+    The files of a directory, such as the shards of a dataset, are
+    identified together by their total size and latest modification time,
+    or by a hash of their contents in name order.
+
+    :param path: the file or directory path.
+    :param content: whether to hash the file contents, rather than rely on
+        the size and modification time of the file.
+    :return: a json serializable fingerprint, or None values if the file
+        doesn't exist.
+    """
+    if not path.exists():
+        return {"path": str(path), "size": None}
+    is_dir = path.is_dir()
+    files = (
+        sorted(p for p in path.rglob("*") if p.is_file()) if is_dir else [path]
+    )
+    stats = [f.stat() for f in files]
+    res = {"path": str(path), "size": sum(stat.st_size for stat in stats)}
+    if is_dir:
+        res["n_files"] = len(files)
+    if content:
+        digest = hashlib.sha256()
+        for file in files:
+            with open(file, "rb") as f:
+                while block := f.read(_HASH_BLOCK_SIZE):
+                    digest.update(block)
+        res["sha256"] = digest.hexdigest()
+    else:
+        res["mtime_ns"] = max((stat.st_mtime_ns for stat in stats), default=0)
+    return res
+
+
+def cache_key(*parts: Any) -> str:
+    """
+    Get a key identifying the inputs of a stage.
+
+    :param parts: the inputs, which must be json serializable. Dates and other
+        values are serialized with their string representation.
+    :return: a hex digest of the inputs.
+    """
+    data = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()[:32]
+
+
+class StageCache:
+    """
+    Cache the results of pipeline stages, addressed by the key of their inputs.
+
+    Each entry is a parquet file named after its stage and key, so entries
+    never need to be updated: a change in the inputs gives a new key. Using
+    an entry refreshes its modification time, and the least recently used
+    entries are evicted when the cache grows larger than ``max_bytes``.
+
+    :param cache_dir: the cache directory.
+    :param max_bytes: the size limit of the cache.
+    :param enabled: whether to read and write entries.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path,
+        max_bytes: int = CACHE_BYTES,
+        enabled: bool = True,
+    ):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, stage: str, key: str) -> Path:
+        """
+        Get the path of a cache entry.
+
+        :param stage: the stage name.
+        :param key: the key of the stage inputs, see :func:`cache_key`.
+        :return: the path of the entry, which may not exist.
+        """
+        return self.cache_dir / f"{stage}-{key}.parquet"
+
+    def contains(self, stage: str, key: str) -> bool:
+        """
+        Check if a stage result is cached.
+
+        :param stage: the stage name.
+        :param key: the key of the stage inputs.
+        :return: True if the entry exists and the cache is enabled.
+        """
+        return self.enabled and self.path(stage, key).exists()
+
+    def load(self, stage: str, key: str) -> pd.DataFrame | None:
+        """
+        Load a stage result from the cache.
+
+        :param stage: the stage name.
+        :param key: the key of the stage inputs.
+        :return: the result, or None if it is not cached.
+        """
+        if not self.contains(stage, key):
+            self.misses += 1
+            return None
+        path = self.path(stage, key)
+        data = pd.read_parquet(path)
+        os.utime(path)
+        self.hits += 1
+        return data
+
+    def save(self, stage: str, key: str, data: pd.DataFrame) -> None:
+        """
+        Save a stage result to the cache.
+
+        :param stage: the stage name.
+        :param key: the key of the stage inputs.
+        :param data: the result.
+        """
+        if not self.enabled:
+            return
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self.path(stage, key)
+        # never leave a partially written entry behind
+        tmp_path = path.with_suffix(".tmp")
+        data.to_parquet(tmp_path, compression="zstd")
+        tmp_path.replace(path)
+
+    def _entries(self) -> List[Tuple[os.stat_result, Path]]:
+        """Get the cache entries, least recently used first."""
+        if not self.cache_dir.exists():
+            return []
+        entries = [(p.stat(), p) for p in self.cache_dir.glob("*.parquet")]
+        return sorted(entries, key=lambda entry: entry[0].st_mtime_ns)
+
+    def size(self) -> int:
+        """
+        Get the size of the cache.
+
+        :return: the total size of the entries, in bytes.
+        """
+        return sum(stat.st_size for stat, _ in self._entries())
+
+    def evict(self) -> int:
+        """
+        Remove the least recently used entries, until the cache fits its limit.
+
+        :return: the number of entries removed.
+        """
+        entries = self._entries()
+        total = sum(stat.st_size for stat, _ in entries)
+        n_evicted = 0
+        for stat, path in entries:
+            if total <= self.max_bytes:
+                break
+            path.unlink()
+            total -= stat.st_size
+            n_evicted += 1
+        if n_evicted:
+            log.debug("Evicted %i cache entries from %s", n_evicted, self)
+        return n_evicted
+
+    def clear(self) -> None:
+        """Remove all the entries."""
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def __repr__(self) -> str:
+        """Show the cache directory."""
+        return f"StageCache({self.cache_dir})"
@@ -1,12 +1,30 @@
-from itertools import repeat
+import logging
+from functools import partial
 from pathlib import Path
-from typing import Any, Tuple
+from typing import Any, Iterator, Tuple
 
 import numpy as np
 import pandas as pd
 from pandas.tseries.offsets import BaseOffset
 
+from etl_pipeline_example.dataset import (
+    DatasetFormat,
+    dataset_paths,
+    remove_company_returns,
+    shard_path,
+    write_company_file,
+    write_company_returns,
+    write_market_returns,
+)
+from etl_pipeline_example.executor import map_ordered
+
+log = logging.getLogger(__name__)
+
 DEFAULT_RANDOM_SEED = 42
+COMPANY_BLOCK_SIZE = 256
+"""Number of companies generated from each random stream."""
+SHARD_COMPANIES = 2**13
+"""Max number of companies in each shard file of a large company dataset."""
 
 
 def date_index(
@@ -28,6 +46,117 @@ def date_index(
     return pd.date_range(history_start, history_end, name=name, freq=freq)
 
 
+def _seed_sequence(random_seed: Any) -> np.random.SeedSequence:
+    """Get the root seed sequence for a random seed."""
+    if isinstance(random_seed, np.random.SeedSequence):
+        return random_seed
+    return np.random.SeedSequence(random_seed)
+
+
+def _block_rng(
+    seed_seq: np.random.SeedSequence, block: int, stream: int
+) -> np.random.Generator:
+    """Get an independent random generator for a block of companies."""
+    child = np.random.SeedSequence(
+        seed_seq.entropy, spawn_key=(*seed_seq.spawn_key, block, stream)
+    )
+    return np.random.default_rng(child)
+
+
+def _company_block(
+    dates: pd.DatetimeIndex,
+    block: int,
+    n_companies: int,
+    n_dates: int,
+    seed_seq: np.random.SeedSequence,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Create returns for a block of companies.
+
+    :return: the company ids, the positions of the dates in the input dates,
+        and the returns, sorted by company id and date position.
+    """
+    first = block * COMPANY_BLOCK_SIZE
+    n_block = min(COMPANY_BLOCK_SIZE, n_companies - first)
+    n_all_dates = len(dates)
+    if n_dates > n_all_dates:
+        raise ValueError(
+            f"Cannot sample {n_dates} dates out of {n_all_dates} without "
+            "replacement"
+        )
+    # sample dates without replacement for all the companies at once, taking
+    # the positions of the n_dates smallest random keys
+    keys = _block_rng(seed_seq, block, 0).random((n_block, n_all_dates))
+    if 0 < n_dates < n_all_dates:
+        date_codes = np.argpartition(keys, n_dates - 1, axis=1)[:, :n_dates]
+    else:
+        date_codes = np.argsort(keys, axis=1)[:, :n_dates]
+    date_codes.sort(axis=1)
+    returns = _block_rng(seed_seq, block, 1).normal(
+        loc=0, scale=0.012, size=(n_block, n_dates)
+    )
+    company_ids = np.repeat(np.arange(first, first + n_block), n_dates)
+    return company_ids, date_codes.ravel(), returns.ravel()
+
+
+def _company_series(
+    dates: pd.DatetimeIndex,
+    company_ids: np.ndarray,
+    date_codes: np.ndarray,
+    returns: np.ndarray,
+) -> pd.Series:
+    """Build a company returns series from integer codes."""
+    companies, company_codes = np.unique(company_ids, return_inverse=True)
+    index = pd.MultiIndex(
+        levels=[companies, dates],
+        codes=[company_codes, date_codes],
+        names=["companyid", "date"],
+        verify_integrity=False,
+    ).remove_unused_levels()
+    return pd.Series(index=index, data=returns, name="returns")
+
+
+def iter_company_data(
+    dates: pd.DatetimeIndex | None = None,
+    n_companies: int = 500,
+    n_dates: int = 4000,
+    random_seed: Any = DEFAULT_RANDOM_SEED,
+) -> Iterator[pd.Series]:
+    """Create company returns in chunks, in company id order.
+
+    Each chunk holds :data:`COMPANY_BLOCK_SIZE` companies, generated from its
+    own random stream, so that large datasets can be written to disk without
+    holding all the returns in memory. Results are the same as
+    :func:`company_data`.
+
+    :param dates: the datetimes to sample from
+    :param n_companies: the number of companies in the resulting series.
+    :param n_dates: the number of datetime samples to take.
+    :param random_seed: an optional random seed for repeatable results.
+    :return: an iterator on series of randomized company returns.
+    """
+    if dates is None:
+        dates = date_index()
+    seed_seq = _seed_sequence(random_seed)
+    n_blocks = -(-n_companies // COMPANY_BLOCK_SIZE)
+    yield from _company_chunks(
+        dates, range(n_blocks), n_companies, n_dates, seed_seq
+    )
+
+
+def _company_chunks(
+    dates: pd.DatetimeIndex,
+    blocks: range,
+    n_companies: int,
+    n_dates: int,
+    seed_seq: np.random.SeedSequence,
+) -> Iterator[pd.Series]:
+    """Create the company returns of some blocks, one block at a time."""
+    for block in blocks:
+        arrays = _company_block(dates, block, n_companies, n_dates, seed_seq)
+        yield _company_series(dates, *arrays)
+
+
 def company_data(
     dates: pd.DatetimeIndex | None = None,
     n_companies: int = 500,
@@ -36,6 +165,9 @@ def company_data(
 ) -> pd.Series:
     """Create a series of company returns.
 
+    Returns are sorted by company id and date. The returns of each company
+    only depend on the random seed and on the company id.
+
     :param dates: the datetimes to sample from
     :param n_companies: the number of companies in the resulting series.
     :param n_dates: the number of datetime samples to take.
@@ -44,18 +176,15 @@ def company_data(
     """
     if dates is None:
         dates = date_index()
-    # make randomisation deterministic
-    np.random.seed(random_seed)
-    index_n = [
-        list(
-            zip(repeat(i), np.random.choice(dates, size=n_dates, replace=False))
-        )
-        for i in range(n_companies)
+    seed_seq = _seed_sequence(random_seed)
+    blocks = [
+        _company_block(dates, block, n_companies, n_dates, seed_seq)
+        for block in range(-(-n_companies // COMPANY_BLOCK_SIZE))
     ]
-    index_all = [x for y in index_n for x in y]
-    index = pd.MultiIndex.from_tuples(index_all, names=["companyid", "date"])
-    returns = np.random.normal(loc=0, scale=0.012, size=n_companies * n_dates)
-    return pd.Series(index=index, data=returns, name="returns")
+    if not blocks:
+        blocks = [_company_block(dates, 0, 0, n_dates, seed_seq)]
+    company_ids, date_codes, returns = map(np.concatenate, zip(*blocks))
+    return _company_series(dates, company_ids, date_codes, returns)
 
 
 def returns_data(
@@ -70,12 +199,90 @@ def returns_data(
     """
     if dates is None:
         dates = date_index()
-    # make randomisation deterministic
-    np.random.seed(random_seed)
-    mkt_returns = np.random.normal(loc=0, scale=0.008, size=len(dates))
+    rng = np.random.default_rng(_seed_sequence(random_seed))
+    mkt_returns = rng.normal(loc=0, scale=0.008, size=len(dates))
     return pd.Series(index=dates, data=mkt_returns, name="returns")
 
 
+def _write_company_shard(
+    dates: pd.DatetimeIndex,
+    n_companies: int,
+    n_dates: int,
+    seed_seq: np.random.SeedSequence,
+    dataset_format: DatasetFormat,
+    shard: Tuple[Path, range],
+) -> Path:
+    """Create the returns of the blocks of a shard, and write them to it."""
+    path, blocks = shard
+    chunks = _company_chunks(dates, blocks, n_companies, n_dates, seed_seq)
+    return write_company_file(chunks, path, dataset_format)
+
+
+def write_company_shards(
+    dataset_dir: Path,
+    dates: pd.DatetimeIndex,
+    n_companies: int,
+    n_dates: int,
+    random_seed: Any = DEFAULT_RANDOM_SEED,
+    dataset_format: DatasetFormat = DatasetFormat.PARQUET,
+    shard_companies: int = SHARD_COMPANIES,
+    n_workers: int = 1,
+) -> Path:
+    """
+    Write company returns as a directory of shards, in a pool of processes.
+
+    Each shard holds consecutive blocks of :data:`COMPANY_BLOCK_SIZE`
+    companies, and is created and written by a worker one block at a time,
+    so memory usage is bounded by a block in each worker. Blocks are
+    generated from their own random streams, so shards are the same for any
+    number of workers. Shards are written to a temporary directory, which
+    replaces the existing company returns once complete.
+
+    :param dataset_dir: the directory to write into.
+    :param dates: the datetimes to sample from.
+    :param n_companies: the number of companies.
+    :param n_dates: the number of dates for which companies have returns.
+    :param random_seed: an optional random seed for repeatable results.
+    :param dataset_format: the file format, which must be columnar.
+    :param shard_companies: the max number of companies in each shard,
+        rounded up to whole blocks.
+    :param n_workers: the number of processes writing shards.
+    :return: the path to the directory of company returns.
+    """
+    if dataset_format == DatasetFormat.PICKLE:
+        raise ValueError("Pickled company returns can't be sharded")
+    path, _ = dataset_paths(dataset_dir, dataset_format)
+    tmp_dir = path.with_name(f"{path.name}.tmp")
+    remove_company_returns(tmp_dir)
+    tmp_dir.mkdir(parents=True)
+    n_blocks = -(-n_companies // COMPANY_BLOCK_SIZE)
+    shard_blocks = max(1, -(-shard_companies // COMPANY_BLOCK_SIZE))
+    shards = [
+        (
+            shard_path(tmp_dir, n_shard, dataset_format),
+            range(first, min(first + shard_blocks, n_blocks)),
+        )
+        for n_shard, first in enumerate(range(0, n_blocks, shard_blocks))
+    ]
+    log.info(
+        "Writing %i company shards with %i workers", len(shards), n_workers
+    )
+    write_shard = partial(
+        _write_company_shard,
+        dates,
+        n_companies,
+        n_dates,
+        _seed_sequence(random_seed),
+        dataset_format,
+    )
+    n_workers = max(1, min(n_workers, len(shards)))
+    for shard in map_ordered(write_shard, shards, n_workers):
+        log.debug("Wrote company shard %s", shard.name)
+    remove_company_returns(path)
+    tmp_dir.replace(path)
+    return path
+
+
 def write_dataset(
     dataset_dir: Path,
     history_start: str | pd.Timestamp = "2000-01-01",
@@ -83,8 +290,17 @@ def write_dataset(
     n_companies: int = 5000,
     n_dates: int = 4000,
     random_seed: Any = DEFAULT_RANDOM_SEED,
+    dataset_format: DatasetFormat = DatasetFormat.PARQUET,
+    n_workers: int = 1,
+    shard_companies: int = SHARD_COMPANIES,
 ) -> Tuple[Path, Path]:
-    """Write a dataset of company and market returns using pickle.
+    """Write a dataset of company and market returns.
+
+    With columnar formats, company returns are written to disk in chunks as
+    they are generated, so that datasets larger than memory can be created.
+    Datasets of more than ``shard_companies`` companies are written as a
+    directory of shards, by ``n_workers`` processes, see
+    :func:`write_company_shards`. The data only depends on the random seed.
 
     :param history_start: the history start date.
     :param history_end: the history end date, or None to use today.
@@ -92,16 +308,32 @@ def write_dataset(
     :param n_companies: the number of companies in the dataset.
     :param n_dates: the number of dates for which companies have returns.
     :param random_seed: an optional random seed for repeatable results.
+    :param dataset_format: the file format, columnar parquet by default.
+    :param n_workers: the number of processes writing company shards.
+    :param shard_companies: the max number of companies in each shard.
     :return: paths to the company and market return files respectively.
     """
     dates = date_index(history_start=history_start, history_end=history_end)
-    comp = company_data(
-        dates, n_companies=n_companies, n_dates=n_dates, random_seed=random_seed
-    )
-    market = returns_data(dates, random_seed=random_seed)
-    cr = dataset_dir / "company_returns.pkl"
-    mr = dataset_dir / "market_returns.pkl"
-    dataset_dir.mkdir(exist_ok=True, parents=True)
-    comp.to_pickle(cr)
-    market.to_pickle(mr)
+    seed_seq = _seed_sequence(random_seed)
+    if dataset_format != DatasetFormat.PICKLE and n_companies > shard_companies:
+        cr = write_company_shards(
+            dataset_dir,
+            dates,
+            n_companies,
+            n_dates,
+            seed_seq,
+            dataset_format,
+            shard_companies,
+            n_workers,
+        )
+    else:
+        chunks = iter_company_data(
+            dates,
+            n_companies=n_companies,
+            n_dates=n_dates,
+            random_seed=seed_seq,
+        )
+        cr = write_company_returns(chunks, dataset_dir, dataset_format)
+    market = returns_data(dates, random_seed=seed_seq)
+    mr = write_market_returns(market, dataset_dir, dataset_format)
     return cr, mr
@@ -0,0 +1,562 @@
+import logging
+import shutil
+from enum import Enum
+from pathlib import Path
+from typing import Callable, Collection, Iterable, List, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from etl_pipeline_example.panel import CompanyPanel
+
+log = logging.getLogger(__name__)
+
+COMPANY_RETURNS = "company_returns"
+"""Base name of the company returns file."""
+MARKET_RETURNS = "market_returns"
+"""Base name of the market returns file."""
+ROW_GROUP_SIZE = 2**18
+"""Number of rows in each parquet row group or feather record batch."""
+
+
+class DatasetFormat(Enum):
+    """File format of the company and market returns."""
+
+    PARQUET = "parquet"
+    """Columnar parquet files, sorted by company id and date."""
+    FEATHER = "feather"
+    """Columnar feather (arrow IPC) files, sorted by company id and date."""
+    PICKLE = "pkl"
+    """Legacy pickled pandas series."""
+
+
+def dataset_paths(data_dir: Path, fmt: DatasetFormat) -> Tuple[Path, Path]:
+    """
+    Get the paths to the company and market returns in a data directory.
+
+    Columnar company returns can also be a directory of shard files with the
+    same name, see :func:`shard_path`, which is read as a single file.
+
+    :param data_dir: the data directory.
+    :param fmt: the dataset format.
+    :return: paths to the company and market return files respectively.
+    """
+    return (
+        data_dir / f"{COMPANY_RETURNS}.{fmt.value}",
+        data_dir / f"{MARKET_RETURNS}.{fmt.value}",
+    )
+
+
+def detect_format(data_dir: Path) -> DatasetFormat | None:
+    """
+    Detect the format of the dataset in a directory.
+
+    Columnar formats take precedence over pickle if more than one is present.
+
+    :param data_dir: the data directory.
+    :return: the dataset format, or None if no dataset is found.
+    """
+    for fmt in DatasetFormat:
+        if all(p.exists() for p in dataset_paths(data_dir, fmt)):
+            return fmt
+    return None
+
+
+def _level_values(
+    index: pd.MultiIndex, level: str, convert: Callable[[pd.Index], np.ndarray]
+) -> np.ndarray:
+    """
+    Materialize the values of an index level from its codes.
+
+    Only the distinct values are converted, before taking them by code.
+    """
+    n_level = index.names.index(level)
+    return convert(index.levels[n_level])[index.codes[n_level]]
+
+
+def _days(dates: pd.Index) -> np.ndarray:
+    """Get int32 days since the epoch, the physical type of date32."""
+    return dates.to_numpy("datetime64[D]").view(np.int64).astype(np.int32)
+
+
+def is_sorted(index: pd.MultiIndex) -> bool:
+    """
+    Check if a company and date index is sorted, from its codes.
+
+    This is equivalent to ``index.is_monotonic_increasing``, without the
+    temporary copies of the index values pandas makes.
+
+    :param index: the index, with companyid and date levels.
+    :return: True if the index is sorted by company id and date.
+    """
+    if not all(level.is_monotonic_increasing for level in index.levels):
+        return index.is_monotonic_increasing
+    company_codes = index.codes[index.names.index("companyid")]
+    date_codes = index.codes[index.names.index("date")]
+    company_steps = np.diff(company_codes)
+    if np.any(company_steps < 0):
+        return False
+    return not np.any((company_steps == 0) & (np.diff(date_codes) < 0))
+
+
+def company_returns_table(company_data: pd.Series) -> pa.Table:
+    """
+    Convert company returns to a compact arrow table.
+
+    The table is sorted by company id and date, which are stored as int32
+    and date32 respectively. They are built from the index codes, with a
+    single 4 bytes per row allocation each, while the returns share the
+    memory of the series.
+
+    :param company_data: the company returns, with a companyid and date index.
+    :return: the arrow table.
+    """
+    if not is_sorted(company_data.index):
+        company_data = company_data.sort_index()
+    index = company_data.index
+    company_ids = _level_values(
+        index, "companyid", lambda ids: ids.to_numpy().astype(np.int32)
+    )
+    days = _level_values(index, "date", _days)
+    dates = pa.Array.from_buffers(
+        pa.date32(), len(days), [None, pa.py_buffer(days)]
+    )
+    return pa.table(
+        {
+            "companyid": company_ids,
+            "date": dates,
+            "returns": company_data.to_numpy(),
+        }
+    )
+
+
+def market_returns_table(market_data: pd.Series) -> pa.Table:
+    """
+    Convert market returns to an arrow table with date32 dates.
+
+    :param market_data: the market returns, with a date index.
+    :return: the arrow table.
+    """
+    dates = market_data.index.to_numpy("datetime64[D]")
+    return pa.table(
+        {
+            "date": pa.array(dates, type=pa.date32()),
+            "returns": market_data.to_numpy(),
+        }
+    )
+
+
+class _ColumnarWriter:
+    """Write arrow tables to a columnar file one chunk at a time."""
+
+    def __init__(self, path: Path, fmt: DatasetFormat):
+        self.path = path
+        self.fmt = fmt
+        self._writer = None
+
+    def write(self, table: pa.Table) -> None:
+        if self._writer is None:
+            if self.fmt == DatasetFormat.PARQUET:
+                self._writer = pq.ParquetWriter(self.path, table.schema)
+            elif self.fmt == DatasetFormat.FEATHER:
+                # same compression as write_feather
+                options = pa.ipc.IpcWriteOptions(compression="lz4")
+                self._writer = pa.ipc.new_file(
+                    self.path, table.schema, options=options
+                )
+            else:
+                raise NotImplementedError(f"Not a columnar format: {self.fmt}")
+        if self.fmt == DatasetFormat.PARQUET:
+            self._writer.write_table(table, row_group_size=ROW_GROUP_SIZE)
+        else:
+            self._writer.write_table(table, max_chunksize=ROW_GROUP_SIZE)
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+
+
+def shard_path(path: Path, n_shard: int, fmt: DatasetFormat) -> Path:
+    """
+    Get the path of a shard of company returns written as a directory.
+
+    Shards are numbered in company id order, and their names sort in the
+    same order, which is the order datasets read them in.
+
+    :param path: the directory of the shards.
+    :param n_shard: the shard number.
+    :param fmt: the dataset format.
+    :return: the path of the shard file.
+    """
+    return path / f"part-{n_shard:05d}.{fmt.value}"
+
+
+def remove_company_returns(path: Path) -> None:
+    """
+    Remove company returns written as a single file or as shards.
+
+    :param path: the file or directory of the company returns.
+    """
+    if path.is_dir():
+        shutil.rmtree(path)
+    else:
+        path.unlink(missing_ok=True)
+
+
+def write_company_file(
+    chunks: Iterable[pd.Series],
+    path: Path,
+    fmt: DatasetFormat = DatasetFormat.PARQUET,
+) -> Path:
+    """
+    Write company returns to a columnar file, one chunk at a time.
+
+    Each chunk is written as soon as it is received, so only one chunk needs
+    to be in memory.
+
+    :param chunks: chunks of company returns, in company id order.
+    :param path: the file path.
+    :param fmt: the columnar dataset format.
+    :return: the file path.
+    """
+    writer = _ColumnarWriter(path, fmt)
+    try:
+        for chunk in chunks:
+            writer.write(company_returns_table(chunk))
+    finally:
+        writer.close()
+    return path
+
+
+def write_company_returns(
+    chunks: Iterable[pd.Series],
+    data_dir: Path,
+    fmt: DatasetFormat = DatasetFormat.PARQUET,
+) -> Path:
+    """
+    Write company returns to a data directory, one chunk at a time.
+
+    With columnar formats, each chunk is written as soon as it is received,
+    so only one chunk needs to be in memory. To keep the file sorted by
+    company id, chunks must be in company id order and must not share
+    companies. Existing company returns are replaced, even if they were
+    written as shards.
+
+    :param chunks: chunks of company returns.
+    :param data_dir: the directory to write into.
+    :param fmt: the dataset format.
+    :return: the path to the company returns file.
+    """
+    path, _ = dataset_paths(data_dir, fmt)
+    data_dir.mkdir(exist_ok=True, parents=True)
+    remove_company_returns(path)
+    if fmt == DatasetFormat.PICKLE:
+        pd.concat(chunks).to_pickle(path)
+        return path
+    return write_company_file(chunks, path, fmt)
+
+
+def write_market_returns(
+    market_data: pd.Series,
+    data_dir: Path,
+    fmt: DatasetFormat = DatasetFormat.PARQUET,
+) -> Path:
+    """
+    Write market returns to a data directory.
+
+    :param market_data: the market returns.
+    :param data_dir: the directory to write into.
+    :param fmt: the dataset format.
+    :return: the path to the market returns file.
+    """
+    _, path = dataset_paths(data_dir, fmt)
+    data_dir.mkdir(exist_ok=True, parents=True)
+    if fmt == DatasetFormat.PICKLE:
+        market_data.to_pickle(path)
+        return path
+    writer = _ColumnarWriter(path, fmt)
+    try:
+        writer.write(market_returns_table(market_data))
+    finally:
+        writer.close()
+    return path
+
+
+def write_returns(
+    company_data: pd.Series,
+    market_data: pd.Series,
+    data_dir: Path,
+    fmt: DatasetFormat = DatasetFormat.PARQUET,
+) -> Tuple[Path, Path]:
+    """
+    Write company and market returns to a data directory.
+
+    :param company_data: the company returns.
+    :param market_data: the market returns.
+    :param data_dir: the directory to write into.
+    :param fmt: the dataset format.
+    :return: paths to the company and market return files respectively.
+    """
+    return (
+        write_company_returns([company_data], data_dir, fmt),
+        write_market_returns(market_data, data_dir, fmt),
+    )
+
+
+def filter_expression(
+    companies: Collection[int] | None,
+    start: pd.Timestamp | str | None,
+    end: pd.Timestamp | str | None,
+    date_type: pa.DataType = pa.date32(),
+) -> ds.Expression | None:
+    """
+    Build a dataset filter on company ids and an inclusive date range.
+
+    :param companies: the company ids to keep, or None to keep all. A range
+        of consecutive ids is filtered as a range rather than as a set.
+    :param start: the first date to keep.
+    :param end: the last date to keep.
+    :param date_type: the arrow type of the date column.
+    :return: the filter, or None if there is nothing to filter.
+    """
+    conditions = []
+    if isinstance(companies, range) and companies.step == 1:
+        # a range of ids is checked against the row group statistics
+        conditions.append(ds.field("companyid") >= companies.start)
+        conditions.append(ds.field("companyid") < companies.stop)
+    elif companies is not None:
+        conditions.append(ds.field("companyid").isin(list(companies)))
+    if start is not None:
+        start = pa.scalar(pd.Timestamp(start), type=date_type)
+        conditions.append(ds.field("date") >= start)
+    if end is not None:
+        end = pa.scalar(pd.Timestamp(end), type=date_type)
+        conditions.append(ds.field("date") <= end)
+    expr = None
+    for condition in conditions:
+        expr = condition if expr is None else expr & condition
+    return expr
+
+
+def _open_dataset(path: Path, fmt: DatasetFormat) -> ds.Dataset:
+    """Open a columnar file as an arrow dataset."""
+    if fmt == DatasetFormat.PICKLE:
+        raise NotImplementedError(f"Not a columnar format: {fmt}")
+    file_format = "ipc" if fmt == DatasetFormat.FEATHER else "parquet"
+    return ds.dataset(path, format=file_format)
+
+
+def _read_table(
+    path: Path,
+    fmt: DatasetFormat,
+    columns: List[str],
+    filter_expr: ds.Expression | None = None,
+) -> pa.Table:
+    """Read a columnar file with pyarrow's multithreaded dataset scanner."""
+    dataset = _open_dataset(path, fmt)
+    return dataset.to_table(
+        columns=columns, filter=filter_expr, use_threads=True
+    )
+
+
+def read_company_returns(
+    data_dir: Path,
+    fmt: DatasetFormat | None = None,
+    companies: Collection[int] | None = None,
+    start: pd.Timestamp | str | None = None,
+    end: pd.Timestamp | str | None = None,
+) -> pd.Series:
+    """
+    Read company returns from a data directory.
+
+    Filters on companies and dates are pushed down to the columnar reader,
+    so that only the matching row groups are read.
+
+    :param data_dir: the data directory.
+    :param fmt: the dataset format, detected from the files if None.
+    :param companies: the company ids to read, or None to read all.
+    :param start: the first date to read, inclusive.
+    :param end: the last date to read, inclusive.
+    :return: the company returns, with a companyid and date index.
+    """
+    fmt = fmt or _detect_format_or_raise(data_dir)
+    path, _ = dataset_paths(data_dir, fmt)
+    log.debug("Reading company returns from %s", path)
+    if fmt == DatasetFormat.PICKLE:
+        company_data = pd.read_pickle(path)
+        mask = np.ones(len(company_data), dtype=bool)
+        if companies is not None:
+            ids = company_data.index.get_level_values("companyid")
+            mask &= ids.isin(list(companies))
+        dates = company_data.index.get_level_values("date")
+        if start is not None:
+            mask &= dates >= pd.Timestamp(start)
+        if end is not None:
+            mask &= dates <= pd.Timestamp(end)
+        return company_data if mask.all() else company_data[mask]
+    table = _read_table(
+        path,
+        fmt,
+        ["companyid", "date", "returns"],
+        filter_expression(companies, start, end),
+    )
+    return company_returns_series(table)
+
+
+def read_company_panel(
+    data_dir: Path,
+    fmt: DatasetFormat | None = None,
+    companies: Collection[int] | None = None,
+    start: pd.Timestamp | str | None = None,
+    end: pd.Timestamp | str | None = None,
+) -> CompanyPanel:
+    """
+    Read company returns from a data directory, as a panel.
+
+    Unlike :func:`read_company_returns`, columnar formats are read without
+    building a company and date index.
+
+    :param data_dir: the data directory.
+    :param fmt: the dataset format, detected from the files if None.
+    :param companies: the company ids to read, or None to read all.
+    :param start: the first date to read, inclusive.
+    :param end: the last date to read, inclusive.
+    :return: the company returns.
+    """
+    fmt = fmt or _detect_format_or_raise(data_dir)
+    if fmt == DatasetFormat.PICKLE:
+        return CompanyPanel.from_series(
+            read_company_returns(data_dir, fmt, companies, start, end)
+        )
+    path, _ = dataset_paths(data_dir, fmt)
+    log.debug("Reading company returns from %s", path)
+    table = _read_table(
+        path,
+        fmt,
+        ["companyid", "date", "returns"],
+        filter_expression(companies, start, end),
+    )
+    return CompanyPanel.from_table(table)
+
+
+def company_summary(
+    data_dir: Path,
+    fmt: DatasetFormat | None = None,
+    companies: Collection[int] | None = None,
+    start: pd.Timestamp | str | None = None,
+    end: pd.Timestamp | str | None = None,
+) -> pd.DataFrame:
+    """
+    Summarize the company returns in a data directory, without loading them.
+
+    Only the company id and date columns are scanned, one record batch at a
+    time, so memory usage depends on the number of companies rather than on
+    the number of returns.
+
+    :param data_dir: the data directory.
+    :param fmt: the dataset format, detected from the files if None. Must be
+        a columnar format.
+    :param companies: the company ids to summarize, or None for all.
+    :param start: the first date to summarize, inclusive.
+    :param end: the last date to summarize, inclusive.
+    :return: the number of returns and the first and last date of each
+        company, in n_rows, first_date and last_date columns by company id.
+    """
+    fmt = fmt or _detect_format_or_raise(data_dir)
+    path, _ = dataset_paths(data_dir, fmt)
+    log.debug("Summarizing company returns in %s", path)
+    dataset = _open_dataset(path, fmt)
+    aggregations = [("date", "count"), ("date", "min"), ("date", "max")]
+    batch_stats = [
+        pa.Table.from_batches([batch])
+        .group_by("companyid")
+        .aggregate(aggregations)
+        for batch in dataset.to_batches(
+            columns=["companyid", "date"],
+            filter=filter_expression(companies, start, end),
+        )
+        if batch.num_rows > 0
+    ]
+    if not batch_stats:
+        return pd.DataFrame(
+            {
+                "n_rows": pd.Series(dtype=np.int64),
+                "first_date": pd.Series(dtype="datetime64[ns]"),
+                "last_date": pd.Series(dtype="datetime64[ns]"),
+            },
+            index=pd.Index([], dtype=np.int64, name="companyid"),
+        )
+    # companies spanning several record batches are merged
+    stats = (
+        pa.concat_tables(batch_stats)
+        .group_by("companyid")
+        .aggregate(
+            [("date_count", "sum"), ("date_min", "min"), ("date_max", "max")]
+        )
+    )
+    summary = pd.DataFrame(
+        {
+            "n_rows": stats["date_count_sum"].to_numpy(),
+            "first_date": stats["date_min_min"]
+            .to_numpy()
+            .astype("datetime64[ns]"),
+            "last_date": stats["date_max_max"]
+            .to_numpy()
+            .astype("datetime64[ns]"),
+        },
+        index=pd.Index(stats["companyid"].to_numpy(), name="companyid"),
+    )
+    return summary.sort_index()
+
+
+def company_returns_series(table: pa.Table) -> pd.Series:
+    """
+    Convert an arrow table of company returns to a series.
+
+    :param table: the table, with companyid, date and returns columns.
+    :return: the company returns, with a companyid and date index.
+    """
+    index = pd.MultiIndex.from_arrays(
+        [
+            table["companyid"].to_numpy(),
+            table["date"].to_numpy().astype("datetime64[ns]"),
+        ],
+        names=["companyid", "date"],
+    )
+    return pd.Series(table["returns"].to_numpy(), index=index, name="returns")
+
+
+def read_market_returns(
+    data_dir: Path, fmt: DatasetFormat | None = None
+) -> pd.Series:
+    """
+    Read market returns from a data directory.
+
+    :param data_dir: the data directory.
+    :param fmt: the dataset format, detected from the files if None.
+    :return: the market returns, with a date index.
+    """
+    fmt = fmt or _detect_format_or_raise(data_dir)
+    _, path = dataset_paths(data_dir, fmt)
+    log.debug("Reading market returns from %s", path)
+    if fmt == DatasetFormat.PICKLE:
+        market_data = pd.read_pickle(path)
+        # make sure the series index has a name, or we'll get weird errors
+        if market_data.index.name is None:
+            market_data.index = market_data.index.rename("date")
+        return market_data
+    table = _read_table(path, fmt, ["date", "returns"])
+    index = pd.DatetimeIndex(
+        table["date"].to_numpy().astype("datetime64[ns]"), name="date"
+    )
+    return pd.Series(table["returns"].to_numpy(), index=index, name="returns")
+
+
+def _detect_format_or_raise(data_dir: Path) -> DatasetFormat:
+    fmt = detect_format(data_dir)
+    if fmt is None:
+        raise FileNotFoundError(f"No company and market data in {data_dir}")
+    return fmt
@@ -0,0 +1,206 @@
+import logging
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Generic,
+    Iterable,
+    Iterator,
+    Tuple,
+    TypeVar,
+)
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+_DONE = object()
+"""Sentinel for the end of a queue."""
+_POLL_SECONDS = 0.1
+"""How often a blocked background thread checks if it should stop."""
+
+
+def map_ordered(
+    func: Callable[..., Any],
+    items: Iterable[Any],
+    n_workers: int = 1,
+    initializer: Callable[..., None] | None = None,
+    initargs: Tuple = (),
+    max_pending: int | None = None,
+) -> Iterator[Any]:
+    """
+    Apply a function to each item, optionally in a pool of processes.
+
+    Results are yielded in the same order as the input items regardless of
+    the number of workers. Only a bounded number of tasks is submitted to the
+    pool ahead of the results being consumed, so that results never pile up
+    in memory.
+
+    :param func: the function to apply, must be picklable when using more
+        than one worker.
+    :param items: the items to apply the function to.
+    :param n_workers: the number of worker processes, 1 to run everything
+        in the current process.
+    :param initializer: a function to call once in each worker before any
+        task, e.g. to set up read only state shared by all tasks.
+    :param initargs: the arguments to the initializer.
+    :param max_pending: the max number of tasks submitted but not consumed,
+        defaults to twice the number of workers.
+    :return: an iterator on the function results.
+    """
+    if n_workers < 1:
+        raise ValueError(f"Invalid number of workers: {n_workers}")
+    if n_workers == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        yield from map(func, items)
+        return
+    max_pending = max_pending or 2 * n_workers
+    log.debug("Starting pool of %i worker processes", n_workers)
+    with ProcessPoolExecutor(
+        max_workers=n_workers, initializer=initializer, initargs=initargs
+    ) as pool:
+        pending: Deque[Future] = deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def prefetch(items: Iterable[T], depth: int = 2) -> Iterator[T]:
+    """
+    Produce items on a background thread, ahead of their consumption.
+
+    Items such as partitions read from disk are produced while the
+    previous ones are being processed, so that reading and processing
+    overlap when they release the GIL, as arrow reads and numpy calculations
+    mostly do. At most ``depth`` items wait in a bounded queue, plus the one
+    being produced. Errors are raised when the failed item would have been
+    consumed, and closing the iterator stops the background thread.
+
+    :param items: the items, typically produced by a generator.
+    :param depth: the max number of items produced ahead, 0 to produce them
+        in the consuming thread.
+    :return: an iterator on the items, in order.
+    """
+    if depth < 1:
+        yield from items
+        return
+    buffer: queue.Queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(entry: Tuple[Any, BaseException | None]) -> bool:
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=_POLL_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce() -> None:
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((_DONE, None))
+        except BaseException as e:
+            put((_DONE, e))
+
+    thread = threading.Thread(target=produce, name="prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class BackgroundWriter(Generic[T]):
+    """
+    Write items on a background thread, behind their production.
+
+    Items are handed over through a bounded queue, so producing the next
+    item overlaps with writing the previous ones, and producers wait when
+    ``max_pending`` items are not written yet. The first write error is
+    raised by the next call to :meth:`submit` or by :meth:`close`, and later
+    items are discarded. Writers are context managers, which wait for all
+    the items to be written on exit.
+
+    :param write: the function writing an item.
+    :param max_pending: the max number of items waiting to be written, 0 to
+        write them in the submitting thread.
+    """
+
+    def __init__(self, write: Callable[[T], Any], max_pending: int = 2):
+        self._write = write
+        self._error: BaseException | None = None
+        self._queue: queue.Queue = queue.Queue(maxsize=max(1, max_pending))
+        self._thread: threading.Thread | None = None
+        if max_pending > 0:
+            self._thread = threading.Thread(
+                target=self._run, name="writer", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is _DONE:
+                return
+            if self._error is None:
+                try:
+                    self._write(item)
+                except BaseException as e:
+                    self._error = e
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+    def submit(self, item: T) -> None:
+        """
+        Queue an item to be written.
+
+        :param item: the item.
+        """
+        self._raise_error()
+        if self._thread is None:
+            self._write(item)
+        else:
+            self._queue.put(item)
+
+    def close(self) -> None:
+        """Wait for all the items to be written."""
+        if self._thread is not None:
+            self._queue.put(_DONE)
+            self._thread.join()
+            self._thread = None
+        self._raise_error()
+
+    def __enter__(self) -> "BackgroundWriter[T]":
+        """Start writing items."""
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Wait for all the items to be written."""
+        if exc_type is None:
+            self.close()
+            return
+        # don't hide the original error behind a write error
+        try:
+            self.close()
+        except Exception:
+            log.debug("Ignoring write error after failure", exc_info=True)
@@ -0,0 +1,337 @@
+import logging
+from enum import Enum
+from functools import lru_cache
+from typing import Callable, Dict, Sequence, Tuple
+
+import numpy as np
+
+from etl_pipeline_example.precision import MOMENT_DTYPE
+
+log = logging.getLogger(__name__)
+
+RECOMPUTE_ROWS = 2**10
+"""Rows between exact recalculations of the running window moments."""
+
+Moments = Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+"""The count of valid rows, and the xy, xx and yy co-moments of windows."""
+
+
+class Kernel(Enum):
+    """Implementation of the rolling window moments."""
+
+    AUTO = "auto"
+    """Use numba if it is installed, numpy otherwise."""
+    NUMPY = "numpy"
+    """Vectorized cumulative sums, restarted every :data:`RECOMPUTE_ROWS`."""
+    NUMBA = "numba"
+    """Running updates compiled with numba, which must be installed."""
+
+
+def window_comoments_loop(
+    x: np.ndarray,
+    y: np.ndarray,
+    window: int,
+    recompute_rows: int = RECOMPUTE_ROWS,
+) -> Moments:
+    """
+    Calculate rolling co-moments with running updates, one row at a time.
+
+    This is the source of the numba kernel, see :func:`compiled_comoments`,
+    and also runs as plain (slow) python. Each row is added to the moments of
+    its column, and the row leaving the window removed, with Welford's
+    updates of the means and co-moments. Rows where the company or the market
+    value is missing are skipped. Windows of equal values get moments of
+    exactly 0, as in pandas, from the length of the runs of equal values
+    ending at each row. The moments are recalculated exactly from
+    the window rows every ``recompute_rows`` rows, so that rounding errors
+    never build up over long histories.
+
+    :param x: a float32 or float64 (dates x companies) matrix of returns.
+    :param y: the market returns for each matrix row.
+    :param window: the window size in rows.
+    :param recompute_rows: the rows between exact recalculations.
+    :return: float64 (dates x companies) matrices of the number of valid rows
+        in each window, and of the sums of the products of the deviations
+        from the window means, NaN for windows without valid rows.
+    """
+    n_rows, n_cols = x.shape
+    out_n = np.empty((n_rows, n_cols))
+    out_xy = np.empty((n_rows, n_cols))
+    out_xx = np.empty((n_rows, n_cols))
+    out_yy = np.empty((n_rows, n_cols))
+    n = np.zeros(n_cols)
+    mx = np.zeros(n_cols)
+    my = np.zeros(n_cols)
+    cxy = np.zeros(n_cols)
+    cxx = np.zeros(n_cols)
+    cyy = np.zeros(n_cols)
+    # valid rows in the runs of equal values ending at the last valid row
+    run_x = np.zeros(n_cols)
+    run_y = np.zeros(n_cols)
+    last_x = np.zeros(n_cols)
+    last_y = np.zeros(n_cols)
+    for t in range(n_rows):
+        old = t - window
+        yt = y[t]
+        yo = y[old] if old >= 0 else np.nan
+        for j in range(n_cols):
+            if old >= 0:
+                xo = x[old, j]
+                if not (np.isnan(xo) or np.isnan(yo)):
+                    n[j] -= 1
+                    if n[j] == 0:
+                        mx[j] = my[j] = cxy[j] = cxx[j] = cyy[j] = 0.0
+                    else:
+                        dx, dy = xo - mx[j], yo - my[j]
+                        mx[j] -= dx / n[j]
+                        my[j] -= dy / n[j]
+                        cxx[j] -= dx * (xo - mx[j])
+                        cyy[j] -= dy * (yo - my[j])
+                        cxy[j] -= dx * (yo - my[j])
+            xt = x[t, j]
+            if not (np.isnan(xt) or np.isnan(yt)):
+                run_x[j] = run_x[j] + 1 if xt == last_x[j] else 1
+                run_y[j] = run_y[j] + 1 if yt == last_y[j] else 1
+                last_x[j], last_y[j] = xt, yt
+                n[j] += 1
+                dx, dy = xt - mx[j], yt - my[j]
+                mx[j] += dx / n[j]
+                my[j] += dy / n[j]
+                cxx[j] += dx * (xt - mx[j])
+                cyy[j] += dy * (yt - my[j])
+                cxy[j] += dx * (yt - my[j])
+        if (t + 1) % recompute_rows == 0:
+            first = max(0, t - window + 1)
+            for j in range(n_cols):
+                count, sx, sy = 0.0, 0.0, 0.0
+                for s in range(first, t + 1):
+                    if not (np.isnan(x[s, j]) or np.isnan(y[s])):
+                        count += 1
+                        sx += x[s, j]
+                        sy += y[s]
+                n[j] = count
+                mx[j] = sx / count if count else 0.0
+                my[j] = sy / count if count else 0.0
+                cxy[j] = cxx[j] = cyy[j] = 0.0
+                for s in range(first, t + 1):
+                    if not (np.isnan(x[s, j]) or np.isnan(y[s])):
+                        dx, dy = x[s, j] - mx[j], y[s] - my[j]
+                        cxy[j] += dx * dy
+                        cxx[j] += dx * dx
+                        cyy[j] += dy * dy
+        out_n[t] = n
+        for j in range(n_cols):
+            # empty windows have no moments, as in the numpy kernel
+            if n[j] == 0:
+                out_xy[t, j] = out_xx[t, j] = out_yy[t, j] = np.nan
+                continue
+            # equal values have no deviations, whatever the rounding errors
+            const_x, const_y = run_x[j] >= n[j], run_y[j] >= n[j]
+            out_xx[t, j] = 0.0 if const_x else cxx[j]
+            out_yy[t, j] = 0.0 if const_y else cyy[j]
+            out_xy[t, j] = 0.0 if const_x or const_y else cxy[j]
+    return out_n, out_xy, out_xx, out_yy
+
+
+@lru_cache(maxsize=None)
+def compiled_comoments() -> Callable[..., Moments] | None:
+    """
+    Compile :func:`window_comoments_loop` with numba, if it is installed.
+
+    Numba is only imported on the first call, and compiled kernels are cached
+    on disk, so that worker processes don't compile them again. The kernel
+    releases the GIL, but runs on a single thread: partitions are already
+    calculated in parallel by worker processes.
+
+    :return: the compiled kernel, or None if numba is not installed.
+    """
+    try:
+        import numba
+    except ImportError:
+        log.debug("Numba is not installed, using the numpy rolling kernel")
+        return None
+    return numba.njit(cache=True, nogil=True)(window_comoments_loop)
+
+
+def _window_sums(
+    cumsum: np.ndarray, window: int, start: int, stop: int
+) -> np.ndarray:
+    """Sum the last ``window`` rows of a cumulative sum, from start to stop."""
+    first, last = start + 1, stop + 1
+    res = cumsum[first:last].copy()
+    # rows with a full window before them
+    full = max(first, window)
+    if full < last:
+        offset, lag_first, lag_last = full - first, full - window, last - window
+        res[offset:] -= cumsum[lag_first:lag_last]
+    return res
+
+
+def block_rows(
+    windows: Sequence[int], recompute_rows: int = RECOMPUTE_ROWS
+) -> int:
+    """
+    Get the number of rows the numpy kernel calculates at a time.
+
+    Each block also sums the longest window before it, so blocks are at least
+    4 windows long, and the rows summed twice add at most a quarter to the
+    work.
+
+    :param windows: the window sizes in rows.
+    :param recompute_rows: the rows between exact recalculations.
+    :return: the number of rows in each block.
+    """
+    return max(recompute_rows, 4 * max(windows))
+
+
+def run_lengths(values: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    """
+    Count the valid rows in the run of equal values ending at each row.
+
+    Runs are counted in each column, skipping the rows that are not valid, so
+    that a window is constant when its run is at least as long as its count of
+    valid rows. Rows that are not valid get the run of the last valid row
+    before them.
+
+    :param values: a (rows x columns) matrix.
+    :param valid: whether each value is valid.
+    :return: a (rows x columns) matrix of run lengths.
+    """
+    n_rows, n_cols = values.shape
+    rows = np.arange(n_rows)[:, np.newaxis]
+    cols = np.arange(n_cols)
+    last_valid = np.maximum.accumulate(np.where(valid, rows, -1), axis=0)
+    prev_valid = np.full(values.shape, -1)
+    prev_valid[1:] = last_valid[:-1]
+    changed = valid & (
+        (prev_valid < 0) | (values != values[np.maximum(prev_valid, 0), cols])
+    )
+    run_start = np.maximum.accumulate(np.where(changed, rows, 0), axis=0)
+    n_valid = np.zeros((n_rows + 1, n_cols), dtype=np.int64)
+    np.cumsum(valid, axis=0, out=n_valid[1:])
+    return n_valid[1:] - n_valid[run_start, cols]
+
+
+def _window_comoments_numpy(
+    x: np.ndarray,
+    y: np.ndarray,
+    windows: Sequence[int],
+    recompute_rows: int,
+    start: int,
+    stop: int,
+) -> Dict[int, Moments]:
+    """
+    Calculate rolling co-moments from cumulative sums, one block at a time.
+
+    The cumulative sums of each block start at the longest window before it,
+    from values centered on their mean over the block, so their magnitude and
+    rounding errors only depend on the block length. They are shared by all
+    the windows. Blocks are converted to :data:`MOMENT_DTYPE` one at a time.
+    Windows of equal values get moments of exactly 0, see :func:`run_lengths`.
+    """
+    n_cols = x.shape[1]
+    y = np.broadcast_to(y[:, np.newaxis], x.shape)
+    res = {
+        window: tuple(np.empty((stop - start, n_cols)) for _ in range(4))
+        for window in windows
+    }
+    n_block = block_rows(windows, recompute_rows)
+    for block_start in range(start, stop, n_block):
+        block_stop = min(block_start + n_block, stop)
+        first = max(0, block_start - max(windows) + 1)
+        bx = x[first:block_stop].astype(MOMENT_DTYPE)
+        by = y[first:block_stop].astype(MOMENT_DTYPE)
+        valid = ~(np.isnan(bx) | np.isnan(by))
+        # the lookback holds the runs of the first windows of the block
+        block = slice(block_start - first, block_stop - first)
+        runs_x = run_lengths(bx, valid)[block]
+        runs_y = run_lengths(by, valid)[block]
+        # moments are shift invariant: centering avoids cancellation errors
+        n_valid = valid.sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            x_mean = np.where(valid, bx, 0.0).sum(axis=0) / n_valid
+            y_mean = np.where(valid, by, 0.0).sum(axis=0) / n_valid
+        bx = np.where(valid, bx - x_mean, 0.0)
+        by = np.where(valid, by - y_mean, 0.0)
+        cumsums = []
+        for moment in (valid, bx, by, bx * by, bx * bx, by * by):
+            cumsum = np.zeros((len(moment) + 1, n_cols))
+            np.cumsum(moment, axis=0, out=cumsum[1:])
+            cumsums.append(cumsum)
+        del bx, by, valid
+
+        rows = slice(block_start - start, block_stop - start)
+        for window in windows:
+            n, sx, sy, sxy, sxx, syy = (
+                _window_sums(c, window, block_start - first, block_stop - first)
+                for c in cumsums
+            )
+            out_n, out_xy, out_xx, out_yy = res[window]
+            out_n[rows] = n
+            with np.errstate(invalid="ignore", divide="ignore"):
+                np.subtract(sxy, sx * sy / n, out=out_xy[rows])
+                np.subtract(sxx, sx * sx / n, out=out_xx[rows])
+                np.subtract(syy, sy * sy / n, out=out_yy[rows])
+            const_x = (runs_x >= n) & (n > 0)
+            const_y = (runs_y >= n) & (n > 0)
+            out_xx[rows][const_x] = 0.0
+            out_yy[rows][const_y] = 0.0
+            out_xy[rows][const_x | const_y] = 0.0
+    return res
+
+
+def window_comoments(
+    x: np.ndarray,
+    y: np.ndarray,
+    windows: Sequence[int],
+    kernel: Kernel = Kernel.AUTO,
+    recompute_rows: int = RECOMPUTE_ROWS,
+    start: int = 0,
+    stop: int | None = None,
+) -> Dict[int, Moments]:
+    """
+    Calculate rolling co-moments of every matrix column against the market.
+
+    Windows are made of the last ``window`` rows, and only rows where both
+    the company and the market values are present are taken into account,
+    like pandas does for rolling covariance and correlation. Returns can be
+    float32: they are accumulated in :data:`MOMENT_DTYPE` either way.
+
+    The moments of a range of rows can be calculated on their own, from the
+    rows of their windows, so that the moments of a long history never need
+    to be held in memory all at once.
+
+    :param x: a (dates x companies) matrix of returns.
+    :param y: the market returns for each matrix row.
+    :param windows: the window sizes in rows.
+    :param kernel: the implementation to use.
+    :param recompute_rows: the rows between exact recalculations, which
+        bound the rounding errors of the running sums.
+    :param start: the first row to get the moments of.
+    :param stop: the row after the last one, defaults to the last row.
+    :return: for each window, float64 (rows x companies) matrices of the
+        number of valid rows, and of the sums of the products of the
+        deviations from the window means: xy, xx and yy, NaN for windows
+        without valid rows.
+    """
+    stop = len(x) if stop is None else stop
+    compiled = None
+    if kernel != Kernel.NUMPY:
+        compiled = compiled_comoments()
+        if compiled is None and kernel == Kernel.NUMBA:
+            raise ImportError("The numba rolling kernel needs numba")
+    if compiled is None:
+        return _window_comoments_numpy(
+            x, y, windows, recompute_rows, start, stop
+        )
+    first = max(0, start - max(windows) + 1)
+    lookback = start - first
+    x = np.ascontiguousarray(x[first:stop])
+    y = np.ascontiguousarray(y[first:stop], dtype=MOMENT_DTYPE)
+    return {
+        window: tuple(
+            moment[lookback:]
+            for moment in compiled(x, y, window, recompute_rows)
+        )
+        for window in windows
+    }
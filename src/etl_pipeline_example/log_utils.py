@@ -1,13 +1,38 @@
+import json
 import logging
+import resource
 import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, TypeVar
 
 import pandas as pd
+import pyarrow as pa
 
+from etl_pipeline_example.panel import CompanyPanel
 
-def setup_logging() -> None:
-    """Create a basic logging setup."""
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+_DONE = object()
+"""Sentinel for exhausted iterators."""
+
+
+def setup_logging(level: int | str = logging.INFO) -> None:
+    """
+    Create a basic logging setup.
+
+    Debug messages are logged for each partition, so formatting them has a
+    cost on large runs: only enable them when needed.
+
+    :param level: the logging level, as a number or a name such as "DEBUG".
+    """
     logging.basicConfig(
-        level=logging.DEBUG,
+        level=level,
         format="{asctime} {levelname:>5s} {module:>10}:{lineno:<3} {message}",
         style="{",
         handlers=[logging.StreamHandler(stream=sys.stdout)],
@@ -16,14 +41,14 @@ def setup_logging() -> None:
 
 def log_mem_usage(
     logger: logging.Logger,
-    data: pd.DataFrame | pd.Series,
+    data: pd.DataFrame | pd.Series | CompanyPanel,
     data_name: str,
     level: int = logging.DEBUG,
 ) -> None:
     """Log the memory usage of a pandas dataframe or series in megabytes.
 
     :param logger: the logger to use.
-    :param data: the pandas data to log memory usage for.
+    :param data: the pandas data or company panel to log memory usage for.
     :param data_name: the name of the pandas data.
     :param level: the logging level.
     """
@@ -31,3 +56,164 @@ def log_mem_usage(
     if isinstance(mu, pd.Series):
         mu = mu.sum()
     logger.log(level, "%s mem usage: %.02f MB", data_name, mu / 1e6)
+
+
+def max_rss_bytes() -> int:
+    """
+    Get the peak resident set size of the current process.
+
+    :return: the peak RSS in bytes.
+    """
+    # ru_maxrss survives exec on linux, so a spawned process would report the
+    # peak of its parent: prefer the high water mark of the process memory
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_rss() -> bool:
+    """
+    Reset the peak resident set size of the current process to its RSS.
+
+    Only supported on linux, by writing to ``/proc/self/clear_refs``.
+
+    :return: True if the peak was reset, False if it is not supported.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        return False
+    return True
+
+
+@dataclass
+class StageStats:
+    """Resource usage of a pipeline stage, summed over its executions."""
+
+    name: str
+    """The stage name."""
+    calls: int = 0
+    """The number of times the stage was executed."""
+    wall_seconds: float = 0.0
+    """The total wall time."""
+    cpu_seconds: float = 0.0
+    """The total CPU time of the current process."""
+    peak_rss_mb: float = 0.0
+    """The process peak RSS at the end of the stage."""
+    arrow_allocated_mb: float = 0.0
+    """The largest arrow memory pool allocation at the end of the stage."""
+    traced_peak_mb: float | None = None
+    """The largest python allocation peak traced during the stage."""
+
+
+class RunProfiler:
+    """
+    Record wall time, CPU time and memory usage of pipeline stages.
+
+    Stages with the same name, such as the correlation of each partition,
+    are summed into a single record. When disabled, stages only cost a
+    function call. CPU time and memory are measured in the current process
+    only, so work done in worker processes is not included.
+
+    :param enabled: whether to record stages.
+    :param trace_memory: whether to trace python allocations with
+        :mod:`tracemalloc`, which slows down allocation heavy code.
+    """
+
+    def __init__(self, enabled: bool = True, trace_memory: bool = False):
+        self.enabled = enabled
+        self.trace_memory = enabled and trace_memory
+        self.stages: Dict[str, StageStats] = {}
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """
+        Record the resource usage of a stage.
+
+        :param name: the stage name.
+        """
+        if not self.enabled:
+            yield
+            return
+        started_tracing = False
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            tracemalloc.reset_peak()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            stats = self.stages.setdefault(name, StageStats(name))
+            stats.calls += 1
+            stats.wall_seconds += wall
+            stats.cpu_seconds += cpu
+            stats.peak_rss_mb = max_rss_bytes() / 1e6
+            stats.arrow_allocated_mb = max(
+                stats.arrow_allocated_mb, pa.total_allocated_bytes() / 1e6
+            )
+            if self.trace_memory:
+                _, traced_peak = tracemalloc.get_traced_memory()
+                stats.traced_peak_mb = max(
+                    stats.traced_peak_mb or 0.0, traced_peak / 1e6
+                )
+                if started_tracing:
+                    tracemalloc.stop()
+            log.debug("Stage %s done in %.02fs", name, wall)
+
+    def iterate(self, name: str, items: Iterable[T]) -> Iterator[T]:
+        """
+        Record the resource usage of producing each item of an iterable.
+
+        :param name: the stage name.
+        :param items: the items, typically produced by a generator.
+        :return: an iterator on the items.
+        """
+        if not self.enabled:
+            yield from items
+            return
+        iterator = iter(items)
+        while True:
+            with self.stage(name):
+                item = next(iterator, _DONE)
+            if item is _DONE:
+                # the last call only found out the items were exhausted
+                self.stages[name].calls -= 1
+                return
+            yield item
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Get a machine readable report of the run.
+
+        :return: the total wall time, the process peak RSS and the stages.
+        """
+        return {
+            "wall_seconds": time.perf_counter() - self._start,
+            "peak_rss_mb": max_rss_bytes() / 1e6,
+            "stages": [asdict(s) for s in self.stages.values()],
+        }
+
+    def write_report(self, path: Path) -> None:
+        """
+        Write the run report to a json file, if enabled.
+
+        :param path: the path of the json file.
+        """
+        if not self.enabled:
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=1)
+        log.info("Saved run report to %s", path)
@@ -0,0 +1,174 @@
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc as ipc
+
+from etl_pipeline_example.bdays import from_bday_offsets, to_bday_offsets
+from etl_pipeline_example.precision import value_dtype
+
+log = logging.getLogger(__name__)
+
+MARKET_FILE = "market.arrow"
+"""Name of the memory-mapped market returns, in the store directory."""
+_FIRST_DAY_KEY = b"first_day"
+"""Schema metadata key of the business day offset of the first value."""
+
+
+class MarketSeries:
+    """
+    Market returns on the business day grid, addressed by business day offset.
+
+    Values are stored for every business day from the first to the last
+    market date, with NaN for the days without returns, so the value of the
+    business day offset ``day`` is at ``values[day - first_day]``: aligning
+    the market with company dates is an integer subtraction, rather than a
+    pandas index join. See :func:`etl_pipeline_example.bdays.to_bday_offsets`.
+
+    A series written to a file with :meth:`write` can be opened with
+    :meth:`open` as a read-only memory map, shared by all the processes
+    reading it. Such a series is pickled as its path, so worker processes
+    map the file themselves rather than receive a copy of the values.
+
+    :param first_day: the business day offset of the first value.
+    :param values: the returns of each business day.
+    :param path: the file the values are mapped from, if any.
+    """
+
+    __slots__ = ("first_day", "values", "path")
+
+    def __init__(
+        self, first_day: int, values: np.ndarray, path: Path | None = None
+    ):
+        self.first_day = int(first_day)
+        self.values = values
+        self.path = path
+
+    @classmethod
+    def from_series(cls, market_data: pd.Series) -> "MarketSeries":
+        """
+        Create a market series from a pandas series.
+
+        Returns on dates that are not business days are dropped, as they
+        never match the dates of resampled company returns.
+
+        :param market_data: the market returns, with a date index.
+        :return: the market series, float32 unless the returns need more.
+        """
+        dates = pd.DatetimeIndex(market_data.index)
+        on_grid = (dates == dates.normalize()) & (dates.dayofweek < 5)
+        days = to_bday_offsets(dates[on_grid])
+        dtype = value_dtype(market_data.dtype)
+        if not len(days):
+            return cls(0, np.array([], dtype=dtype))
+        first = int(days.min())
+        values = np.full(int(days.max()) - first + 1, np.nan, dtype=dtype)
+        values[days - first] = market_data.to_numpy()[on_grid]
+        return cls(first, values)
+
+    @classmethod
+    def open(cls, path: Path) -> "MarketSeries":
+        """
+        Map a market series file into memory, without reading it.
+
+        :param path: the file written by :meth:`write`.
+        :return: the market series, with read-only values.
+        """
+        with pa.memory_map(str(path)) as source:
+            table = ipc.open_file(source).read_all()
+        first_day = int(table.schema.metadata[_FIRST_DAY_KEY])
+        values = table["returns"].chunk(0).to_numpy(zero_copy_only=True)
+        log.debug("Mapped %i market returns from %s", len(values), path)
+        return cls(first_day, values, path)
+
+    def write(self, path: Path) -> None:
+        """
+        Write the market series to an uncompressed arrow IPC file.
+
+        The file holds the values as a single buffer, so it can be mapped
+        back with :meth:`open`. It is written to a temporary file first, so
+        a crash never leaves a partially written file behind.
+
+        :param path: the file path.
+        """
+        schema = pa.schema(
+            [("returns", pa.from_numpy_dtype(self.values.dtype))],
+            metadata={_FIRST_DAY_KEY: str(self.first_day)},
+        )
+        tmp_path = path.with_suffix(".tmp")
+        with pa.OSFile(str(tmp_path), "wb") as sink:
+            with ipc.new_file(sink, schema) as writer:
+                writer.write_table(pa.table([self.values], schema=schema))
+        tmp_path.replace(path)
+
+    def __len__(self) -> int:
+        """Get the number of business days."""
+        return len(self.values)
+
+    def __reduce__(self):
+        """Pickle a memory-mapped series as its path only."""
+        if self.path is not None:
+            return MarketSeries.open, (self.path,)
+        return MarketSeries, (self.first_day, self.values)
+
+    def window(self, first_day: int, n_days: int) -> np.ndarray:
+        """
+        Get the returns of consecutive business days.
+
+        :param first_day: the business day offset of the first day.
+        :param n_days: the number of days.
+        :return: the returns, NaN for the days outside the series. They share
+            memory with the series if all the days are inside it.
+        """
+        start = first_day - self.first_day
+        if start >= 0 and start + n_days <= len(self.values):
+            return self.values[start:][:n_days]
+        return self.take(first_day + np.arange(n_days))
+
+    def take(self, days: np.ndarray) -> np.ndarray:
+        """
+        Get the returns of some business days.
+
+        :param days: the business day offsets.
+        :return: the returns, NaN for the days outside the series.
+        """
+        positions = np.asarray(days, dtype=np.int64) - self.first_day
+        inside = (positions >= 0) & (positions < len(self.values))
+        res = np.full(len(positions), np.nan, dtype=self.values.dtype)
+        res[inside] = self.values[positions[inside]]
+        return res
+
+    def reindex(self, dates: pd.DatetimeIndex) -> np.ndarray:
+        """
+        Get the returns of some dates, like :meth:`pandas.Series.reindex`.
+
+        :param dates: the dates.
+        :return: the returns, NaN for the dates without returns and the
+            dates that are not business days.
+        """
+        days = to_bday_offsets(dates)
+        if len(days) and days[-1] - days[0] + 1 == len(days):
+            res = self.window(int(days[0]), len(days))
+        else:
+            res = self.take(days)
+        on_grid = from_bday_offsets(days) == np.asarray(dates, "datetime64[ns]")
+        if not on_grid.all():
+            res = np.where(on_grid, res, np.nan)
+        return res
+
+    def to_series(self) -> pd.Series:
+        """
+        Convert the market series to a pandas series.
+
+        :return: the returns of each business day, with a date index.
+        """
+        days = self.first_day + np.arange(len(self.values))
+        index = pd.DatetimeIndex(from_bday_offsets(days), name="date")
+        return pd.Series(self.values, index=index, name="returns")
+
+    def __repr__(self) -> str:
+        """Show the size of the series."""
+        source = "" if self.path is None else f", mapped from {self.path}"
+        return f"MarketSeries({len(self)} business days{source})"
@@ -0,0 +1,274 @@
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from etl_pipeline_example.bdays import from_bday_offsets, to_bday_offsets
+
+
+def level_codes(
+    index: pd.MultiIndex, level: str
+) -> Tuple[np.ndarray, pd.Index]:
+    """
+    Get the sorted distinct values of an index level, and the codes into them.
+
+    This reuses the codes already stored in the index, rather than hashing
+    the level values again.
+
+    :param index: the index.
+    :param level: the name of the level.
+    :return: the position of each row's value in the distinct values, and
+        the sorted distinct values.
+    """
+    n_level = index.names.index(level)
+    values, codes = index.levels[n_level], index.codes[n_level]
+    order = values.argsort()
+    rank = np.empty(len(values), dtype=np.intp)
+    rank[order] = np.arange(len(values))
+    used = np.bincount(codes, minlength=len(values))[order] > 0
+    new_codes = np.cumsum(used) - 1
+    return new_codes[rank[codes]], values[order][used]
+
+
+class CompanyPanel:
+    """
+    Company returns on the business day grid, in compressed rows by company.
+
+    Rows are sorted by company and business day. The rows of the company at
+    position ``n`` are ``indptr[n]:indptr[n + 1]``, so a company is sliced
+    in O(1) without any per row company array. Dates are stored as int32
+    offsets on the business day grid, see
+    :func:`etl_pipeline_example.bdays.to_bday_offsets`, which takes 8 bytes
+    per row with float32 values. Unlike a series with a company and date
+    index, no operation ever materializes int64 company ids or datetime64
+    dates for every row.
+
+    Dates falling on a weekend are mapped to the previous business day, as
+    when resampling to business days, so a company can have several rows on
+    the same day before resampling.
+
+    :param company_ids: the sorted company ids.
+    :param indptr: the position of the first row of each company, followed
+        by the number of rows.
+    :param days: the business day offset of each row.
+    :param values: the value of each row.
+    """
+
+    __slots__ = ("company_ids", "indptr", "days", "values")
+
+    def __init__(
+        self,
+        company_ids: np.ndarray,
+        indptr: np.ndarray,
+        days: np.ndarray,
+        values: np.ndarray,
+    ):
+        if len(indptr) != len(company_ids) + 1 or indptr[0] != 0:
+            raise ValueError("Row pointers don't match the companies")
+        if not indptr[-1] == len(days) == len(values):
+            raise ValueError("Row pointers don't match the rows")
+        self.company_ids = np.asarray(company_ids)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.days = np.asarray(days, dtype=np.int32)
+        self.values = np.asarray(values)
+
+    @classmethod
+    def from_codes(
+        cls,
+        company_codes: np.ndarray,
+        company_ids: np.ndarray,
+        days: np.ndarray,
+        values: np.ndarray,
+    ) -> "CompanyPanel":
+        """
+        Create a panel from rows in any order.
+
+        :param company_codes: the position of each row's company in the
+            company ids.
+        :param company_ids: the sorted company ids.
+        :param days: the business day offset of each row.
+        :param values: the value of each row.
+        :return: the panel.
+        """
+        company_steps = np.diff(company_codes)
+        if np.any(company_steps < 0) or np.any(
+            (company_steps == 0) & (np.diff(days) < 0)
+        ):
+            order = np.lexsort((days, company_codes))
+            company_codes, days = company_codes[order], days[order]
+            values = values[order]
+        counts = np.bincount(company_codes, minlength=len(company_ids))
+        indptr = np.zeros(len(company_ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        return cls(company_ids, indptr, days, values)
+
+    @classmethod
+    def from_series(cls, company_data: pd.Series) -> "CompanyPanel":
+        """
+        Create a panel from a series.
+
+        :param company_data: the company data, with a companyid and date
+            index.
+        :return: the panel.
+        """
+        company_codes, companies = level_codes(company_data.index, "companyid")
+        date_codes, dates = level_codes(company_data.index, "date")
+        return cls.from_codes(
+            company_codes,
+            companies.to_numpy(),
+            to_bday_offsets(dates)[date_codes],
+            company_data.to_numpy(),
+        )
+
+    @classmethod
+    def from_table(cls, table: pa.Table) -> "CompanyPanel":
+        """
+        Create a panel from an arrow table.
+
+        :param table: the table, with companyid, date and returns columns.
+        :return: the panel.
+        """
+        ids = table["companyid"].to_numpy()
+        days = to_bday_offsets(table["date"].to_numpy())
+        values = table["returns"].to_numpy()
+        company_steps = np.diff(ids)
+        if len(ids) and np.all(company_steps >= 0):
+            # sorted by company, as in the store: companies start where the
+            # id changes, and no per row codes are needed
+            starts = np.flatnonzero(company_steps) + 1
+            unsorted_days = np.diff(days) < 0
+            unsorted_days[starts - 1] = False
+            if not unsorted_days.any():
+                indptr = np.r_[0, starts, len(ids)]
+                return cls(ids[indptr[:-1]], indptr, days, values)
+        companies, company_codes = np.unique(ids, return_inverse=True)
+        return cls.from_codes(company_codes, companies, days, values)
+
+    def __len__(self) -> int:
+        """Get the number of rows."""
+        return len(self.values)
+
+    @property
+    def n_companies(self) -> int:
+        """The number of companies."""
+        return len(self.company_ids)
+
+    @property
+    def counts(self) -> np.ndarray:
+        """The number of rows of each company."""
+        return np.diff(self.indptr)
+
+    @property
+    def company_codes(self) -> np.ndarray:
+        """The position of each row's company, as int32."""
+        codes = np.arange(self.n_companies, dtype=np.int32)
+        return np.repeat(codes, self.counts)
+
+    @property
+    def nbytes(self) -> int:
+        """The memory used by the arrays."""
+        arrays = self.company_ids, self.indptr, self.days, self.values
+        return sum(array.nbytes for array in arrays)
+
+    def memory_usage(self, deep: bool = True) -> int:
+        """
+        Get the memory used by the panel, like pandas objects.
+
+        :param deep: ignored, the panel only holds numpy arrays.
+        :return: the memory used, in bytes.
+        """
+        return self.nbytes
+
+    def company(self, position: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get the rows of a company, without copying them.
+
+        :param position: the position of the company in the company ids.
+        :return: the business day offsets and the values of the company.
+        """
+        rows = slice(self.indptr[position], self.indptr[position + 1])
+        return self.days[rows], self.values[rows]
+
+    def companies(self, start: int, stop: int) -> "CompanyPanel":
+        """
+        Get a range of companies, without copying their rows.
+
+        :param start: the position of the first company.
+        :param stop: the position after the last company.
+        :return: a panel sharing memory with this one.
+        """
+        rows = slice(self.indptr[start], self.indptr[stop])
+        indptr = self.indptr[start:][: stop - start + 1]
+        return CompanyPanel(
+            self.company_ids[start:stop],
+            indptr - self.indptr[start],
+            self.days[rows],
+            self.values[rows],
+        )
+
+    def index(self) -> pd.MultiIndex:
+        """
+        Build a company and date index for the rows.
+
+        Only the companies and dates with rows are in the index levels.
+
+        :return: the index.
+        """
+        counts = self.counts
+        company_ids = self.company_ids
+        if np.any(counts == 0):
+            company_ids = company_ids[counts > 0]
+            counts = counts[counts > 0]
+        company_codes = np.repeat(
+            np.arange(len(company_ids), dtype=np.int32), counts
+        )
+        dates = np.array([], dtype="datetime64[ns]")
+        date_codes = np.array([], dtype=np.int32)
+        if len(self):
+            first = self.days.min()
+            used = np.bincount(self.days - first) > 0
+            dates = from_bday_offsets(first + np.flatnonzero(used))
+            date_codes = (np.cumsum(used) - 1)[self.days - first]
+        return pd.MultiIndex(
+            levels=[pd.Index(company_ids), pd.DatetimeIndex(dates)],
+            codes=[company_codes, date_codes],
+            names=["companyid", "date"],
+            verify_integrity=False,
+        )
+
+    def to_series(self, name: str | None = "returns") -> pd.Series:
+        """
+        Convert the panel to a series.
+
+        :param name: the series name.
+        :return: the company data, with a companyid and date index.
+        """
+        return pd.Series(self.values, index=self.index(), name=name)
+
+    def to_table(self) -> pa.Table:
+        """
+        Convert the panel to an arrow table.
+
+        Company ids and dates are stored as int32 and date32, as in
+        :func:`etl_pipeline_example.dataset.company_returns_table`, while the
+        returns share the memory of the panel.
+
+        :return: the table, with companyid, date and returns columns.
+        """
+        company_ids = np.repeat(self.company_ids.astype(np.int32), self.counts)
+        days = from_bday_offsets(self.days, "D").view(np.int64)
+        days = days.astype(np.int32)
+        dates = pa.Array.from_buffers(
+            pa.date32(), len(days), [None, pa.py_buffer(days)]
+        )
+        return pa.table(
+            {"companyid": company_ids, "date": dates, "returns": self.values}
+        )
+
+    def __repr__(self) -> str:
+        """Show the size of the panel."""
+        return (
+            f"CompanyPanel({self.n_companies} companies, {len(self)} rows, "
+            f"{self.values.dtype})"
+        )
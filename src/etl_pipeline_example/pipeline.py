@@ -1,16 +1,100 @@
 import logging
+import shutil
 from enum import Enum
+from functools import partial
 from pathlib import Path
+from typing import Any, Collection, Dict, Iterator, List, Sequence, Tuple
 
+import numpy as np
 import pandas as pd
 import pyarrow as pa
-import pyarrow.dataset as ds
 from pandas.tseries.offsets import BaseOffset
 
-from etl_pipeline_example.log_utils import log_mem_usage
+from etl_pipeline_example.bdays import (
+    from_bday_offsets,
+    is_bday_freq,
+    to_bday_offsets,
+)
+from etl_pipeline_example.cache import (
+    CACHE_BYTES,
+    CACHE_DIR,
+    StageCache,
+    cache_key,
+    fingerprint,
+)
+from etl_pipeline_example.dataset import (
+    DatasetFormat,
+    company_summary,
+    dataset_paths,
+    detect_format,
+    read_company_panel,
+    read_company_returns,
+    read_market_returns,
+)
+from etl_pipeline_example.executor import (
+    BackgroundWriter,
+    map_ordered,
+    prefetch,
+)
+from etl_pipeline_example.log_utils import (
+    RunProfiler,
+    log_mem_usage,
+    max_rss_bytes,
+)
+from etl_pipeline_example.market import MARKET_FILE, MarketSeries
+from etl_pipeline_example.panel import CompanyPanel, level_codes
+from etl_pipeline_example.precision import (
+    PRECISION_FILE,
+    precision_report,
+    sample_companies,
+    to_value_dtype,
+    value_dtype,
+    write_precision_report,
+)
+from etl_pipeline_example.rolling import (
+    Statistic,
+    rolling_corr_dense,
+    rolling_stats_dense,
+    stat_column,
+)
+from etl_pipeline_example.sinks import OutputFormat, result_sink
+from etl_pipeline_example.stages import CHECKPOINT_DIR, Checkpoints, StageGraph
+from etl_pipeline_example.store import (
+    MANIFEST_FILE,
+    PARTITION_ROWS,
+    STATE_FILE,
+    PartitionInfo,
+    PartitionManifest,
+    StoreState,
+    load_manifest,
+    load_state,
+    plan_partitions,
+    read_partition,
+    read_partition_panel,
+    save_manifest,
+    save_state,
+    write_partitions,
+)
 
 log = logging.getLogger(__name__)
 
+REPORT_FILE = "run_report.json"
+"""Name of the run report written when profiling, in the store directory."""
+BATCH_ROW_BYTES = 160
+"""Estimated peak memory to load, resample and store a row of company data."""
+CORRELATE_ROW_BYTES = 200
+"""Estimated peak memory to calculate the statistics of a stored row."""
+RESAMPLED_ROW_BYTES = 8
+"""Estimated memory of a row of resampled company data, with float32 returns."""
+PREFETCH_DEPTH = 2
+"""Default number of partitions read ahead, and of results written behind."""
+CORRELATE_STAGE = "correlate"
+"""Name of the statistics of a partition in the stage cache."""
+STORE_PLAN_UNIT = "store-plan"
+"""Checkpoint of the partitions and batches planned for an out-of-core store."""
+STORE_BATCH_UNIT = "store-batch-"
+"""Prefix of the checkpoints of the batches of an out-of-core store."""
+
 
 class ResampleStrategy(Enum):
     """Strategy to adopt when resampling data."""
@@ -23,11 +107,124 @@ class ResampleStrategy(Enum):
     """Fill with linearly interpolated values."""
 
 
+class Engine(Enum):
+    """Implementation to use for the calculations in the pipeline."""
+
+    PANDAS = "pandas"
+    """Use pandas groupby and rolling window operations."""
+    DENSE = "dense"
+    """Use vectorized numpy operations on dense (dates x companies) data."""
+
+
+def _interpolate_by_company(
+    values: np.ndarray, company_codes: np.ndarray
+) -> np.ndarray:
+    """
+    Linearly interpolate missing values, without crossing company boundaries.
+
+    Like pandas, missing values after the last valid one are filled with it,
+    and missing values before the first valid one are left as they are.
+    """
+    missing = np.isnan(values)
+    if not missing.any():
+        return values
+    n = len(values)
+    pos = np.arange(n, dtype=np.int32 if n < 2**31 else np.int64)
+    prev = np.maximum.accumulate(np.where(missing, -1, pos))
+    nxt = np.minimum.accumulate(np.where(missing, n, pos)[::-1])[::-1]
+    # only keep the neighbours of the missing rows
+    rows = pos[missing]
+    del pos
+    p, q = prev[rows], nxt[rows]
+    del prev, nxt
+    codes = company_codes[rows]
+    has_prev = (p >= 0) & (company_codes[p.clip(0)] == codes)
+    has_next = (q < n) & (company_codes[q.clip(max=n - 1)] == codes)
+    res = values.copy()
+    fwd = has_prev & ~has_next
+    res[rows[fwd]] = values[p[fwd]]
+    interp = has_prev & has_next
+    rows, p, q = rows[interp], p[interp], q[interp]
+    # same as np.interp, in float64
+    fp, fq = values[p].astype(np.float64), values[q].astype(np.float64)
+    res[rows] = (fq - fp) / (q - p) * (rows - p) + fp
+    return res
+
+
+def _resample_panel(
+    panel: CompanyPanel, strategy: ResampleStrategy
+) -> CompanyPanel:
+    """
+    Resample a company panel to business days.
+
+    Each company's rows are scattered into the span of business days from
+    its first to its last date, at their integer offset in that span, and
+    missing values are filled one company at a time.
+    """
+    if not isinstance(strategy, ResampleStrategy):
+        raise NotImplementedError(f"Not implemented: {strategy}")
+    days, values = panel.days, panel.values
+    dtype = value_dtype(values.dtype)
+
+    # sum the observations falling in the same business day
+    valid = ~np.isnan(values)
+    sums = np.where(valid, values, 0).astype(dtype)
+    indptr = panel.indptr
+    new_cell = np.r_[True, np.diff(days) != 0]
+    new_cell[indptr[:-1][indptr[:-1] < len(days)]] = True
+    if not new_cell.all():
+        starts = np.flatnonzero(new_cell)
+        indptr = np.searchsorted(starts, indptr)
+        days = days[starts]
+        sums = np.add.reduceat(sums, starts)
+        valid = np.logical_or.reduceat(valid, starts)
+    if strategy != ResampleStrategy.ZERO_FILL:
+        sums[~valid] = np.nan
+
+    # find the span of business days of each company
+    counts = np.diff(indptr)
+    present = counts > 0
+    first = np.zeros(panel.n_companies, dtype=np.int64)
+    last = np.full(panel.n_companies, -1, dtype=np.int64)
+    first[present] = days[indptr[:-1][present]]
+    last[present] = days[indptr[1:][present] - 1]
+    spans = last - first + 1
+    res_indptr = np.zeros(panel.n_companies + 1, dtype=np.int64)
+    np.cumsum(spans, out=res_indptr[1:])
+
+    # scatter each day at the same offset from the company's first day
+    fill = 0 if strategy == ResampleStrategy.ZERO_FILL else np.nan
+    res = np.full(res_indptr[-1], fill, dtype=dtype)
+    cells = np.repeat(res_indptr[:-1] - first, counts)
+    cells += days
+    res[cells] = sums
+    del cells, sums, valid
+    res_days = np.repeat((first - res_indptr[:-1]).astype(np.int32), spans)
+    res_days += np.arange(len(res_days), dtype=np.int32)
+    if strategy == ResampleStrategy.INTERPOLATE_LINEAR:
+        res_codes = np.arange(panel.n_companies, dtype=np.int32)
+        res = _interpolate_by_company(res, np.repeat(res_codes, spans))
+    return CompanyPanel(panel.company_ids, res_indptr, res_days, res)
+
+
+def _resample_bdays_dense(
+    company_data: pd.Series, strategy: ResampleStrategy
+) -> pd.Series:
+    """Resample a company data series to business days, as a panel."""
+    if len(company_data) == 0:
+        return resample_company_returns(
+            company_data, "B", strategy, Engine.PANDAS
+        )
+    panel = _resample_panel(CompanyPanel.from_series(company_data), strategy)
+    return panel.to_series(company_data.name)
+
+
 def resample_company_returns(
-    company_data: pd.Series,
+    company_data: pd.Series | CompanyPanel,
     target_freq: str | BaseOffset = "B",
     strategy: ResampleStrategy = ResampleStrategy.ZERO_FILL,
-) -> pd.Series:
+    engine: Engine = Engine.PANDAS,
+) -> pd.Series | CompanyPanel:
     """
     Resample an input company data series.
 
@@ -35,12 +232,27 @@ def resample_company_returns(
     input period. This assumes the input company data series has a multi index
     containing companyid and date.
 
+    The dense engine resamples to business days on a shared integer grid,
+    filling missing values one company at a time: unlike pandas, linear
+    interpolation never uses values from another company. It falls back to
+    pandas for other frequencies.
+
+    A company panel is resampled to a panel by the dense engine, and to a
+    series otherwise.
+
     :param company_data:the company data
     :param target_freq: the target frequency to resample to.
     :param strategy: the resample strategy, e.g. fill with zeroes where returns
         are missing.
+    :param engine: the implementation to use.
     :return: the resampled returns.
     """
+    if engine == Engine.DENSE and is_bday_freq(target_freq):
+        if isinstance(company_data, CompanyPanel):
+            return _resample_panel(company_data, strategy)
+        return _resample_bdays_dense(company_data, strategy)
+    if isinstance(company_data, CompanyPanel):
+        company_data = company_data.to_series()
     groups = company_data.groupby(level="companyid")
     resampled = groups.resample(rule=target_freq, level="date")
     if strategy == ResampleStrategy.ZERO_FILL:
@@ -54,17 +266,39 @@ def resample_company_returns(
 
 
 def rolling_corr(
-    company_data: pd.Series | pd.DataFrame, market_data: pd.Series, window: int
+    company_data: pd.Series | pd.DataFrame,
+    market_data: pd.Series,
+    window: int,
+    engine: Engine = Engine.PANDAS,
+    min_periods: int | None = None,
 ) -> pd.Series:
     """
     Calculate rolling correlation between company and market data.
 
+    The dense engine falls back to pandas if the company data is not on a
+    regular date grid, see
+    :func:`etl_pipeline_example.rolling.rolling_corr_dense`.
+
     :param company_data: the company data
     :param market_data: the market data
     :param window: the window to use
+    :param engine: the implementation to use.
+    :param min_periods: the minimum number of valid rows in a window to
+        produce a value, defaults to the window size.
     :return: the correlation
     """
-    res = company_data.groupby("companyid").rolling(window).corr(market_data)
+    if engine == Engine.DENSE:
+        try:
+            return rolling_corr_dense(
+                company_data, market_data, window, min_periods
+            )
+        except ValueError as e:
+            log.debug("Falling back to pandas rolling correlation: %s", e)
+    res = (
+        company_data.groupby("companyid")
+        .rolling(window, min_periods=min_periods)
+        .corr(market_data)
+    )
 
     # FIXME figure out why there's a duplicate companyid index column and remove
     #  this hack
@@ -73,87 +307,1315 @@ def rolling_corr(
     return res
 
 
-def run_pipeline(data_dir: Path):
-    """Execute the data pipeline."""
-    # Load the company_returns data
-    log.info("Starting pipeline...")
-    company_data = pd.read_pickle(data_dir / "company_returns.pkl")
+def _rolling_stats_pandas(
+    company_data: pd.Series,
+    market_data: pd.Series | MarketSeries,
+    windows: Sequence[int],
+    statistics: Sequence[Statistic],
+    min_periods: int | None,
+) -> pd.DataFrame:
+    """Calculate rolling statistics one company at a time with pandas."""
+    dates = company_data.index.get_level_values("date")
+    pairs = pd.DataFrame(
+        {
+            "x": company_data.to_numpy(),
+            "y": np.asarray(market_data.reindex(dates)),
+        },
+        index=company_data.index,
+    )
+    # only use the rows where both company and market returns are present
+    pairs[pairs.isna().any(axis=1)] = np.nan
+
+    def company_stats(group: pd.DataFrame) -> pd.DataFrame:
+        x, y = group["x"], group["y"]
+        res = {}
+        for statistic in statistics:
+            for window in windows:
+                x_win = x.rolling(window, min_periods=min_periods)
+                if statistic == Statistic.CORR:
+                    stat = x_win.corr(y)
+                elif statistic == Statistic.BETA:
+                    y_win = y.rolling(window, min_periods=min_periods)
+                    stat = x_win.cov(y) / y_win.var()
+                elif statistic == Statistic.COV:
+                    stat = x_win.cov(y)
+                elif statistic == Statistic.VOL:
+                    stat = x_win.std()
+                else:
+                    raise NotImplementedError(f"Not implemented: {statistic}")
+                # pandas divides by rounding errors in some constant windows
+                res[stat_column(statistic, window)] = stat.where(
+                    np.isfinite(stat)
+                )
+        return pd.DataFrame(res, index=group.index)
+
+    return pairs.groupby(level="companyid", group_keys=False).apply(
+        company_stats
+    )
+
+
+def rolling_stats(
+    company_data: pd.Series | CompanyPanel,
+    market_data: pd.Series | MarketSeries,
+    windows: Sequence[int],
+    statistics: Sequence[Statistic] = (Statistic.CORR,),
+    engine: Engine = Engine.PANDAS,
+    min_periods: int | None = None,
+) -> pd.DataFrame:
+    """
+    Calculate rolling statistics between company and market data.
+
+    The dense engine calculates all the statistics and windows from shared
+    running moments, and falls back to pandas if the company data is not on
+    a regular date grid, see
+    :func:`etl_pipeline_example.rolling.rolling_stats_dense`.
+
+    :param company_data: the company data, as a series or a panel.
+    :param market_data: the market data, as a series or on the business day
+        grid.
+    :param windows: the window sizes.
+    :param statistics: the statistics to calculate.
+    :param engine: the implementation to use.
+    :param min_periods: the minimum number of valid rows in a window to
+        produce a value, defaults to the window size like pandas does.
+    :return: a column for each statistic and window, e.g. ``beta_262``.
+    """
+    if engine == Engine.DENSE:
+        try:
+            return rolling_stats_dense(
+                company_data, market_data, windows, statistics, min_periods
+            )
+        except ValueError as e:
+            log.debug("Falling back to pandas rolling statistics: %s", e)
+    if isinstance(company_data, CompanyPanel):
+        company_data = company_data.to_series()
+    return _rolling_stats_pandas(
+        company_data, market_data, windows, statistics, min_periods
+    )
+
+
+def _as_windows(window: int | Sequence[int]) -> List[int]:
+    """Get a list of distinct window sizes, in the order given."""
+    windows = [window] if isinstance(window, int) else window
+    return list(dict.fromkeys(windows))
+
+
+def _between(
+    data: pd.DataFrame,
+    start: pd.Timestamp | str | None,
+    end: pd.Timestamp | str | None,
+) -> pd.DataFrame:
+    """Keep the rows in an inclusive date range."""
+    dates = data.index.get_level_values("date")
+    mask = np.ones(len(data), dtype=bool)
+    if start is not None:
+        mask &= dates >= pd.Timestamp(start)
+    if end is not None:
+        mask &= dates <= pd.Timestamp(end)
+    return data if mask.all() else data[mask]
+
+
+def _result_frame(stats: pd.DataFrame) -> pd.DataFrame:
+    """
+    Drop the rows without any statistic and downcast the rest.
+
+    A lone correlation keeps its original ``returns`` column name.
+    """
+    stats = to_value_dtype(stats.dropna(how="all"))
+    if len(stats.columns) == 1 and stats.columns[0].startswith(
+        f"{Statistic.CORR.value}_"
+    ):
+        stats.columns = ["returns"]
+    return stats
+
+
+def _result_columns(
+    statistics: Sequence[Statistic], windows: Sequence[int]
+) -> List[str]:
+    """Get the names of the result columns, see :func:`_result_frame`."""
+    if list(statistics) == [Statistic.CORR] and len(windows) == 1:
+        return ["returns"]
+    return [
+        stat_column(stat, window) for stat in statistics for window in windows
+    ]
+
+
+def correlate_partition(
+    partition_path: Path,
+    market_data: pd.Series | MarketSeries,
+    window: int | Sequence[int],
+    engine: Engine = Engine.DENSE,
+    statistics: Sequence[Statistic] = (Statistic.CORR,),
+    companies: Collection[int] | None = None,
+    start: pd.Timestamp | str | None = None,
+    end: pd.Timestamp | str | None = None,
+    min_periods: int | None = None,
+) -> pd.DataFrame:
+    """
+    Calculate rolling statistics for a partition of stored company data.
+
+    Only the companies and dates needed are read from the partition: when
+    results start at a date, the rows in the longest window before it are
+    read too.
+
+    :param partition_path: the path to the parquet partition.
+    :param market_data: the market data.
+    :param window: the window size, or several window sizes.
+    :param engine: the implementation to use.
+    :param statistics: the statistics to calculate for each window.
+    :param companies: the company ids to calculate, or None for all.
+    :param start: the first date of the results, inclusive.
+    :param end: the last date of the results, inclusive.
+    :param min_periods: the minimum number of valid rows in a window to
+        produce a value, defaults to the window size.
+    :return: the rows with at least one statistic, downcasted to save memory.
+    """
+    windows = _as_windows(window)
+    company_part = _read_history(
+        partition_path, windows, engine, companies, start, end
+    )
+    return _partition_stats(
+        company_part,
+        market_data,
+        windows,
+        statistics,
+        engine,
+        start,
+        end,
+        min_periods,
+    )
+
+
+def _read_history(
+    partition_path: Path,
+    windows: List[int],
+    engine: Engine,
+    companies: Collection[int] | None,
+    start: pd.Timestamp | str | None,
+    end: pd.Timestamp | str | None,
+) -> pd.Series | CompanyPanel:
+    """
+    Read the rows of a partition needed for results from start to end.
+
+    The dense engine reads them as a panel, without a company and date index.
+    """
+    read_start = None
+    if start is not None:
+        read_start = pd.Timestamp(start) - pd.offsets.BDay(max(windows) - 1)
+    read = read_partition_panel if engine == Engine.DENSE else read_partition
+    return read(partition_path, companies, read_start, end)
+
+
+def _partition_stats(
+    company_part: pd.Series | CompanyPanel,
+    market_data: pd.Series | MarketSeries,
+    windows: List[int],
+    statistics: Sequence[Statistic],
+    engine: Engine,
+    start: pd.Timestamp | str | None,
+    end: pd.Timestamp | str | None,
+    min_periods: int | None,
+) -> pd.DataFrame:
+    """Calculate the statistics of the rows read from a partition."""
+    stats = rolling_stats(
+        company_part, market_data, windows, statistics, engine, min_periods
+    )
+    return _result_frame(_between(stats, start, end))
+
+
+_worker_market_data: pd.Series | MarketSeries | None = None
+"""The market data in a correlation worker process."""
+
+
+def _init_correlation_worker(market_data: pd.Series | MarketSeries) -> None:
+    """
+    Receive the market data once per worker, instead of once per task.
+
+    A memory-mapped market series is received as its path, and mapped again
+    by each worker.
+    """
+    global _worker_market_data
+    _worker_market_data = market_data
+
+
+def _correlate_partition_task(
+    partition_path: Path, **kwargs: Any
+) -> Tuple[np.ndarray, np.ndarray, List[str], List[np.ndarray]]:
+    """Calculate statistics in a worker, and return them as plain arrays."""
+    stats = correlate_partition(partition_path, _worker_market_data, **kwargs)
+    return (
+        stats.index.get_level_values("companyid").to_numpy(),
+        stats.index.get_level_values("date").to_numpy(),
+        list(stats.columns),
+        [stats[column].to_numpy() for column in stats.columns],
+    )
+
+
+def _from_task_result(
+    result: Tuple[np.ndarray, np.ndarray, List[str], List[np.ndarray]]
+) -> pd.DataFrame:
+    """Rebuild the statistics calculated in a worker."""
+    company_ids, dates, columns, values = result
+    index = pd.MultiIndex.from_arrays(
+        [company_ids, dates], names=["companyid", "date"]
+    )
+    return pd.DataFrame(dict(zip(columns, values)), index=index)
+
+
+def _correlate_partitions(
+    partition_paths: List[Path],
+    market_data: pd.Series | MarketSeries,
+    n_workers: int,
+    windows: List[int],
+    engine: Engine,
+    statistics: Sequence[Statistic],
+    companies: Collection[int] | None,
+    start: pd.Timestamp | None,
+    end: pd.Timestamp | None,
+    min_periods: int | None,
+    prefetch_depth: int,
+) -> Iterator[pd.DataFrame]:
+    """
+    Calculate statistics one partition at a time, in partition order.
+
+    In the current process, the next ``prefetch_depth`` partitions are read
+    on a background thread while the current one is calculated. Worker
+    processes read their own partitions, and overlap with each other.
+    """
+    n_partitions = len(partition_paths)
+    if n_workers == 1:
+        histories = prefetch(
+            (
+                _read_history(path, windows, engine, companies, start, end)
+                for path in partition_paths
+            ),
+            prefetch_depth,
+        )
+        for n_part, company_part in enumerate(histories):
+            log.debug(
+                "Calculating correlation part %i of %i", n_part, n_partitions
+            )
+            yield _partition_stats(
+                company_part,
+                market_data,
+                windows,
+                statistics,
+                engine,
+                start,
+                end,
+                min_periods,
+            )
+    else:
+        kwargs = dict(
+            window=windows,
+            engine=engine,
+            statistics=statistics,
+            companies=companies,
+            start=start,
+            end=end,
+            min_periods=min_periods,
+        )
+        log.debug(
+            "Calculating correlations for %i parts with %i workers",
+            n_partitions,
+            n_workers,
+        )
+        results = map_ordered(
+            partial(_correlate_partition_task, **kwargs),
+            partition_paths,
+            n_workers=n_workers,
+            initializer=_init_correlation_worker,
+            initargs=(market_data,),
+        )
+        yield from map(_from_task_result, results)
+
+
+def _cached_correlations(
+    keys: List[str], cache: StageCache, computed: Iterator[pd.DataFrame]
+) -> Iterator[pd.DataFrame]:
+    """
+    Get the statistics of each partition, from the cache if possible.
+
+    The computed statistics must be those of the partitions missing from the
+    cache, in partition order. They are added to the cache as they come.
+    """
+    for key in keys:
+        stats = cache.load(CORRELATE_STAGE, key)
+        if stats is None:
+            stats = next(computed)
+            cache.save(CORRELATE_STAGE, key, stats)
+        yield stats
+
+
+def _read_company_data(
+    data_dir: Path,
+    profiler: RunProfiler,
+    companies: Collection[int] | None = None,
+    start: pd.Timestamp | None = None,
+    end: pd.Timestamp | None = None,
+    as_panel: bool = False,
+) -> pd.Series | CompanyPanel:
+    """Load the company returns."""
+    read = read_company_panel if as_panel else read_company_returns
+    with profiler.stage("load"):
+        company_data = read(data_dir, companies=companies, start=start, end=end)
     log_mem_usage(log, company_data, "Original company data")
-    # downcast to reduce memory footprint
-    company_data = pd.to_numeric(company_data, downcast="float")
+    return company_data
+
+
+def _downcast_company_data(
+    profiler: RunProfiler, company_data: pd.Series | CompanyPanel
+) -> pd.Series | CompanyPanel:
+    """Downcast the company returns to save memory."""
+    with profiler.stage("downcast"):
+        if isinstance(company_data, CompanyPanel):
+            company_data.values = to_value_dtype(company_data.values)
+        else:
+            company_data = to_value_dtype(company_data)
     log_mem_usage(log, company_data, "Downcasted company data")
-    # resample so that it is of business day frequency
-    log.info("Resampling company data to business day...")
-    company_data_resampled = resample_company_returns(
-        company_data, "B", ResampleStrategy.INTERPOLATE_LINEAR
+    return company_data
+
+
+def _load_company_data(
+    data_dir: Path,
+    profiler: RunProfiler,
+    companies: Collection[int] | None = None,
+    start: pd.Timestamp | None = None,
+    end: pd.Timestamp | None = None,
+    as_panel: bool = False,
+) -> pd.Series | CompanyPanel:
+    """Load the company returns and downcast them to save memory."""
+    company_data = _read_company_data(
+        data_dir, profiler, companies, start, end, as_panel
     )
-    log_mem_usage(log, company_data_resampled, "BDay resampled company data")
+    return _downcast_company_data(profiler, company_data)
+
+
+def _load_market_data(data_dir: Path, profiler: RunProfiler) -> pd.Series:
+    """Load the market returns and downcast them to save memory."""
+    log.info("Loading market data...")
+    with profiler.stage("load_market"):
+        market_data = read_market_returns(data_dir)
+        log_mem_usage(log, market_data, "Original market data")
+        market_data = to_value_dtype(market_data)
+    log_mem_usage(log, market_data, "Downcasted market data")
+    return market_data
+
+
+def _map_market_data(data_dir: Path, profiler: RunProfiler) -> MarketSeries:
+    """
+    Load the market returns, and write them on the business day grid.
+
+    The market returns are written to :data:`MARKET_FILE` in the store, and
+    mapped back into memory, so that later runs and worker processes share
+    them without reading or copying them.
+    """
+    market_data = MarketSeries.from_series(
+        _load_market_data(data_dir, profiler)
+    )
+    path = data_dir / "store" / MARKET_FILE
+    path.parent.mkdir(exist_ok=True)
+    market_data.write(path)
+    return MarketSeries.open(path)
+
+
+def _last_dates(company_data: pd.Series | CompanyPanel) -> pd.Series:
+    """Get the last date of each company, in a series by company id."""
+    if isinstance(company_data, CompanyPanel):
+        present = company_data.counts > 0
+        last_days = company_data.days[company_data.indptr[1:][present] - 1]
+        return pd.Series(
+            from_bday_offsets(last_days),
+            index=company_data.company_ids[present],
+        )
+    dates = company_data.index.get_level_values("date")
+    company_ids = company_data.index.get_level_values("companyid")
+    return pd.Series(dates).groupby(company_ids.to_numpy()).max()
+
+
+def _store_company_data(
+    company_data: pd.Series | CompanyPanel,
+    company_dir: Path,
+    manifest: PartitionManifest,
+    state: StoreState,
+    profiler: RunProfiler,
+) -> None:
+    """Write resampled company data to its planned partitions."""
+    if isinstance(company_data, CompanyPanel):
+        partitions = np.repeat(
+            manifest.partition_of(company_data.company_ids),
+            company_data.counts,
+        )
+    else:
+        partitions = manifest.partition_of(
+            company_data.index.get_level_values("companyid")
+        )
+    with profiler.stage("store"):
+        write_partitions(company_data, company_dir, partitions)
+    manifest.record(company_data, partitions)
+    state.update(_last_dates(company_data))
+
+
+def _resample_company_data(
+    strategy: ResampleStrategy,
+    engine: Engine,
+    profiler: RunProfiler,
+    company_data: pd.Series | CompanyPanel,
+) -> pd.Series | CompanyPanel:
+    """Resample the company returns to business days."""
+    log.info("Resampling company data to business day...")
+    with profiler.stage("resample"):
+        resampled = resample_company_returns(
+            company_data, "B", strategy, engine
+        )
+    log_mem_usage(log, resampled, "BDay resampled company data")
+    return resampled
+
+
+def _build_store(
+    store_dir: Path,
+    params: Dict[str, Any],
+    store_key: str,
+    partition_rows: int,
+    partition_bytes: int | None,
+    profiler: RunProfiler,
+    company_data: pd.Series | CompanyPanel,
+) -> Tuple[StoreState, PartitionManifest]:
+    """Replace the company data store with all the resampled returns."""
     # Store this data in an efficient way. Describe the method and the file size
     # once stored.
     #   I'm storing the data in an arrow dataset made up of parquet partitions,
-    #   for now arbitrarily setting a number of partitions
+    #   each holding a contiguous range of company ids
     log.info("Storing company data...")
-    n_companies = len(company_data.index.levels[0])
-    n_partitions = max(1, n_companies // 16)
-    company_ids = company_data_resampled.index.get_level_values(0)
-    partition_values = company_ids % n_partitions
-    company_data_with_partitions = pd.DataFrame(company_data_resampled).assign(
-        partition=partition_values
+    if partition_bytes is not None:
+        row_bytes = company_data.memory_usage(deep=True) / max(
+            1, len(company_data)
+        )
+        partition_rows = max(1, int(partition_bytes / row_bytes))
+    if isinstance(company_data, CompanyPanel):
+        row_counts = pd.Series(
+            company_data.counts, index=company_data.company_ids
+        )
+    else:
+        company_codes, company_ids = level_codes(
+            company_data.index, "companyid"
+        )
+        row_counts = pd.Series(
+            np.bincount(company_codes, minlength=len(company_ids)),
+            index=company_ids,
+        )
+    manifest = PartitionManifest.from_plan(
+        plan_partitions(row_counts, partition_rows)
+    )
+    log.debug(
+        "Planned %i partitions of about %i rows",
+        len(manifest.partitions),
+        partition_rows,
     )
-    log_mem_usage(
-        log, company_data_with_partitions, "Company data with partition info"
+    state = StoreState(params=params, store_key=store_key)
+    store_dir.mkdir(exist_ok=True)
+    # the partitions of a previous run may not match the new ones
+    shutil.rmtree(store_dir / "company_data", ignore_errors=True)
+    _store_company_data(
+        company_data, store_dir / "company_data", manifest, state, profiler
     )
+    save_manifest(store_dir, manifest)
+    save_state(store_dir, state)
+    return state, manifest
+
+
+def _plan_store_batches(
+    data_dir: Path,
+    params: Dict[str, Any],
+    store_key: str,
+    partition_rows: int,
+    partition_bytes: int | None,
+    memory_limit: int,
+    profiler: RunProfiler,
+    companies: Collection[int] | None,
+) -> Dict[str, Any]:
+    """
+    Plan the partitions of the store, and the batches they are stored in.
+
+    The number of resampled rows of each company is known from its first and
+    last date, so partitions are planned from a summary of the input before
+    loading any returns. Batches hold whole partitions, as many as fit in the
+    memory left under the limit. The store is emptied, and the planned
+    manifest saved, so that batches can be stored by later runs.
+    """
     store_dir = data_dir / "store"
+    with profiler.stage("summary"):
+        summary = company_summary(data_dir, companies=companies)
+    offsets = to_bday_offsets(summary[["first_date", "last_date"]].to_numpy())
+    row_counts = pd.Series(offsets[:, 1] - offsets[:, 0] + 1, summary.index)
+    budget = memory_limit - max_rss_bytes()
+    if budget <= 0:
+        raise ValueError(
+            f"Memory limit of {memory_limit} bytes is below the memory "
+            f"already in use ({max_rss_bytes()} bytes)"
+        )
+    if partition_bytes is not None:
+        partition_rows = max(1, partition_bytes // RESAMPLED_ROW_BYTES)
+    # a partition is correlated at once, so it must fit in memory too
+    partition_rows = min(partition_rows, max(1, budget // CORRELATE_ROW_BYTES))
+    manifest = PartitionManifest.from_plan(
+        plan_partitions(row_counts, partition_rows)
+    )
+    partitions = manifest.partition_of(row_counts.index.to_numpy())
+    partition_counts = row_counts.groupby(partitions).sum()
+    batch_rows = max(1, budget // BATCH_ROW_BYTES)
+    batch_starts = plan_partitions(partition_counts, batch_rows)
+    log.info(
+        "Storing %i rows of company data in %i batches of %i partitions",
+        row_counts.sum(),
+        len(batch_starts),
+        len(manifest.partitions),
+    )
     store_dir.mkdir(exist_ok=True)
-    company_table = pa.Table.from_pandas(company_data_with_partitions)
-    ds.write_dataset(
-        company_table,
-        store_dir / "company_data",
-        format="parquet",
-        partitioning=["partition"],
-        existing_data_behavior="delete_matching",
+    shutil.rmtree(store_dir / "company_data", ignore_errors=True)
+    save_manifest(store_dir, manifest)
+    save_state(store_dir, StoreState(params=params, store_key=store_key))
+    return {
+        "batch_starts": batch_starts.tolist(),
+        "last_company": int(row_counts.index.max()),
+    }
+
+
+def _build_store_chunked(
+    data_dir: Path,
+    params: Dict[str, Any],
+    store_key: str,
+    engine: Engine,
+    strategy: ResampleStrategy,
+    partition_rows: int,
+    partition_bytes: int | None,
+    memory_limit: int,
+    profiler: RunProfiler,
+    companies: Collection[int] | None,
+    checkpoints: Checkpoints,
+) -> Tuple[StoreState, PartitionManifest]:
+    """
+    Load, resample and store the company data in batches of partitions.
+
+    The plan and each batch stored are checkpointed, with the manifest and the
+    state saved after each batch, so a run killed while storing resumes from
+    the first batch not stored.
+    """
+    store_dir = data_dir / "store"
+    company_dir = store_dir / "company_data"
+    plan = checkpoints.load(STORE_PLAN_UNIT, store_key)
+    if plan is None:
+        plan = _plan_store_batches(
+            data_dir,
+            params,
+            store_key,
+            partition_rows,
+            partition_bytes,
+            memory_limit,
+            profiler,
+            companies,
+        )
+        # batches of an earlier plan don't match this one
+        checkpoints.clear(STORE_BATCH_UNIT)
+        checkpoints.mark_done(STORE_PLAN_UNIT, store_key, plan)
+    state, manifest = load_state(store_dir), load_manifest(store_dir)
+    n_partitions = len(manifest.partitions)
+    starts = plan["batch_starts"]
+    for n_batch, (first, stop) in enumerate(
+        zip(starts, starts[1:] + [n_partitions])
+    ):
+        unit = f"{STORE_BATCH_UNIT}{n_batch}"
+        if checkpoints.is_done(unit, store_key):
+            log.debug("Company data batch %i is already stored", n_batch)
+            continue
+        log.debug("Loading company data batch %i", n_batch)
+        first_id = manifest.partitions[first].first_company
+        last_id = plan["last_company"]
+        if stop < n_partitions:
+            last_id = manifest.partitions[stop].first_company - 1
+        if companies is None:
+            # all the ids in the range, checked against row group statistics
+            batch_ids = range(first_id, last_id + 1)
+        else:
+            batch_ids = [c for c in companies if first_id <= c <= last_id]
+        company_data = _load_company_data(
+            data_dir, profiler, batch_ids, as_panel=engine == Engine.DENSE
+        )
+        with profiler.stage("resample"):
+            company_data = resample_company_returns(
+                company_data, "B", strategy, engine
+            )
+        # forget what a killed run may have recorded for the batch
+        for info in manifest.partitions[first:stop]:
+            manifest.partitions[info.partition] = PartitionInfo(
+                info.partition, info.first_company
+            )
+        _store_company_data(
+            company_data, company_dir, manifest, state, profiler
+        )
+        del company_data
+        save_manifest(store_dir, manifest)
+        save_state(store_dir, state)
+        checkpoints.mark_done(unit, store_key)
+        # arrow keeps freed memory for reuse, give it back to the next batch
+        pa.default_memory_pool().release_unused()
+    return state, manifest
+
+
+def _load_store(
+    store_dir: Path, params: Dict[str, Any]
+) -> Tuple[StoreState, PartitionManifest]:
+    """Load the state and manifest of a complete store, for new parameters."""
+    log.info("Company data store is up to date, skipping to correlation")
+    state, manifest = load_state(store_dir), load_manifest(store_dir)
+    state.params = params
+    return state, manifest
+
+
+def _run_incremental(
+    data_dir: Path,
+    state: StoreState,
+    manifest: PartitionManifest,
+    engine: Engine,
+    output_format: OutputFormat,
+    profiler: RunProfiler,
+) -> None:
+    """
+    Process only the company returns after the last date in the store.
+
+    History before each company's last stored date is assumed not to change.
+    New returns are resampled together with the last stored value of their
+    company, so that they are interpolated as in a full run, and appended to
+    the store. New correlations are calculated from the new returns and the
+    last ``window`` stored rows of their company. Companies missing from the
+    store are read with their whole history, and added to the partition of
+    their company id range in the manifest.
+    """
+    store_dir = data_dir / "store"
+    company_dir = store_dir / "company_data"
+    params = state.params
+    strategy = ResampleStrategy(params["strategy"])
+    windows = params["windows"]
+    statistics = [Statistic(stat) for stat in params["statistics"]]
+    watermarks = pd.Series(state.company_watermarks, dtype="datetime64[ns]")
+    # read only the returns after the earliest watermark
+    start = watermarks.min() + pd.offsets.BDay() if len(watermarks) else None
+    fmt = detect_format(data_dir)
+    if fmt == DatasetFormat.PICKLE:
+        # pickles are read whole anyway
+        start = None
+    company_data = _load_company_data(
+        data_dir, profiler, params["companies"], start=start
+    )
+    if start is not None:
+        # companies not in the store yet need their whole history
+        summary = company_summary(
+            data_dir, fmt, params["companies"], end=start - pd.Timedelta(1, "D")
+        )
+        new_ids = summary.index.difference(watermarks.index)
+        if len(new_ids):
+            history = _load_company_data(
+                data_dir,
+                profiler,
+                new_ids.tolist(),
+                end=start - pd.Timedelta(1, "D"),
+            )
+            company_data = pd.concat([history, company_data]).sort_index()
+    ids = company_data.index.get_level_values("companyid")
+    offsets = to_bday_offsets(company_data.index.get_level_values("date"))
+    last_dates = watermarks.reindex(ids).to_numpy()
+    # keep returns of new companies, and returns after the watermark
+    is_new = np.isnat(last_dates)
+    known = ~is_new
+    is_new[known] = offsets[known] > to_bday_offsets(last_dates[known])
+    company_data = company_data[is_new]
+    if company_data.empty:
+        log.info("No new company data after the store watermarks")
+        return
+    log.info(
+        "Processing %i new returns for %i companies",
+        len(company_data),
+        company_data.index.get_level_values("companyid").nunique(),
     )
+    market_data = _load_market_data(data_dir, profiler)
 
-    # Load the market_returns
-    log.info("Loading market data...")
-    market_data = pd.read_pickle(data_dir / "market_returns.pkl")
-    # make sure the series index has a name, or we'll get weird errors later on
-    if market_data.index.name is None:
-        market_data.index = market_data.index.rename("date")
-    log_mem_usage(log, market_data, "Original market data")
-    market_data = pd.to_numeric(market_data, downcast="float")
-    log_mem_usage(log, market_data, "Downcasted market data")
+    ids = company_data.index.get_level_values("companyid")
+    known = watermarks.index.intersection(ids.unique())
+    cutoff = None
+    if len(known):
+        # enough history to fill the rolling windows of the new rows
+        cutoff = watermarks[known].min() - pd.offsets.BDay(max(windows) - 1)
+    partitions = manifest.partition_of(ids)
+    new_watermarks = []
+    with result_sink(
+        store_dir, "result_corr", output_format, append=True
+    ) as sink:
+        for n_part in np.unique(partitions):
+            new_part = company_data[partitions == n_part]
+            part_ids = new_part.index.get_level_values("companyid").unique()
+            partition_path = company_dir / str(n_part)
+            stored = new_part.iloc[:0]
+            if partition_path.exists():
+                with profiler.stage("load_store"):
+                    stored = read_partition(partition_path, part_ids, cutoff)
+            # resample from the last stored value, to interpolate the gap
+            stored_ids = stored.index.get_level_values("companyid")
+            stored_last = stored.index.get_level_values("date") == (
+                watermarks.reindex(stored_ids).to_numpy()
+            )
+            with profiler.stage("resample"):
+                resampled = resample_company_returns(
+                    pd.concat([stored[stored_last], new_part]),
+                    "B",
+                    strategy,
+                    engine,
+                )
+                resampled = resampled.drop(stored[stored_last].index)
+            resampled_partitions = np.full(len(resampled), n_part)
+            with profiler.stage("store"):
+                write_partitions(
+                    resampled, company_dir, resampled_partitions, append=True
+                )
+            manifest.record(resampled, resampled_partitions)
+            new_watermarks.append(_last_dates(resampled))
+
+            with profiler.stage("correlate"):
+                history = pd.concat([stored, resampled]).sort_index()
+                stats = rolling_stats(
+                    history,
+                    market_data,
+                    windows,
+                    statistics,
+                    engine,
+                    params.get("min_periods"),
+                )
+                stats = _result_frame(
+                    _between(
+                        stats.loc[resampled.index],
+                        params["start"],
+                        params["end"],
+                    )
+                )
+            with profiler.stage("write"):
+                sink.write(stats)
+    log.info("Saved %i new correlations to %s", sink.n_rows, sink.path)
+    state.update(pd.concat(new_watermarks))
+    # the store no longer matches the inputs of a full run
+    state.store_key = None
+    Checkpoints(store_dir / CHECKPOINT_DIR).clear()
+    save_manifest(store_dir, manifest)
+    save_state(store_dir, state)
+
+
+def _read_precision_sample(
+    data_dir: Path, companies: Collection[int] | None
+) -> pd.Series:
+    """Read the returns of a sample of the companies, as they are stored."""
+    if companies is None and detect_format(data_dir) != DatasetFormat.PICKLE:
+        companies = company_summary(data_dir).index
+    if companies is not None:
+        sample = sample_companies(np.asarray(companies))
+        return read_company_returns(data_dir, companies=sample)
+    # pickles are read whole anyway
+    company_data = read_company_returns(data_dir)
+    ids = company_data.index.get_level_values("companyid")
+    return company_data[ids.isin(sample_companies(ids.unique().sort_values()))]
+
+
+def _validate_precision(
+    data_dir: Path,
+    params: Dict[str, Any],
+    engine: Engine,
+    profiler: RunProfiler,
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Compare the statistics of a sample of companies to a float64 reference.
+
+    The returns of up to :data:`etl_pipeline_example.precision.PRECISION_SAMPLE`
+    companies are read as stored, then resampled and correlated twice: once
+    from float32 returns as in the pipeline, once from the original returns
+    in float64. The largest deviations are logged, and written to
+    :data:`etl_pipeline_example.precision.PRECISION_FILE` in the store.
+    """
+    with profiler.stage("validate"):
+        company_data = _read_precision_sample(data_dir, params["companies"])
+        market_data = read_market_returns(data_dir)
+        strategy = ResampleStrategy(params["strategy"])
+        windows = params["windows"]
+        statistics = [Statistic(stat) for stat in params["statistics"]]
+
+        def calculate(company_data: pd.Series, market_data: pd.Series):
+            resampled = resample_company_returns(
+                company_data, "B", strategy, engine
+            )
+            stats = rolling_stats(
+                resampled,
+                market_data,
+                windows,
+                statistics,
+                engine,
+                params["min_periods"],
+            )
+            return _between(stats, params["start"], params["end"])
+
+        reference = calculate(
+            company_data.astype(np.float64), market_data.astype(np.float64)
+        )
+        actual = to_value_dtype(
+            calculate(to_value_dtype(company_data), to_value_dtype(market_data))
+        )
+        report = precision_report(actual, reference)
+    company_ids = company_data.index.get_level_values("companyid").unique()
+    write_precision_report(
+        data_dir / "store" / PRECISION_FILE, report, company_ids
+    )
+    for column, stats in report.items():
+        log.info(
+            "Largest %s deviation from float64 over %i values of %i "
+            "companies: %.3g",
+            column,
+            stats["n_values"],
+            len(company_ids),
+            stats["max_abs_error"],
+        )
+        if stats["n_missing"] or stats["n_infinite"]:
+            log.warning(
+                "%i %s values are missing and %i infinite in only one of the "
+                "statistics and their float64 reference",
+                stats["n_missing"],
+                column,
+                stats["n_infinite"],
+            )
+    return report
+
+
+def run_pipeline(
+    data_dir: Path,
+    engine: Engine = Engine.DENSE,
+    n_workers: int = 1,
+    output_format: OutputFormat = OutputFormat.CSV,
+    strategy: ResampleStrategy = ResampleStrategy.INTERPOLATE_LINEAR,
+    window: int | Sequence[int] = 262 * 2,
+    incremental: bool = False,
+    partition_rows: int = PARTITION_ROWS,
+    partition_bytes: int | None = None,
+    profile: bool = False,
+    trace_memory: bool = False,
+    statistics: Sequence[Statistic] = (Statistic.CORR,),
+    companies: Collection[int] | None = None,
+    start: pd.Timestamp | str | None = None,
+    end: pd.Timestamp | str | None = None,
+    memory_limit: int | None = None,
+    cache: bool = True,
+    cache_bytes: int = CACHE_BYTES,
+    report_path: Path | None = None,
+    prefetch_depth: int = PREFETCH_DEPTH,
+    min_periods: int | None = None,
+    validate_precision: bool = False,
+):
+    """Execute the data pipeline.
+
+    Correlations are written to the output file as soon as each partition is
+    done, so only one partition of results is held in memory.
+
+    Several rolling statistics over several windows can be calculated in a
+    single pass, and are written as separate columns named after the
+    statistic and the window, e.g. ``beta_262``. A single correlation is
+    written to a ``returns`` column, as in earlier versions.
 
-    # try to save some memory
-    del (
-        company_data,
-        company_data_resampled,
-        company_data_with_partitions,
-        company_ids,
-        company_table,
-        partition_values,
+    A run can be limited to some companies and dates: only the returns of the
+    companies are read and stored, and the store is read back from the
+    longest window before the start date to the end date. Filters are pushed
+    down to the parquet readers, which skip the row groups not needed.
+
+    In incremental mode, only the returns after the last date stored for
+    each company are processed, and the new correlations are appended to
+    the results. A full run is done if the store doesn't exist yet or was
+    built with different parameters.
+
+    Returns and statistics are float32 from the store onwards, and the
+    rolling window moments are accumulated in float64, see
+    :mod:`etl_pipeline_example.precision`. The precision validation
+    calculates the statistics of a sample of companies both ways, and
+    reports the largest deviations from the float64 reference.
+
+    The company data store is split into partitions of contiguous company id
+    ranges, of about ``partition_rows`` rows or ``partition_bytes`` bytes of
+    resampled returns each. The partitions are recorded in a manifest, which
+    schedules the correlation of each partition.
+
+    :param data_dir: the directory containing the input data.
+    :param engine: the implementation to use for resampling and correlation.
+    :param n_workers: the number of processes calculating correlations.
+    :param output_format: the file format of the results.
+    :param strategy: how to fill missing company returns when resampling.
+    :param window: the rolling window, or several rolling windows, in
+        business days.
+    :param incremental: whether to only process new dates.
+    :param partition_rows: the target number of rows in each partition.
+    :param partition_bytes: the target in-memory size of each partition,
+        takes precedence over ``partition_rows`` if given.
+    :param profile: whether to record the time and memory used by each stage,
+        in a json report next to the results.
+    :param trace_memory: whether to also trace python allocations when
+        profiling, which slows down the pipeline.
+    :param statistics: the rolling statistics to calculate for each window.
+    :param companies: the company ids to process, or None for all.
+    :param start: the first date of the results, or None for all.
+    :param end: the last date of the results, or None for all.
+    :param memory_limit: the peak memory to stay under, in bytes, or None
+        to load all the company data at once. Needs a columnar dataset.
+    :param cache: whether to reuse the store and the statistics of earlier
+        runs with the same inputs.
+    :param cache_bytes: the size limit of the statistics cache.
+    :param report_path: where to write the profiling report, defaults to
+        :data:`REPORT_FILE` in the store directory.
+    :param prefetch_depth: the number of partitions read ahead of the
+        calculations, and of results waiting to be written, 0 to read,
+        calculate and write one after the other.
+    :param min_periods: the minimum number of valid rows in a window to
+        produce a statistic, defaults to the window size like pandas does.
+    :param validate_precision: whether to compare the statistics of a sample
+        of companies to a float64 reference, in a
+        :data:`etl_pipeline_example.precision.PRECISION_FILE` report in the
+        store directory.
+    :raise ValueError: if the parameters are invalid, or if a memory limit
+        is given for a pickle dataset.
+    """
+    profiler = RunProfiler(enabled=profile, trace_memory=trace_memory)
+    try:
+        _run_pipeline(
+            data_dir,
+            engine,
+            n_workers,
+            output_format,
+            strategy,
+            window,
+            incremental,
+            partition_rows,
+            partition_bytes,
+            profiler,
+            statistics,
+            companies,
+            start,
+            end,
+            memory_limit,
+            cache,
+            cache_bytes,
+            prefetch_depth,
+            min_periods,
+            validate_precision,
+        )
+    finally:
+        profiler.write_report(report_path or data_dir / "store" / REPORT_FILE)
+
+
+def _run_pipeline(
+    data_dir: Path,
+    engine: Engine,
+    n_workers: int,
+    output_format: OutputFormat,
+    strategy: ResampleStrategy,
+    window: int | Sequence[int],
+    incremental: bool,
+    partition_rows: int,
+    partition_bytes: int | None,
+    profiler: RunProfiler,
+    statistics: Sequence[Statistic],
+    companies: Collection[int] | None,
+    start: pd.Timestamp | str | None,
+    end: pd.Timestamp | str | None,
+    memory_limit: int | None,
+    cache: bool,
+    cache_bytes: int,
+    prefetch_depth: int,
+    min_periods: int | None,
+    validate_precision: bool,
+) -> None:
+    """Execute the data pipeline, see :func:`run_pipeline`."""
+    store_dir = data_dir / "store"
+    company_dir = store_dir / "company_data"
+    windows = _as_windows(window)
+    if min_periods is not None and min_periods > min(windows):
+        raise ValueError(
+            f"min_periods {min_periods} must be <= the window {min(windows)}"
+        )
+    if memory_limit is not None and detect_format(data_dir) == (
+        DatasetFormat.PICKLE
+    ):
+        raise ValueError(
+            "Runs with a memory limit need a parquet or feather dataset, "
+            f"not a pickle: {data_dir}"
+        )
+    statistics = list(dict.fromkeys(statistics))
+    if companies is not None:
+        companies = sorted(int(c) for c in companies)
+    start = None if start is None else pd.Timestamp(start)
+    end = None if end is None else pd.Timestamp(end)
+    params = {
+        "strategy": strategy.value,
+        "windows": windows,
+        "statistics": [stat.value for stat in statistics],
+        "output_format": output_format.value,
+        "companies": companies,
+        "start": None if start is None else start.isoformat(),
+        "end": None if end is None else end.isoformat(),
+        "min_periods": min_periods,
+    }
+    if incremental:
+        state, manifest = load_state(store_dir), load_manifest(store_dir)
+        if (
+            state is not None
+            and manifest is not None
+            and all(state.params.get(k) == v for k, v in params.items())
+        ):
+            log.info("Starting incremental pipeline...")
+            _run_incremental(
+                data_dir, state, manifest, engine, output_format, profiler
+            )
+            if validate_precision:
+                _validate_precision(data_dir, params, engine, profiler)
+            return
+        log.info("No store built with the same parameters, running in full")
+
+    log.info("Starting pipeline...")
+    fmt = detect_format(data_dir)
+    company_path, market_path = (
+        (None, None) if fmt is None else dataset_paths(data_dir, fmt)
+    )
+    reuse = cache and fmt is not None
+    stage_cache = StageCache(store_dir / CACHE_DIR, cache_bytes, enabled=reuse)
+    checkpoints = Checkpoints(store_dir / CHECKPOINT_DIR, enabled=reuse)
+    if not (
+        company_dir.exists()
+        and store_dir.joinpath(STATE_FILE).exists()
+        and store_dir.joinpath(MANIFEST_FILE).exists()
+    ):
+        # the store was deleted since it was checkpointed
+        checkpoints.clear()
+    if not store_dir.joinpath(MARKET_FILE).exists():
+        checkpoints.clear("market")
+    # the store doesn't depend on the windows, statistics or result dates
+    store_key = cache_key(
+        fingerprint(company_path) if company_path else None,
+        strategy.value,
+        engine.value,
+        companies,
+        partition_rows,
+        partition_bytes,
     )
+    graph = StageGraph(checkpoints)
+    load_store = partial(_load_store, store_dir, params)
+    if memory_limit is None:
+        graph.add(
+            "load",
+            partial(
+                _read_company_data,
+                data_dir,
+                profiler,
+                companies,
+                as_panel=engine == Engine.DENSE,
+            ),
+        )
+        graph.add(
+            "downcast", partial(_downcast_company_data, profiler), ["load"]
+        )
+        graph.add(
+            "resample",
+            partial(_resample_company_data, strategy, engine, profiler),
+            ["downcast"],
+        )
+        graph.add(
+            "store",
+            partial(
+                _build_store,
+                store_dir,
+                params,
+                store_key,
+                partition_rows,
+                partition_bytes,
+                profiler,
+            ),
+            ["resample"],
+            key=store_key,
+            load=load_store,
+        )
+    else:
+        graph.add(
+            "store",
+            partial(
+                _build_store_chunked,
+                data_dir,
+                params,
+                store_key,
+                engine,
+                strategy,
+                partition_rows,
+                partition_bytes,
+                memory_limit,
+                profiler,
+                companies,
+                checkpoints,
+            ),
+            key=store_key,
+            load=load_store,
+        )
+    graph.add(
+        "market",
+        partial(_map_market_data, data_dir, profiler),
+        key=cache_key(fingerprint(market_path)) if market_path else None,
+        load=partial(MarketSeries.open, store_dir / MARKET_FILE),
+    )
+    graph.add(
+        "correlate",
+        partial(
+            _correlate_store,
+            store_dir,
+            store_key,
+            market_path,
+            stage_cache,
+            params,
+            engine,
+            n_workers,
+            prefetch_depth,
+            profiler,
+        ),
+        ["store", "market"],
+    )
+    graph.add(
+        "write",
+        partial(
+            _write_results,
+            store_dir,
+            output_format,
+            _result_columns(statistics, windows),
+            stage_cache,
+            prefetch_depth,
+            profiler,
+        ),
+        ["store", "correlate"],
+    )
+    if validate_precision:
+        graph.add(
+            "validate",
+            partial(_validate_precision, data_dir, params, engine, profiler),
+        )
+    graph.run()
+
+
+def _correlate_store(
+    store_dir: Path,
+    store_key: str,
+    market_path: Path | None,
+    stage_cache: StageCache,
+    params: Dict[str, Any],
+    engine: Engine,
+    n_workers: int,
+    prefetch_depth: int,
+    profiler: RunProfiler,
+    store: Tuple[StoreState, PartitionManifest],
+    market_data: pd.Series | MarketSeries,
+) -> Iterator[pd.DataFrame]:
+    """
+    Get the statistics of each store partition, as they are calculated.
 
+    Partitions are calculated lazily, as the statistics are consumed. Their
+    cache entries are the checkpoints of the correlation, so a run that is
+    killed only calculates the partitions not cached yet when it resumes.
+    """
+    _, manifest = store
+    windows = params["windows"]
+    statistics = [Statistic(stat) for stat in params["statistics"]]
+    companies, min_periods = params["companies"], params["min_periods"]
+    start = None if params["start"] is None else pd.Timestamp(params["start"])
+    end = None if params["end"] is None else pd.Timestamp(params["end"])
     # calculate for each company the correlation to the market on a rolling
     # 2 year basis. State any modelling assumptions made.
     #   Assumption: company returns for missing days are interpolated. Change
     #   the assumption by using a different ResampleStrategy above
     log.info("Calculating correlations...")
-    two_years = 262 * 2  # 2 years window in business days
-    correlations = []
-    for n_part in range(n_partitions):
-        partition_path = store_dir / f"company_data/{n_part}"
-        log.debug("Calculating correlation part %i of %i", n_part, n_partitions)
-        company_part = pd.read_parquet(partition_path, engine="pyarrow")
-        corr = rolling_corr(company_part, market_data, window=two_years)
-        # do as much magic as possible to save memory
-        corr = corr.dropna()
-        corr["returns"] = pd.to_numeric(corr["returns"], downcast="float")
-        correlations.append(corr)
-        del company_part
-    del market_data
-    log.debug("Loading and merging correlations")
-    corr_result = pd.concat(correlations)
-    log_mem_usage(log, corr_result, "Final correlations")
+    # partitions without enough dates cannot fill a single window
+    min_rows = min(windows) if min_periods is None else max(min_periods, 1)
+    scheduled = [
+        p
+        for p in manifest.select(companies, start, end)
+        if p.max_window() >= min_rows
+    ]
+    if len(scheduled) < len(manifest.partitions):
+        log.debug(
+            "Skipping %i partitions without the companies or dates requested, "
+            "or shorter than the window",
+            len(manifest.partitions) - len(scheduled),
+        )
+    market_fingerprint = fingerprint(market_path) if market_path else None
+    keys = [
+        cache_key(
+            store_key,
+            vars(p),
+            market_fingerprint,
+            windows,
+            params["statistics"],
+            engine.value,
+            companies,
+            params["start"],
+            params["end"],
+            min_periods,
+        )
+        for p in scheduled
+    ]
+    missing = [
+        p
+        for p, key in zip(scheduled, keys)
+        if not stage_cache.contains(CORRELATE_STAGE, key)
+    ]
+    partition_paths = [
+        store_dir / "company_data" / str(p.partition) for p in missing
+    ]
+    correlations = _correlate_partitions(
+        partition_paths,
+        market_data,
+        n_workers,
+        windows,
+        engine,
+        statistics,
+        companies,
+        start,
+        end,
+        min_periods,
+        prefetch_depth,
+    )
+    return profiler.iterate(
+        "correlate", _cached_correlations(keys, stage_cache, correlations)
+    )
+
+
+def _write_results(
+    store_dir: Path,
+    output_format: OutputFormat,
+    columns: List[str],
+    stage_cache: StageCache,
+    prefetch_depth: int,
+    profiler: RunProfiler,
+    store: Tuple[StoreState, PartitionManifest],
+    correlations: Iterator[pd.DataFrame],
+) -> int:
+    """Write the statistics as they come, then save the store state."""
     log.info("Saving correlations...")
-    corr_result.to_csv(store_dir / "result_corr.csv")
+    with result_sink(
+        store_dir, "result_corr", output_format, columns=columns
+    ) as sink, BackgroundWriter(sink.write, prefetch_depth) as writer:
+        for corr in correlations:
+            with profiler.stage("write"):
+                writer.submit(corr)
+    log.info("Saved %i correlations to %s", sink.n_rows, sink.path)
+    if stage_cache.hits:
+        log.info(
+            "Reused the statistics of %i of %i partitions from the cache",
+            stage_cache.hits,
+            stage_cache.hits + stage_cache.misses,
+        )
+    stage_cache.evict()
+    state, manifest = store
+    save_manifest(store_dir, manifest)
+    save_state(store_dir, state)
+    return sink.n_rows
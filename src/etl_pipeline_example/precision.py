@@ -0,0 +1,118 @@
+import json
+import logging
+from pathlib import Path
+from typing import Any, Dict
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+VALUE_DTYPE = np.dtype(np.float32)
+"""Dtype of the returns and statistics passed between pipeline stages."""
+MOMENT_DTYPE = np.dtype(np.float64)
+"""Dtype the rolling window moments are accumulated in."""
+PRECISION_FILE = "precision.json"
+"""Name of the precision report, in the store directory."""
+PRECISION_SAMPLE = 64
+"""Max number of companies compared to the float64 reference."""
+
+
+def value_dtype(dtype: Any) -> np.dtype:
+    """
+    Get the dtype to calculate values in, from the dtype of their inputs.
+
+    Values stay in :data:`VALUE_DTYPE`, unless their inputs are wider, as
+    when calculating a float64 reference from float64 inputs.
+
+    :param dtype: the dtype of the inputs.
+    :return: the dtype of the values.
+    """
+    return np.result_type(dtype, VALUE_DTYPE)
+
+
+def to_value_dtype(values: Any) -> Any:
+    """
+    Cast returns or statistics to :data:`VALUE_DTYPE`.
+
+    Values already in that dtype are not copied. Unlike
+    ``pd.to_numeric(values, downcast="float")``, the dtype doesn't depend on
+    the values: pandas keeps float64 values that are not close to their
+    float32 rounding, and checks all of them to find out.
+
+    :param values: an array, series or data frame of floats.
+    :return: the values, cast.
+    """
+    return values.astype(VALUE_DTYPE, copy=False)
+
+
+def sample_companies(
+    company_ids: np.ndarray, n_companies: int = PRECISION_SAMPLE
+) -> np.ndarray:
+    """
+    Pick companies evenly spaced in company id order.
+
+    :param company_ids: the sorted company ids to pick from.
+    :param n_companies: the max number of companies to pick.
+    :return: the company ids picked, sorted.
+    """
+    if len(company_ids) <= n_companies:
+        return np.asarray(company_ids)
+    positions = np.linspace(0, len(company_ids) - 1, n_companies)
+    return np.unique(np.asarray(company_ids)[positions.round().astype(int)])
+
+
+def precision_report(
+    actual: pd.DataFrame, reference: pd.DataFrame
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Measure how far statistics deviate from their float64 reference.
+
+    :param actual: the statistics, e.g. calculated in float32.
+    :param reference: the same statistics calculated in float64, with the
+        same columns and index.
+    :return: for each column, the number of finite values compared, the
+        largest absolute and relative deviations, the number of values missing
+        from only one of the statistics, and the number of values infinite in
+        only one of them, or with different signs.
+    """
+    report = {}
+    for column in reference.columns:
+        res = actual[column].to_numpy(np.float64)
+        ref = reference[column].to_numpy(np.float64)
+        both = np.isfinite(res) & np.isfinite(ref)
+        infinite = np.isinf(res) | np.isinf(ref)
+        deviation = np.abs(res[both] - ref[both])
+        scale = np.abs(ref[both])
+        nonzero = scale > 0
+        relative = deviation[nonzero] / scale[nonzero]
+        report[column] = {
+            "n_values": int(both.sum()),
+            "max_abs_error": float(deviation.max(initial=0.0)),
+            "max_rel_error": float(relative.max(initial=0.0)),
+            "n_missing": int((np.isnan(res) != np.isnan(ref)).sum()),
+            "n_infinite": int((infinite & (res != ref)).sum()),
+        }
+    return report
+
+
+def write_precision_report(
+    path: Path, report: Dict[str, Dict[str, Any]], company_ids: np.ndarray
+) -> None:
+    """
+    Write a precision report as json.
+
+    :param path: the report path.
+    :param report: the report, see :func:`precision_report`.
+    :param company_ids: the companies compared.
+    """
+    data = {
+        "value_dtype": VALUE_DTYPE.name,
+        "moment_dtype": MOMENT_DTYPE.name,
+        "companies": [int(c) for c in company_ids],
+        "statistics": report,
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(data, f, indent=1)
+    log.debug("Saved precision report to %s", path)
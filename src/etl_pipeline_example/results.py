@@ -0,0 +1,298 @@
+import logging
+import sys
+from pathlib import Path
+from typing import IO, Collection, Dict, Iterator, List
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc as ipc
+
+from etl_pipeline_example.dataset import is_sorted
+from etl_pipeline_example.sinks import ResultSink
+
+log = logging.getLogger(__name__)
+
+INDEX_FILE = "index.arrow"
+"""Name of the company index, in the directory of an indexed result store."""
+EXPORT_COMPANIES = 256
+"""Number of companies read at a time when exporting an indexed store."""
+_INDEX_SCHEMA = pa.schema(
+    [
+        ("companyid", pa.int64()),
+        ("segment", pa.int32()),
+        ("batch", pa.int32()),
+        ("offset", pa.int64()),
+        ("length", pa.int64()),
+        ("start_date", pa.timestamp("ns")),
+        ("end_date", pa.timestamp("ns")),
+    ]
+)
+"""The rows of a company in a record batch of a segment, and their dates."""
+
+
+def _segment_path(store_dir: Path, segment: int) -> Path:
+    """Get the path of a segment file of an indexed result store."""
+    return store_dir / f"segment-{segment}.arrow"
+
+
+def _read_index(store_dir: Path) -> pa.Table | None:
+    """Read the index of an indexed result store, if there is one."""
+    path = store_dir / INDEX_FILE
+    if not path.exists():
+        return None
+    with pa.memory_map(str(path)) as source:
+        return ipc.open_file(source).read_all()
+
+
+class IndexedResultSink(ResultSink):
+    """
+    Write results to an indexed store, to look them up by company and date.
+
+    The store is a directory of uncompressed arrow IPC segment files, one
+    for each sink, holding a record batch for each chunk of results sorted
+    by company id and date. The index file records the rows of each company
+    in each batch, with their first and last dates, and is only replaced
+    once the segment is complete. See :class:`ResultStore` to read it.
+
+    :param path: the store directory.
+    :param append: whether to add a segment to the existing results, which
+        must be for later dates, rather than replacing them.
+    """
+
+    def __init__(self, path: Path, append: bool = False):
+        super().__init__(path)
+        index = _read_index(path) if append else None
+        if index is None:
+            # the index goes first, so it never points to missing segments
+            path.joinpath(INDEX_FILE).unlink(missing_ok=True)
+            for old_path in path.glob("segment-*.arrow"):
+                old_path.unlink()
+            index = _INDEX_SCHEMA.empty_table()
+        self._index = index
+        segments = index["segment"].to_numpy()
+        self._segment = int(segments.max()) + 1 if len(segments) else 0
+        self._entries: List[pa.Table] = []
+        self._writer: ipc.RecordBatchFileWriter | None = None
+        self._schema: pa.Schema | None = None
+
+    def _write(self, data: pd.DataFrame) -> None:
+        if data.empty:
+            return
+        if not is_sorted(data.index):
+            data = data.sort_index()
+        table = pa.Table.from_pandas(data)
+        if self._writer is None:
+            self._schema = table.schema
+            self.path.mkdir(parents=True, exist_ok=True)
+            self._writer = ipc.new_file(
+                str(_segment_path(self.path, self._segment)), self._schema
+            )
+        elif not table.schema.equals(self._schema):
+            table = table.cast(self._schema)
+        n_batch = len(self._entries)
+        self._writer.write_batch(table.combine_chunks().to_batches()[0])
+
+        company_ids = data.index.get_level_values("companyid").to_numpy()
+        dates = data.index.get_level_values("date").to_numpy()
+        ids, offsets = np.unique(company_ids, return_index=True)
+        lengths = np.diff(offsets, append=len(company_ids))
+        self._entries.append(
+            pa.table(
+                [
+                    ids.astype(np.int64),
+                    np.full(len(ids), self._segment, dtype=np.int32),
+                    np.full(len(ids), n_batch, dtype=np.int32),
+                    offsets.astype(np.int64),
+                    lengths.astype(np.int64),
+                    dates[offsets],
+                    dates[offsets + lengths - 1],
+                ],
+                schema=_INDEX_SCHEMA,
+            )
+        )
+
+    def close(self) -> None:
+        """Finalize the segment, then add its rows to the index."""
+        if self._writer is not None:
+            self._writer.close()
+        index = pa.concat_tables([self._index, *self._entries]).sort_by(
+            [("companyid", "ascending"), ("start_date", "ascending")]
+        )
+        self.path.mkdir(parents=True, exist_ok=True)
+        path = self.path / INDEX_FILE
+        tmp_path = path.with_suffix(".tmp")
+        with pa.OSFile(str(tmp_path), "wb") as sink:
+            with ipc.new_file(sink, _INDEX_SCHEMA) as writer:
+                writer.write_table(index)
+        tmp_path.replace(path)
+        log.debug("Indexed segment %i of %s", self._segment, self.path)
+
+
+class ResultStore:
+    """
+    Look up the results of some companies and dates in an indexed store.
+
+    The index is read when the store is opened, and segments are memory
+    mapped on first use, so a lookup only reads the pages holding the rows
+    of the companies and dates requested: the rows of each company are found
+    in the index, then the rows of the dates in their date column. Stores
+    are written by :class:`IndexedResultSink`, with the ``indexed`` output
+    format of the pipeline.
+
+    :param path: the store directory, e.g. ``${workdir}/store/result_corr``.
+    :raise FileNotFoundError: if the directory holds no indexed results.
+    """
+
+    def __init__(self, path: Path):
+        index = _read_index(path)
+        if index is None:
+            raise FileNotFoundError(f"No indexed results in {path}")
+        self.path = path
+        self._index = {
+            name: index[name].to_numpy() for name in _INDEX_SCHEMA.names
+        }
+        self._readers: Dict[int, ipc.RecordBatchFileReader] = {}
+        self._sources: List[pa.MemoryMappedFile] = []
+
+    def _reader(self, segment: int) -> ipc.RecordBatchFileReader:
+        """Get the reader of a segment, mapping it the first time."""
+        if segment not in self._readers:
+            source = pa.memory_map(str(_segment_path(self.path, segment)))
+            self._sources.append(source)
+            self._readers[segment] = ipc.open_file(source)
+        return self._readers[segment]
+
+    @property
+    def company_ids(self) -> np.ndarray:
+        """The sorted ids of the companies with results."""
+        return np.unique(self._index["companyid"])
+
+    def __len__(self) -> int:
+        """Get the number of rows of results."""
+        return int(self._index["length"].sum())
+
+    def get_corr(
+        self,
+        company_ids: int | Collection[int],
+        start: pd.Timestamp | str | None = None,
+        end: pd.Timestamp | str | None = None,
+    ) -> pd.DataFrame:
+        """
+        Get the results of some companies and dates.
+
+        :param company_ids: the company ids.
+        :param start: the first date, inclusive.
+        :param end: the last date, inclusive.
+        :return: the results, with the columns of the pipeline output, and a
+            company and date index, sorted.
+        """
+        ids = np.asarray(company_ids, dtype=np.int64).ravel()
+        first = pd.Timestamp(start or pd.Timestamp.min).to_datetime64()
+        last = pd.Timestamp(end or pd.Timestamp.max).to_datetime64()
+        index = self._index
+        # entries are sorted by company, then date
+        entries = np.flatnonzero(
+            np.isin(index["companyid"], ids)
+            & (index["start_date"] <= last)
+            & (index["end_date"] >= first)
+        )
+        batches = []
+        for entry in entries:
+            batch = (
+                self._reader(int(index["segment"][entry]))
+                .get_batch(int(index["batch"][entry]))
+                .slice(index["offset"][entry], index["length"][entry])
+            )
+            if index["start_date"][entry] < first or (
+                index["end_date"][entry] > last
+            ):
+                dates = batch.column("date").to_numpy()
+                lo = np.searchsorted(dates, first, side="left")
+                hi = np.searchsorted(dates, last, side="right")
+                batch = batch.slice(lo, hi - lo)
+            batches.append(batch)
+        if not batches:
+            return self._schema().empty_table().to_pandas()
+        return pa.Table.from_batches(batches).to_pandas()
+
+    def _schema(self) -> pa.Schema:
+        """Get the schema of the results, from the first segment."""
+        segments = self._index["segment"]
+        if not len(segments):
+            return pa.schema([])
+        return self._reader(int(segments.min())).schema
+
+    def iterate(
+        self,
+        company_ids: Collection[int] | None = None,
+        start: pd.Timestamp | str | None = None,
+        end: pd.Timestamp | str | None = None,
+        n_companies: int = EXPORT_COMPANIES,
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Get the results of many companies, a few companies at a time.
+
+        :param company_ids: the company ids, or None for all the companies.
+        :param start: the first date, inclusive.
+        :param end: the last date, inclusive.
+        :param n_companies: the number of companies in each chunk.
+        :return: the results of each chunk of companies, in company order.
+        """
+        if company_ids is None:
+            ids = self.company_ids
+        else:
+            ids = np.unique(np.asarray(company_ids, dtype=np.int64))
+        for chunk in range(0, len(ids), n_companies):
+            results = self.get_corr(ids[chunk:][:n_companies], start, end)
+            if not results.empty:
+                yield results
+
+    def to_csv(
+        self,
+        path: Path | None = None,
+        company_ids: Collection[int] | None = None,
+        start: pd.Timestamp | str | None = None,
+        end: pd.Timestamp | str | None = None,
+    ) -> int:
+        """
+        Export results as csv, as the ``csv`` output format would write them.
+
+        :param path: the csv file, or None to write to the standard output.
+        :param company_ids: the company ids, or None for all the companies.
+        :param start: the first date, inclusive.
+        :param end: the last date, inclusive.
+        :return: the number of rows written.
+        """
+        n_rows = 0
+        f: IO[str] = sys.stdout if path is None else open(path, "w", newline="")
+        try:
+            for results in self.iterate(company_ids, start, end):
+                results.to_csv(f, header=n_rows == 0)
+                n_rows += len(results)
+        finally:
+            if path is not None:
+                f.close()
+        return n_rows
+
+    def close(self) -> None:
+        """Unmap the segments."""
+        self._readers.clear()
+        for source in self._sources:
+            source.close()
+        self._sources.clear()
+
+    def __enter__(self):
+        """Start reading results."""
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Unmap the segments."""
+        self.close()
+
+    def __repr__(self) -> str:
+        """Show the size of the store."""
+        return (
+            f"ResultStore({len(self)} rows of {len(self.company_ids)} "
+            f"companies in {self.path})"
+        )
@@ -0,0 +1,325 @@
+from enum import Enum
+from typing import Dict, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from etl_pipeline_example.bdays import from_bday_offsets
+from etl_pipeline_example.kernels import (
+    Kernel,
+    Moments,
+    block_rows,
+    window_comoments,
+)
+from etl_pipeline_example.market import MarketSeries
+from etl_pipeline_example.panel import CompanyPanel, level_codes
+from etl_pipeline_example.precision import value_dtype
+
+CORR_TOLERANCE = 1e-9
+"""Max absolute difference from the pandas rolling correlation, which is
+missing for the same windows."""
+BLOCK_CELLS = 2**20
+"""Number of (date, company) cells whose float64 window co-moments are held
+in memory at a time."""
+
+
+class Statistic(Enum):
+    """A rolling statistic of company returns against the market returns."""
+
+    CORR = "corr"
+    """Correlation to the market returns."""
+    BETA = "beta"
+    """Slope of the regression of company returns on market returns."""
+    COV = "cov"
+    """Covariance with the market returns."""
+    VOL = "vol"
+    """Standard deviation of the company returns."""
+
+
+def stat_column(statistic: Statistic, window: int) -> str:
+    """
+    Get the name of the result column of a rolling statistic.
+
+    :param statistic: the statistic.
+    :param window: the window size.
+    :return: the column name, e.g. ``corr_524``.
+    """
+    return f"{statistic.value}_{window}"
+
+
+def dense_pivot(
+    company_data: pd.Series | CompanyPanel,
+) -> Tuple[np.ndarray, pd.Index, pd.DatetimeIndex, np.ndarray, np.ndarray]:
+    """
+    Pivot company data into a dense (dates x companies) matrix.
+
+    Rows of the matrix cover the union of the dates in the input, or every
+    business day in their range for a panel, columns the sorted company ids.
+    Cells without a value are NaN. The matrix is float32, unless the input
+    data needs a wider type, see
+    :func:`etl_pipeline_example.precision.value_dtype`.
+
+    :param company_data: the company data, with a companyid and date index,
+        or as a panel.
+    :return: the matrix, the company ids, the dates, and for each input value
+        the column and row it was placed at.
+    """
+    if isinstance(company_data, CompanyPanel):
+        company_codes = company_data.company_codes
+        companies = pd.Index(company_data.company_ids, name="companyid")
+        first = company_data.days.min() if len(company_data) else 0
+        date_codes = company_data.days - first
+        n_dates = int(date_codes.max()) + 1 if len(company_data) else 0
+        dates = pd.DatetimeIndex(
+            from_bday_offsets(first + np.arange(n_dates)), name="date"
+        )
+        values = company_data.values
+    else:
+        company_codes, companies = level_codes(company_data.index, "companyid")
+        date_codes, dates = level_codes(company_data.index, "date")
+        values = company_data.to_numpy()
+    matrix = np.full(
+        (len(dates), len(companies)), np.nan, dtype=value_dtype(values.dtype)
+    )
+    matrix[date_codes, company_codes] = values
+    return matrix, companies, dates, company_codes, date_codes
+
+
+def _check_contiguous(
+    company_codes: np.ndarray, date_codes: np.ndarray, is_sorted: bool = False
+):
+    """Make sure the dates of each company are a contiguous run of rows."""
+    if not is_sorted:
+        order = np.lexsort((date_codes, company_codes))
+        company_codes, date_codes = company_codes[order], date_codes[order]
+    same_company = np.diff(company_codes) == 0
+    if not np.all(np.diff(date_codes)[same_company] == 1):
+        raise ValueError(
+            "Company dates are not contiguous on a shared date grid, resample "
+            "the company data before calculating rolling statistics"
+        )
+
+
+def _moment_stats(
+    moments: Dict[int, Moments],
+    windows: Sequence[int],
+    statistics: Sequence[Statistic],
+    min_periods: int | None,
+) -> Dict[Tuple[Statistic, int], np.ndarray]:
+    """Calculate rolling statistics from the window co-moments, in float64."""
+    res = {}
+    for window in windows:
+        n, cov, var_x, var_y = moments.pop(window)
+        # pandas divides by n - 1, so single rows have no statistics either
+        min_n = max(window if min_periods is None else min_periods, 2)
+        var_x, var_y = np.maximum(var_x, 0.0), np.maximum(var_y, 0.0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            for statistic in statistics:
+                # constant windows have no correlation or beta
+                if statistic == Statistic.CORR:
+                    stat = cov / np.sqrt(var_x * var_y)
+                    stat[(var_x == 0) | (var_y == 0)] = np.nan
+                elif statistic == Statistic.BETA:
+                    stat = cov / var_y
+                    stat[var_y == 0] = np.nan
+                elif statistic == Statistic.COV:
+                    stat = cov / (n - 1)
+                elif statistic == Statistic.VOL:
+                    stat = np.sqrt(var_x / (n - 1))
+                else:
+                    raise NotImplementedError(f"Not implemented: {statistic}")
+                # noisy moments near 0 can overflow, in float32 above all
+                stat[~np.isfinite(stat) | (n < min_n)] = np.nan
+                res[statistic, window] = stat
+    return res
+
+
+def rolling_stats_matrix(
+    company_matrix: np.ndarray,
+    market_values: np.ndarray,
+    windows: Sequence[int],
+    statistics: Sequence[Statistic],
+    min_periods: int | None = None,
+    kernel: Kernel = Kernel.AUTO,
+) -> Dict[Tuple[Statistic, int], np.ndarray]:
+    """
+    Calculate rolling statistics of every matrix column against the market.
+
+    Windows are made of the last ``window`` rows, and only rows where both
+    the company and the market values are present are taken into account.
+    The window co-moments are accumulated in float64, see
+    :func:`etl_pipeline_example.kernels.window_comoments`, and shared by all
+    the statistics, so each additional one only costs a few array operations.
+    Covariance and standard deviation have one degree of freedom, and windows
+    with fewer than ``min_periods`` valid rows are missing, like in pandas.
+
+    Statistics are calculated for blocks of about :data:`BLOCK_CELLS` cells
+    at a time, rows of a block of the kernel by as many companies as fit, so
+    only the float64 moments of one block are held in memory. Results
+    are float32, unless the inputs are wider, see
+    :func:`etl_pipeline_example.precision.value_dtype`.
+
+    :param company_matrix: a (dates x companies) matrix of returns.
+    :param market_values: the market returns for each matrix row.
+    :param windows: the window sizes in rows.
+    :param statistics: the statistics to calculate.
+    :param min_periods: the minimum number of valid rows in a window to
+        produce a value, defaults to the window size like pandas does.
+    :param kernel: the implementation of the window co-moments.
+    :return: a (dates x companies) matrix for each statistic and window.
+    """
+    if min_periods is not None and min_periods > min(windows):
+        raise ValueError(
+            f"min_periods {min_periods} must be <= the window {min(windows)}"
+        )
+    dtype = value_dtype(np.result_type(company_matrix, market_values))
+    res = {
+        (statistic, window): np.empty(company_matrix.shape, dtype=dtype)
+        for statistic in statistics
+        for window in windows
+    }
+    n_rows, n_companies = company_matrix.shape
+    n_block = block_rows(windows)
+    n_block_companies = max(1, BLOCK_CELLS // n_block)
+    for start in range(0, n_rows, n_block):
+        stop = min(start + n_block, n_rows)
+        for first in range(0, n_companies, n_block_companies):
+            companies = slice(first, first + n_block_companies)
+            moments = window_comoments(
+                company_matrix[:, companies],
+                market_values,
+                windows,
+                kernel,
+                start=start,
+                stop=stop,
+            )
+            block_stats = _moment_stats(
+                moments, windows, statistics, min_periods
+            )
+            for key, stat in block_stats.items():
+                res[key][start:stop, companies] = stat
+    return res
+
+
+def rolling_corr_matrix(
+    company_matrix: np.ndarray,
+    market_values: np.ndarray,
+    window: int,
+    min_periods: int | None = None,
+) -> np.ndarray:
+    """
+    Calculate the rolling correlation of every matrix column to the market.
+
+    See :func:`rolling_stats_matrix`.
+
+    :param company_matrix: a (dates x companies) matrix of returns.
+    :param market_values: the market returns for each matrix row.
+    :param window: the window size in rows.
+    :param min_periods: the minimum number of valid rows in a window to
+        produce a value, defaults to the window size like pandas does.
+    :return: a (dates x companies) matrix of correlations.
+    """
+    stats = rolling_stats_matrix(
+        company_matrix, market_values, [window], [Statistic.CORR], min_periods
+    )
+    return stats[Statistic.CORR, window]
+
+
+def rolling_corr_dense(
+    company_data: pd.Series | pd.DataFrame,
+    market_data: pd.Series | MarketSeries,
+    window: int,
+    min_periods: int | None = None,
+) -> pd.Series | pd.DataFrame:
+    """
+    Calculate rolling correlation between company and market data.
+
+    This is a vectorized equivalent of
+    :func:`etl_pipeline_example.pipeline.rolling_corr`: the company data is
+    pivoted into a dense (dates x companies) matrix and correlations are
+    calculated for all companies at once. Results of float64 returns match
+    the pandas ones within :data:`CORR_TOLERANCE`, float32 returns give
+    float32 correlations, rounded from those.
+
+    The company data must be on a regular date grid, i.e. the dates of each
+    company must be contiguous in the union of all the dates, as is the case
+    after resampling.
+
+    :param company_data: the company data, with a companyid and date index.
+    :param market_data: the market data, with a date index, or on the
+        business day grid.
+    :param window: the window to use
+    :param min_periods: the minimum number of valid rows in a window to
+        produce a value, defaults to the window size.
+    :return: the correlation, sorted by company id.
+    :raise ValueError: if the company data is not on a regular date grid.
+    """
+    if isinstance(company_data, pd.DataFrame):
+        return pd.DataFrame(
+            {
+                col: rolling_corr_dense(
+                    company_data[col], market_data, window, min_periods
+                )
+                for col in company_data.columns
+            }
+        )
+    matrix, _, dates, company_codes, date_codes = dense_pivot(company_data)
+    _check_contiguous(company_codes, date_codes)
+    market_values = np.asarray(market_data.reindex(dates))
+    corr = rolling_corr_matrix(matrix, market_values, window, min_periods)
+    res = pd.Series(
+        corr[date_codes, company_codes],
+        index=company_data.index,
+        name=company_data.name,
+    )
+    if np.any(np.diff(company_codes) < 0):
+        res = res.iloc[np.argsort(company_codes, kind="stable")]
+    return res
+
+
+def rolling_stats_dense(
+    company_data: pd.Series | CompanyPanel,
+    market_data: pd.Series | MarketSeries,
+    windows: Sequence[int],
+    statistics: Sequence[Statistic],
+    min_periods: int | None = None,
+) -> pd.DataFrame:
+    """
+    Calculate rolling statistics between company and market data.
+
+    All the statistics and windows are calculated in one pass over a dense
+    (dates x companies) matrix, see :func:`rolling_stats_matrix`. The company
+    data must be on a regular date grid, as for :func:`rolling_corr_dense`.
+
+    :param company_data: the company data, with a companyid and date index,
+        or as a panel.
+    :param market_data: the market data, with a date index, or on the
+        business day grid.
+    :param windows: the window sizes.
+    :param statistics: the statistics to calculate.
+    :param min_periods: the minimum number of valid rows in a window to
+        produce a value, defaults to the window size.
+    :return: a column for each statistic and window, named by
+        :func:`stat_column`, sorted by company id.
+    :raise ValueError: if the company data is not on a regular date grid.
+    """
+    is_panel = isinstance(company_data, CompanyPanel)
+    matrix, _, dates, company_codes, date_codes = dense_pivot(company_data)
+    _check_contiguous(company_codes, date_codes, is_sorted=is_panel)
+    market_values = np.asarray(market_data.reindex(dates))
+    stats = rolling_stats_matrix(
+        matrix, market_values, windows, statistics, min_periods
+    )
+    res = pd.DataFrame(
+        {
+            stat_column(statistic, window): stats[statistic, window][
+                date_codes, company_codes
+            ]
+            for statistic in statistics
+            for window in windows
+        },
+        index=company_data.index() if is_panel else company_data.index,
+    )
+    if np.any(np.diff(company_codes) < 0):
+        res = res.iloc[np.argsort(company_codes, kind="stable")]
+    return res
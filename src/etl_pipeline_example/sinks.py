@@ -0,0 +1,216 @@
+import logging
+from enum import Enum
+from pathlib import Path
+from typing import IO, Sequence
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from etl_pipeline_example.precision import VALUE_DTYPE
+
+log = logging.getLogger(__name__)
+
+
+class OutputFormat(Enum):
+    """File format of the pipeline results."""
+
+    CSV = "csv"
+    """Comma separated values, with a header row."""
+    PARQUET = "parquet"
+    """Parquet file, compressed with zstd."""
+    ARROW = "arrow"
+    """Arrow IPC file, compressed with zstd."""
+    INDEXED = "indexed"
+    """Uncompressed arrow IPC files with a company index, to look results up
+    by company and date, see :class:`etl_pipeline_example.results.ResultStore`.
+    """
+
+
+def empty_results(columns: Sequence[str]) -> pd.DataFrame:
+    """
+    Create results without any rows.
+
+    :param columns: the names of the result columns.
+    :return: the results, with float32 columns and a companyid and date index.
+    """
+    index = pd.MultiIndex.from_arrays(
+        [pd.Index([], dtype=np.int64), pd.DatetimeIndex([])],
+        names=["companyid", "date"],
+    )
+    return pd.DataFrame(
+        {column: pd.Series(dtype=VALUE_DTYPE) for column in columns},
+        index=index,
+    )
+
+
+class ResultSink:
+    """
+    Write results to a file one chunk at a time.
+
+    Sinks are context managers: the file is finalized when the context exits.
+    Only one chunk is held in memory at any point. Unless appending, the file
+    is always replaced, by one without rows if no results were written, so
+    results of earlier runs never look like the output of the current one.
+
+    :param path: the file path.
+    :param columns: the names of the result columns, for the file written
+        when there are no results.
+    """
+
+    def __init__(self, path: Path, columns: Sequence[str] = ()):
+        self.path = path
+        self.columns = list(columns)
+        self.n_rows = 0
+
+    def write(self, data: pd.DataFrame) -> None:
+        """Append a chunk of results to the file.
+
+        :param data: the results to append.
+        """
+        self._write(data)
+        self.n_rows += len(data)
+
+    def close(self) -> None:
+        """Finalize the file."""
+        raise NotImplementedError()
+
+    def _write(self, data: pd.DataFrame) -> None:
+        raise NotImplementedError()
+
+    def __enter__(self):
+        """Start writing results."""
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Finalize the file."""
+        self.close()
+
+
+class CsvResultSink(ResultSink):
+    """Write results as csv, exactly as ``DataFrame.to_csv`` would.
+
+    In append mode, results are added at the end of an existing file.
+    """
+
+    def __init__(
+        self, path: Path, columns: Sequence[str] = (), append: bool = False
+    ):
+        super().__init__(path, columns)
+        self._file: IO[str] | None = None
+        self._append = append and path.exists() and path.stat().st_size > 0
+
+    def _write(self, data: pd.DataFrame) -> None:
+        header = self._file is None and not self._append
+        if self._file is None:
+            mode = "a" if self._append else "w"
+            self._file = open(self.path, mode, newline="")
+        data.to_csv(self._file, header=header)
+
+    def close(self) -> None:
+        """Finalize the file, with only a header if there are no results."""
+        if self._file is None and not self._append:
+            self._write(empty_results(self.columns))
+        if self._file is not None:
+            self._file.close()
+
+
+class _ArrowResultSink(ResultSink):
+    """
+    Base class for sinks writing arrow tables.
+
+    In append mode, results are written to a new file, which is not created
+    if there are no results.
+    """
+
+    def __init__(
+        self, path: Path, columns: Sequence[str] = (), append: bool = False
+    ):
+        super().__init__(path, columns)
+        self._append = append
+        self._writer = None
+        self._schema: pa.Schema | None = None
+
+    def _open(self, schema: pa.Schema):
+        raise NotImplementedError()
+
+    def _write(self, data: pd.DataFrame) -> None:
+        table = pa.Table.from_pandas(data)
+        if self._writer is None:
+            self._schema = table.schema
+            self._writer = self._open(self._schema)
+        elif not table.schema.equals(self._schema):
+            table = table.cast(self._schema)
+        self._writer.write_table(table)
+
+    def close(self) -> None:
+        """Finalize the file, with only a schema if there are no results."""
+        if self._writer is None and not self._append:
+            self._write(empty_results(self.columns))
+        if self._writer is not None:
+            self._writer.close()
+
+
+class ParquetResultSink(_ArrowResultSink):
+    """Write results to a zstd compressed parquet file."""
+
+    def _open(self, schema: pa.Schema) -> pq.ParquetWriter:
+        return pq.ParquetWriter(self.path, schema, compression="zstd")
+
+
+class ArrowResultSink(_ArrowResultSink):
+    """Write results to a zstd compressed arrow IPC file."""
+
+    def _open(self, schema: pa.Schema) -> pa.ipc.RecordBatchFileWriter:
+        options = pa.ipc.IpcWriteOptions(compression="zstd")
+        return pa.ipc.new_file(self.path, schema, options=options)
+
+
+_SINKS = {
+    OutputFormat.PARQUET: ParquetResultSink,
+    OutputFormat.ARROW: ArrowResultSink,
+}
+
+
+def result_sink(
+    output_dir: Path,
+    name: str,
+    output_format: OutputFormat,
+    append: bool = False,
+    columns: Sequence[str] = (),
+) -> ResultSink:
+    """
+    Create a sink to stream results to.
+
+    When appending, csv results are added at the end of the existing file,
+    while parquet and arrow results are written to a new numbered file, e.g.
+    ``{name}.1.parquet``, since those formats can't be appended to. Indexed
+    results are written to the ``{name}`` directory, appending a segment.
+
+    :param output_dir: the directory to write into.
+    :param name: the file name, without extension.
+    :param output_format: the file format.
+    :param append: whether to keep the existing results.
+    :param columns: the names of the result columns, for the file written
+        when there are no results.
+    :return: a new result sink, to be used as a context manager.
+    """
+    ext = output_format.value
+    path = output_dir / f"{name}.{ext}"
+    if output_format == OutputFormat.CSV:
+        sink = CsvResultSink(path, columns, append)
+    elif output_format == OutputFormat.INDEXED:
+        # the results module imports the sinks
+        from etl_pipeline_example.results import IndexedResultSink
+
+        path = output_dir / name
+        sink = IndexedResultSink(path, append=append)
+    else:
+        n = 0
+        while append and path.exists():
+            n += 1
+            path = output_dir / f"{name}.{n}.{ext}"
+        sink = _SINKS[output_format](path, columns, append)
+    log.debug("Writing %s results to %s", ext, path)
+    return sink
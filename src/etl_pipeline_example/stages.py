@@ -0,0 +1,300 @@
+import json
+import logging
+import shutil
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Sequence, Set, Tuple
+
+log = logging.getLogger(__name__)
+
+CHECKPOINT_DIR = "checkpoints"
+"""Name of the checkpoint directory, in the store directory."""
+
+
+class Checkpoints:
+    """
+    Completion markers of pipeline stages and of their units of work.
+
+    A marker records the key of the inputs a unit completed with, see
+    :func:`etl_pipeline_example.cache.cache_key`, and optionally some json
+    serializable data, such as a plan the next units depend on. A unit is
+    only done if its marker has the key of its current inputs, so markers
+    never need to be invalidated when inputs change. Each marker is a file
+    written atomically once its unit is complete, so a killed run never
+    leaves a marker behind for unfinished work.
+
+    :param checkpoint_dir: the checkpoint directory.
+    :param enabled: whether to read and write markers.
+    """
+
+    def __init__(self, checkpoint_dir: Path, enabled: bool = True):
+        self.checkpoint_dir = checkpoint_dir
+        self.enabled = enabled
+
+    def path(self, unit: str) -> Path:
+        """
+        Get the path of the marker of a unit.
+
+        :param unit: the unit name, such as ``store-batch-3``.
+        :return: the path of the marker, which may not exist.
+        """
+        return self.checkpoint_dir / f"{unit}.json"
+
+    def _read(self, unit: str) -> Dict[str, Any] | None:
+        """Read the marker of a unit, if enabled and it exists."""
+        path = self.path(unit)
+        if not self.enabled or not path.exists():
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def is_done(self, unit: str, key: str) -> bool:
+        """
+        Check if a unit completed with some inputs.
+
+        :param unit: the unit name.
+        :param key: the key of the unit inputs.
+        :return: True if the unit has a marker with the same key.
+        """
+        marker = self._read(unit)
+        return marker is not None and marker["key"] == key
+
+    def load(self, unit: str, key: str) -> Any:
+        """
+        Get the data recorded when a unit completed.
+
+        :param unit: the unit name.
+        :param key: the key of the unit inputs.
+        :return: the data, or None if the unit is not done with this key.
+        """
+        marker = self._read(unit)
+        if marker is None or marker["key"] != key:
+            return None
+        return marker["data"]
+
+    def mark_done(self, unit: str, key: str, data: Any = None) -> None:
+        """
+        Record that a unit completed.
+
+        :param unit: the unit name.
+        :param key: the key of the unit inputs.
+        :param data: json serializable data to record with the marker.
+        """
+        if not self.enabled:
+            return
+        self.checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        path = self.path(unit)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"key": key, "data": data}, f)
+        tmp_path.replace(path)
+        log.debug("Checkpointed %s", unit)
+
+    def clear(self, prefix: str = "") -> None:
+        """
+        Remove markers, so that their units run again.
+
+        :param prefix: the prefix of the unit names to remove, all of them
+            by default.
+        """
+        if not prefix:
+            shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+        elif self.checkpoint_dir.exists():
+            for path in self.checkpoint_dir.glob(f"{prefix}*.json"):
+                path.unlink()
+
+    def __repr__(self) -> str:
+        """Show the checkpoint directory."""
+        return f"Checkpoints({self.checkpoint_dir})"
+
+
+@dataclass
+class Stage:
+    """A step of a pipeline, calculated from the outputs of other stages."""
+
+    name: str
+    """The stage name, unique in its graph."""
+    func: Callable[..., Any]
+    """Calculates the output, from the outputs of the inputs in order."""
+    inputs: Tuple[str, ...] = ()
+    """The names of the stages whose outputs are passed to the function."""
+    key: str | None = None
+    """The key of everything the output depends on, for checkpointed stages.
+    A stage with a key is skipped when it already completed with that key."""
+    load: Callable[[], Any] | None = None
+    """Gets the output of a completed stage back, e.g. from disk, when a stage
+    that runs needs it. Completed stages without it run again if needed."""
+
+
+class StageGraph:
+    """
+    Run pipeline stages in the order of their inputs, resuming earlier runs.
+
+    Stages are added after their inputs, so the graph is always acyclic and
+    the order they are added in is a valid execution order. Stages with a key
+    are checkpointed when they complete, and only run again when their key
+    changes: if a run fails or is killed, the next one starts from the last
+    stages completed. Stages that don't depend on each other can run at the
+    same time, on up to ``n_threads`` threads.
+
+    Outputs are dropped as soon as all the stages using them are done, so a
+    chain of stages only holds the data of consecutive stages in memory.
+    Outputs can be iterators, for stages that stream their data through the
+    following ones.
+
+    :param checkpoints: the completion markers of the stages, or None to run
+        everything.
+    :param n_threads: the number of stages that can run at the same time, 1
+        to run them one after the other in the current thread.
+    """
+
+    def __init__(
+        self, checkpoints: Checkpoints | None = None, n_threads: int = 1
+    ):
+        if n_threads < 1:
+            raise ValueError(f"Invalid number of threads: {n_threads}")
+        self.checkpoints = checkpoints
+        self.n_threads = n_threads
+        self.stages: Dict[str, Stage] = {}
+
+    def add(
+        self,
+        name: str,
+        func: Callable[..., Any],
+        inputs: Sequence[str] = (),
+        key: str | None = None,
+        load: Callable[[], Any] | None = None,
+    ) -> None:
+        """
+        Add a stage, after all its inputs.
+
+        :param name: the stage name.
+        :param func: calculates the output of the stage from the outputs of
+            its inputs, in order.
+        :param inputs: the names of the input stages.
+        :param key: the key of everything the output depends on, to
+            checkpoint the stage, or None to always run it.
+        :param load: gets the output of the stage back once it is done.
+        :raise ValueError: if the stage exists or an input doesn't.
+        """
+        if name in self.stages:
+            raise ValueError(f"Duplicate stage: {name}")
+        unknown = [i for i in inputs if i not in self.stages]
+        if unknown:
+            raise ValueError(f"Unknown inputs of stage {name}: {unknown}")
+        self.stages[name] = Stage(name, func, tuple(inputs), key, load)
+
+    def is_done(self, name: str) -> bool:
+        """
+        Check if a stage is checkpointed with its current key.
+
+        :param name: the stage name.
+        :return: True if the stage doesn't need to run again.
+        """
+        stage = self.stages[name]
+        return (
+            stage.key is not None
+            and self.checkpoints is not None
+            and self.checkpoints.is_done(name, stage.key)
+        )
+
+    def _targets(self, targets: Sequence[str] | None) -> Set[str]:
+        """Get the targets, defaulting to the stages no other stage uses."""
+        if targets is not None:
+            return set(targets)
+        used = {i for stage in self.stages.values() for i in stage.inputs}
+        return {name for name in self.stages if name not in used}
+
+    def plan(self, targets: Sequence[str] | None = None) -> Dict[str, bool]:
+        """
+        Get the stages needed to get the outputs of some stages.
+
+        Stages that are done are only loaded if a stage that runs, or the
+        caller, needs their output, and their own inputs are not needed.
+
+        :param targets: the stages to get the output of, defaults to the
+            stages no other stage uses.
+        :return: whether to run each stage needed, or to load its output,
+            in execution order.
+        """
+        needed = self._targets(targets)
+        plan = {}
+        for name in reversed(self.stages):
+            if name not in needed:
+                continue
+            stage = self.stages[name]
+            if self.is_done(name) and stage.load is not None:
+                plan[name] = False
+            else:
+                plan[name] = True
+                needed.update(stage.inputs)
+        return dict(reversed(plan.items()))
+
+    def _execute(self, name: str, run: bool, args: List[Any]) -> Any:
+        """Run a stage, or load its output if it is done."""
+        stage = self.stages[name]
+        if not run:
+            log.info("Stage %s is done, reusing its output", name)
+            return stage.load()
+        log.debug("Running stage %s", name)
+        output = stage.func(*args)
+        if stage.key is not None and self.checkpoints is not None:
+            self.checkpoints.mark_done(name, stage.key)
+        return output
+
+    def run(self, targets: Sequence[str] | None = None) -> Dict[str, Any]:
+        """
+        Run the stages needed to get the outputs of some stages.
+
+        :param targets: the stages to get the output of, defaults to the
+            stages no other stage uses.
+        :return: the output of each target.
+        """
+        plan = self.plan(targets)
+        targets = self._targets(targets)
+        uses = Counter(
+            i
+            for name, run in plan.items()
+            if run
+            for i in self.stages[name].inputs
+        )
+        outputs: Dict[str, Any] = {}
+
+        def complete(name: str, output: Any) -> None:
+            outputs[name] = output
+            if not plan[name]:
+                return
+            for i in self.stages[name].inputs:
+                uses[i] -= 1
+                if uses[i] == 0 and i not in targets:
+                    del outputs[i]
+
+        def args(name: str) -> List[Any]:
+            if not plan[name]:
+                return []
+            return [outputs[i] for i in self.stages[name].inputs]
+
+        if self.n_threads == 1:
+            for name, run in plan.items():
+                complete(name, self._execute(name, run, args(name)))
+            return {name: outputs[name] for name in targets if name in outputs}
+
+        todo = list(plan)
+        running: Dict[Future, str] = {}
+        with ThreadPoolExecutor(self.n_threads) as pool:
+            while todo or running:
+                for name in list(todo):
+                    inputs = self.stages[name].inputs if plan[name] else ()
+                    # outputs only hold the stages done, and still needed
+                    if all(i in outputs for i in inputs):
+                        todo.remove(name)
+                        future = pool.submit(
+                            self._execute, name, plan[name], args(name)
+                        )
+                        running[future] = name
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    complete(running.pop(future), future.result())
+        return {name: outputs[name] for name in targets if name in outputs}
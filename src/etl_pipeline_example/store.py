@@ -0,0 +1,458 @@
+import json
+import logging
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Collection, Dict, List
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from etl_pipeline_example.bdays import from_bday_offsets, to_bday_offsets
+from etl_pipeline_example.dataset import (
+    company_returns_series,
+    company_returns_table,
+    filter_expression,
+    is_sorted,
+)
+from etl_pipeline_example.panel import CompanyPanel
+
+log = logging.getLogger(__name__)
+
+STATE_FILE = "state.json"
+"""Name of the store state file, in the store directory."""
+MANIFEST_FILE = "manifest.json"
+"""Name of the partition manifest file, in the store directory."""
+PARTITION_ROWS = 2**21
+"""Default number of rows in each partition of the company data store."""
+STORE_ROW_GROUP_SIZE = 2**16
+"""Max number of rows in each row group of the company data store."""
+STORE_COMPRESSION = "zstd"
+"""Compression codec of the company data store."""
+
+
+@dataclass
+class StoreState:
+    """State of the company data store, used to process only new dates."""
+
+    params: Dict[str, Any]
+    """The pipeline parameters the store was built with."""
+    company_watermarks: Dict[int, pd.Timestamp] = field(default_factory=dict)
+    """The last date stored for each company."""
+    store_key: str | None = None
+    """The key of the inputs the store was built from, if known."""
+
+    def update(self, watermarks: pd.Series) -> None:
+        """
+        Record the last dates stored for some companies.
+
+        :param watermarks: the last date by company id.
+        """
+        self.company_watermarks.update(watermarks.items())
+
+
+def _write_json(path: Path, data: Dict[str, Any]) -> None:
+    """
+    Write a json file.
+
+    The data is written to a temporary file first, so that a crash never
+    leaves a partially written file behind.
+    """
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=1)
+    tmp_path.replace(path)
+
+
+def load_state(store_dir: Path) -> StoreState | None:
+    """
+    Load the state of a store.
+
+    :param store_dir: the store directory.
+    :return: the store state, or None if the store has no state.
+    """
+    path = store_dir / STATE_FILE
+    if not path.exists():
+        return None
+    with open(path) as f:
+        data = json.load(f)
+    return StoreState(
+        params=data["params"],
+        company_watermarks={
+            int(k): pd.Timestamp(v)
+            for k, v in data["company_watermarks"].items()
+        },
+        store_key=data.get("store_key"),
+    )
+
+
+def save_state(store_dir: Path, state: StoreState) -> None:
+    """
+    Save the state of a store.
+
+    :param store_dir: the store directory.
+    :param state: the store state.
+    """
+    data = {
+        "params": state.params,
+        "company_watermarks": {
+            str(k): v.isoformat() for k, v in state.company_watermarks.items()
+        },
+        "store_key": state.store_key,
+    }
+    path = store_dir / STATE_FILE
+    _write_json(path, data)
+    log.debug("Saved store state to %s", path)
+
+
+def plan_partitions(
+    row_counts: pd.Series, target_rows: int = PARTITION_ROWS
+) -> np.ndarray:
+    """
+    Split companies into partitions of contiguous company id ranges.
+
+    A company goes to the partition where its first row falls when rows are
+    laid out in company id order, so partitions hold about ``target_rows``
+    rows each. Companies are never split across partitions, so a partition
+    can be larger than the target by the rows of its last company.
+
+    :param row_counts: the number of rows by company id.
+    :param target_rows: the target number of rows in each partition.
+    :return: the first company id of each partition, sorted.
+    """
+    if target_rows < 1:
+        raise ValueError(f"Invalid partition size: {target_rows}")
+    row_counts = row_counts.sort_index()
+    counts = row_counts.to_numpy()
+    first_rows = np.cumsum(counts) - counts
+    bins = first_rows // target_rows
+    starts = np.diff(bins, prepend=-1) != 0
+    return row_counts.index.to_numpy()[starts]
+
+
+@dataclass
+class PartitionInfo:
+    """The company id range and the content of a store partition."""
+
+    partition: int
+    """The partition number, which is also its directory name."""
+    first_company: int
+    """The first company id in the range of the partition."""
+    last_company: int | None = None
+    """The last company id stored in the partition."""
+    n_rows: int = 0
+    """The number of rows stored in the partition."""
+    start_date: pd.Timestamp | None = None
+    """The first date stored in the partition."""
+    end_date: pd.Timestamp | None = None
+    """The last date stored in the partition."""
+
+    def max_window(self) -> int:
+        """
+        Get the largest rolling window any company in the partition can fill.
+
+        :return: the number of business days between the first and last date
+            stored, inclusive.
+        """
+        if self.n_rows == 0:
+            return 0
+        start, end = to_bday_offsets([self.start_date, self.end_date])
+        return int(end - start) + 1
+
+
+@dataclass
+class PartitionManifest:
+    """The partitions of the company data store, sorted by company id."""
+
+    partitions: List[PartitionInfo] = field(default_factory=list)
+    """The partitions, in company id order."""
+
+    @classmethod
+    def from_plan(cls, first_companies: np.ndarray) -> "PartitionManifest":
+        """
+        Create an empty manifest for planned partitions.
+
+        :param first_companies: the first company id of each partition,
+            as returned by :func:`plan_partitions`.
+        :return: the manifest.
+        """
+        return cls(
+            [
+                PartitionInfo(partition=n_part, first_company=int(first))
+                for n_part, first in enumerate(first_companies)
+            ]
+        )
+
+    def partition_of(self, company_ids: np.ndarray) -> np.ndarray:
+        """
+        Get the partition of some companies.
+
+        Companies after the last range, such as companies added after the
+        store was planned, belong to the last partition.
+
+        :param company_ids: the company ids.
+        :return: the partition number of each company.
+        """
+        firsts = [p.first_company for p in self.partitions]
+        positions = np.searchsorted(firsts, company_ids, side="right") - 1
+        return np.maximum(positions, 0)
+
+    def select(
+        self,
+        companies: Collection[int] | None = None,
+        start: pd.Timestamp | str | None = None,
+        end: pd.Timestamp | str | None = None,
+    ) -> List[PartitionInfo]:
+        """
+        Get the partitions that can hold some companies and dates.
+
+        :param companies: the company ids, or None for all the companies.
+        :param start: the first date, inclusive.
+        :param end: the last date, inclusive.
+        :return: the partitions, in company id order.
+        """
+        selected = [p for p in self.partitions if p.n_rows > 0]
+        if companies is not None:
+            ids = np.fromiter(companies, dtype=np.int64)
+            parts = set(self.partition_of(ids).tolist())
+            selected = [p for p in selected if p.partition in parts]
+        if start is not None:
+            start = pd.Timestamp(start)
+            selected = [p for p in selected if p.end_date >= start]
+        if end is not None:
+            end = pd.Timestamp(end)
+            selected = [p for p in selected if p.start_date <= end]
+        return selected
+
+    def record(
+        self, company_data: pd.Series | CompanyPanel, partitions: np.ndarray
+    ) -> None:
+        """
+        Record company data written to the store.
+
+        :param company_data: the company data written.
+        :param partitions: the partition of each row in the company data.
+        """
+        if isinstance(company_data, CompanyPanel):
+            company_ids = np.repeat(
+                company_data.company_ids, company_data.counts
+            )
+            # dates are only converted once per partition, after aggregating
+            dates = company_data.days
+        else:
+            company_ids = company_data.index.get_level_values("companyid")
+            dates = company_data.index.get_level_values("date")
+        stats = (
+            pd.DataFrame({"companyid": company_ids, "date": dates})
+            .groupby(np.asarray(partitions))
+            .agg(
+                last_company=("companyid", "max"),
+                n_rows=("date", "size"),
+                start_date=("date", "min"),
+                end_date=("date", "max"),
+            )
+        )
+        if isinstance(company_data, CompanyPanel):
+            for column in "start_date", "end_date":
+                days = stats[column].to_numpy()
+                stats[column] = pd.DatetimeIndex(from_bday_offsets(days))
+        for n_part, row in stats.iterrows():
+            info = self.partitions[n_part]
+            if info.n_rows == 0:
+                info.last_company = int(row["last_company"])
+                info.start_date = row["start_date"]
+                info.end_date = row["end_date"]
+            else:
+                info.last_company = max(
+                    info.last_company, int(row["last_company"])
+                )
+                info.start_date = min(info.start_date, row["start_date"])
+                info.end_date = max(info.end_date, row["end_date"])
+            info.n_rows += int(row["n_rows"])
+
+
+def load_manifest(store_dir: Path) -> PartitionManifest | None:
+    """
+    Load the partition manifest of a store.
+
+    :param store_dir: the store directory.
+    :return: the manifest, or None if the store has no manifest.
+    """
+    path = store_dir / MANIFEST_FILE
+    if not path.exists():
+        return None
+    with open(path) as f:
+        data = json.load(f)
+    partitions = []
+    for info in data["partitions"]:
+        for key in "start_date", "end_date":
+            if info[key] is not None:
+                info[key] = pd.Timestamp(info[key])
+        partitions.append(PartitionInfo(**info))
+    return PartitionManifest(partitions)
+
+
+def save_manifest(store_dir: Path, manifest: PartitionManifest) -> None:
+    """
+    Save the partition manifest of a store.
+
+    :param store_dir: the store directory.
+    :param manifest: the manifest.
+    """
+    partitions = []
+    for info in manifest.partitions:
+        data = vars(info).copy()
+        for key in "start_date", "end_date":
+            if data[key] is not None:
+                data[key] = data[key].isoformat()
+        partitions.append(data)
+    path = store_dir / MANIFEST_FILE
+    _write_json(path, {"partitions": partitions})
+    log.debug("Saved partition manifest to %s", path)
+
+
+def _read_partition_table(
+    partition_path: Path,
+    companies: Collection[int] | None,
+    start: pd.Timestamp | str | None,
+    end: pd.Timestamp | str | None,
+) -> pa.Table:
+    """Read the returns of some companies and dates from a partition."""
+    dataset = ds.dataset(partition_path, format="parquet")
+    date_type = dataset.schema.field("date").type
+    return dataset.to_table(
+        columns=["companyid", "date", "returns"],
+        filter=filter_expression(companies, start, end, date_type),
+        use_threads=True,
+    )
+
+
+def read_partition(
+    partition_path: Path,
+    companies: Collection[int] | None = None,
+    start: pd.Timestamp | str | None = None,
+    end: pd.Timestamp | str | None = None,
+) -> pd.Series:
+    """
+    Read company data from a partition of the store.
+
+    Only the company id, date and returns columns are read. Filters are
+    pushed down to the parquet reader, which skips the row groups whose
+    statistics don't match: rows are sorted by company id and date, so row
+    groups cover narrow company ranges.
+
+    :param partition_path: the partition directory.
+    :param companies: the company ids to read, or None to read all.
+    :param start: the first date to read, inclusive.
+    :param end: the last date to read, inclusive.
+    :return: the company data, sorted by company id and date.
+    """
+    table = _read_partition_table(partition_path, companies, start, end)
+    company_data = company_returns_series(table)
+    if not is_sorted(company_data.index):
+        # after incremental runs, companies are split across files
+        company_data = company_data.sort_index()
+    return company_data
+
+
+def read_partition_panel(
+    partition_path: Path,
+    companies: Collection[int] | None = None,
+    start: pd.Timestamp | str | None = None,
+    end: pd.Timestamp | str | None = None,
+) -> CompanyPanel:
+    """
+    Read company data from a partition of the store, as a panel.
+
+    This reads the same rows as :func:`read_partition`, without building a
+    company and date index.
+
+    :param partition_path: the partition directory.
+    :param companies: the company ids to read, or None to read all.
+    :param start: the first date to read, inclusive.
+    :param end: the last date to read, inclusive.
+    :return: the company data.
+    """
+    return CompanyPanel.from_table(
+        _read_partition_table(partition_path, companies, start, end)
+    )
+
+
+def _last_date(company_data: pd.Series | CompanyPanel) -> pd.Timestamp:
+    """Get the last date of company data, from the index codes of a series."""
+    if isinstance(company_data, CompanyPanel):
+        return pd.Timestamp(from_bday_offsets(company_data.days.max()))
+    index = company_data.index
+    n_level = index.names.index("date")
+    dates = index.levels[n_level]
+    used = np.bincount(index.codes[n_level], minlength=len(dates)) > 0
+    return dates[used].max()
+
+
+def write_partitions(
+    company_data: pd.Series | CompanyPanel,
+    company_dir: Path,
+    partitions: np.ndarray,
+    append: bool = False,
+) -> None:
+    """
+    Write company data to the partitioned store.
+
+    The arrow table is built straight from the series buffers, see
+    :func:`etl_pipeline_example.dataset.company_returns_table`, and each
+    partition is written from a zero-copy slice of it, so the store needs
+    about one more copy of the data in memory.
+
+    Rows are sorted by company id and date, and written in small row groups,
+    so that row group statistics can skip the companies not read back.
+    Company ids and dates are dictionary encoded, and pages are compressed
+    with :data:`STORE_COMPRESSION`.
+
+    :param company_data: the company data, as a series or a panel.
+    :param company_dir: the store directory of the company data.
+    :param partitions: the partition of each row, which must be sorted when
+        the company data is sorted, as for contiguous company id ranges.
+    :param append: whether to add files to existing partitions, rather than
+        replacing the partitions written.
+    """
+    if isinstance(company_data, CompanyPanel):
+        # panels are always sorted
+        table = company_data.to_table()
+    else:
+        if not is_sorted(company_data.index):
+            order = np.lexsort(
+                (
+                    company_data.index.get_level_values("date"),
+                    company_data.index.get_level_values("companyid"),
+                )
+            )
+            company_data = company_data.iloc[order]
+            partitions = partitions[order]
+        table = company_returns_table(company_data)
+    if np.any(np.diff(partitions) < 0):
+        raise ValueError("Partitions are not contiguous company id ranges")
+    if append:
+        last_date = _last_date(company_data)
+        basename_template = f"part-{last_date:%Y%m%d}-{{i}}.parquet"
+        existing_data_behavior = "overwrite_or_ignore"
+    else:
+        basename_template = "part-{i}.parquet"
+        existing_data_behavior = "delete_matching"
+    file_format = ds.ParquetFileFormat()
+    file_options = file_format.make_write_options(
+        compression=STORE_COMPRESSION, use_dictionary=["companyid", "date"]
+    )
+    parts, offsets = np.unique(partitions, return_index=True)
+    ends = np.append(offsets[1:], len(partitions))
+    for n_part, offset, end in zip(parts, offsets, ends):
+        ds.write_dataset(
+            table.slice(offset, end - offset),
+            company_dir / str(n_part),
+            format=file_format,
+            file_options=file_options,
+            basename_template=basename_template,
+            existing_data_behavior=existing_data_behavior,
+            min_rows_per_group=STORE_ROW_GROUP_SIZE,
+            max_rows_per_group=STORE_ROW_GROUP_SIZE,
+        )
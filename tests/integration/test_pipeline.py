@@ -1,12 +1,494 @@
+import json
 from filecmp import cmp
 
-from etl_pipeline_example.create_dataset import write_dataset
-from etl_pipeline_example.pipeline import run_pipeline
+import pandas as pd
+import pytest
+from pandas._testing import assert_frame_equal, assert_series_equal
+
+from etl_pipeline_example import pipeline
+from etl_pipeline_example.create_dataset import (
+    company_data,
+    date_index,
+    returns_data,
+    write_dataset,
+)
+from etl_pipeline_example.dataset import DatasetFormat, write_returns
+from etl_pipeline_example.log_utils import max_rss_bytes
+from etl_pipeline_example.pipeline import BATCH_ROW_BYTES, Engine, run_pipeline
+from etl_pipeline_example.precision import PRECISION_FILE, PRECISION_SAMPLE
+from etl_pipeline_example.results import ResultStore
+from etl_pipeline_example.rolling import Statistic
+from etl_pipeline_example.sinks import OutputFormat
+from etl_pipeline_example.store import load_manifest, read_partition
 
 
 def test_pipeline_small_dataset(tmp_path, testfiles):
     expected = testfiles / "expected_results_small.csv"
-    write_dataset(tmp_path, "2016-01-01", n_companies=6, n_dates=1000)
+    write_dataset(
+        tmp_path, "2016-01-01", "2023-03-24", n_companies=6, n_dates=1000
+    )
     run_pipeline(tmp_path)
     actual = tmp_path.joinpath("store/result_corr.csv")
     assert cmp(actual, expected), "Files are different!"
+
+
+def test_pipeline_parallel(tmp_path):
+    serial_dir, parallel_dir = tmp_path / "serial", tmp_path / "parallel"
+    for data_dir in serial_dir, parallel_dir:
+        write_dataset(
+            data_dir, "2018-01-01", "2023-03-24", n_companies=40, n_dates=800
+        )
+    run_pipeline(serial_dir, partition_rows=10_000)
+    run_pipeline(parallel_dir, n_workers=2, partition_rows=10_000)
+    assert cmp(
+        serial_dir / "store/result_corr.csv",
+        parallel_dir / "store/result_corr.csv",
+        shallow=False,
+    ), "Files are different!"
+
+
+def test_pipeline_parquet_output(tmp_path, testfiles):
+    expected = pd.read_csv(
+        testfiles / "expected_results_small.csv",
+        parse_dates=["date"],
+        index_col=["companyid", "date"],
+        dtype={"returns": "float32"},
+    )
+    write_dataset(
+        tmp_path, "2016-01-01", "2023-03-24", n_companies=6, n_dates=1000
+    )
+    run_pipeline(tmp_path, output_format=OutputFormat.PARQUET)
+    actual = pd.read_parquet(tmp_path / "store/result_corr.parquet")
+    assert_frame_equal(actual, expected)
+
+
+@pytest.mark.parametrize(
+    "params",
+    [{}, {"window": [63, 524], "statistics": [Statistic.CORR, Statistic.BETA]}],
+)
+def test_pipeline_incremental(tmp_path, params):
+    dates = date_index("2018-01-01", "2023-03-24")
+    companies = company_data(dates, n_companies=40, n_dates=800)
+    # a company with returns only after the first run
+    late = companies.loc[[0]]
+    late = late[late.index.get_level_values("date") >= "2023-02-01"]
+    late.index = late.index.set_levels([100], level="companyid")
+    # a company with its whole history added after the first run
+    added = companies.loc[[1]].rename(index={1: 101}, level="companyid")
+    companies = pd.concat([companies, late, added])
+    market = returns_data(dates)
+    day_one = companies[companies.index.get_level_values("date") < "2023-02"]
+    day_one = day_one.drop(101, level="companyid")
+
+    full_dir, incremental_dir = tmp_path / "full", tmp_path / "incremental"
+    write_returns(companies, market, full_dir)
+    run_pipeline(full_dir, partition_rows=10_000, **params)
+    write_returns(day_one, market, incremental_dir)
+    run_pipeline(
+        incremental_dir, incremental=True, partition_rows=10_000, **params
+    )
+    write_returns(companies, market, incremental_dir)
+    run_pipeline(incremental_dir, incremental=True, **params)
+    # nothing new to process
+    run_pipeline(incremental_dir, incremental=True, **params)
+
+    def read_results(data_dir):
+        res = pd.read_csv(
+            data_dir / "store/result_corr.csv",
+            parse_dates=["date"],
+            index_col=["companyid", "date"],
+        )
+        return res.sort_index()
+
+    expected, actual = read_results(full_dir), read_results(incremental_dir)
+    assert expected.index.get_level_values("companyid").isin([101]).any()
+    assert_frame_equal(actual, expected, check_exact=False, rtol=1e-6)
+
+    def read_store(data_dir):
+        return read_partition(data_dir / "store/company_data").sort_index()
+
+    assert_series_equal(read_store(incremental_dir), read_store(full_dir))
+    # the new companies are appended to the last partition
+    manifest = load_manifest(incremental_dir / "store")
+    assert manifest.partitions[-1].last_company == 101
+    n_rows = sum(p.n_rows for p in manifest.partitions)
+    assert n_rows == len(read_store(incremental_dir))
+
+
+def test_pipeline_indexed_output(tmp_path):
+    dates = date_index("2018-01-01", "2023-03-24")
+    companies = company_data(dates, n_companies=40, n_dates=800)
+    market = returns_data(dates)
+    csv_dir, indexed_dir = tmp_path / "csv", tmp_path / "indexed"
+    write_returns(companies, market, csv_dir)
+    run_pipeline(csv_dir, partition_rows=10_000)
+    write_returns(companies, market, indexed_dir)
+    run_pipeline(
+        indexed_dir, partition_rows=10_000, output_format=OutputFormat.INDEXED
+    )
+    with ResultStore(indexed_dir / "store/result_corr") as store:
+        store.to_csv(indexed_dir / "export.csv")
+        lookup = store.get_corr([3, 17], "2022-06-01", "2022-06-30")
+    assert cmp(
+        indexed_dir / "export.csv", csv_dir / "store/result_corr.csv"
+    ), "Files are different!"
+    expected = pd.read_csv(
+        csv_dir / "store/result_corr.csv",
+        parse_dates=["date"],
+        index_col=["companyid", "date"],
+        dtype={"returns": "float32"},
+    )
+    assert_frame_equal(
+        lookup, expected.loc[([3, 17], slice("2022-06", "2022-06")), :]
+    )
+
+    # incremental runs add segments, looked up with the earlier ones
+    day_one = companies[companies.index.get_level_values("date") < "2023-02"]
+    write_returns(day_one, market, indexed_dir)
+    run_pipeline(indexed_dir, output_format=OutputFormat.INDEXED)
+    write_returns(companies, market, indexed_dir)
+    run_pipeline(
+        indexed_dir, incremental=True, output_format=OutputFormat.INDEXED
+    )
+    result_dir = indexed_dir / "store/result_corr"
+    assert len(list(result_dir.glob("segment-*.arrow"))) == 2
+    with ResultStore(result_dir) as store:
+        actual = store.get_corr(store.company_ids)
+    assert_frame_equal(actual, expected, check_exact=False, rtol=1e-6)
+
+
+def test_pipeline_sharded_dataset(tmp_path):
+    single_dir, sharded_dir = tmp_path / "single", tmp_path / "sharded"
+    params = dict(n_companies=300, n_dates=200)
+    write_dataset(single_dir, "2021-01-01", "2023-03-24", **params)
+    company_path, _ = write_dataset(
+        sharded_dir,
+        "2021-01-01",
+        "2023-03-24",
+        n_workers=2,
+        shard_companies=256,
+        **params,
+    )
+    assert len(list(company_path.iterdir())) == 2
+    for data_dir in single_dir, sharded_dir:
+        run_pipeline(data_dir, window=63, partition_rows=50_000)
+    assert cmp(
+        single_dir / "store/result_corr.csv",
+        sharded_dir / "store/result_corr.csv",
+        shallow=False,
+    ), "Files are different!"
+
+
+def test_pipeline_partitions(tmp_path):
+    write_dataset(
+        tmp_path, "2018-01-01", "2023-03-24", n_companies=40, n_dates=800
+    )
+    run_pipeline(tmp_path, partition_bytes=100_000, profile=True)
+    manifest = load_manifest(tmp_path / "store")
+    assert len(manifest.partitions) > 1
+    for part in manifest.partitions:
+        stored = read_partition(
+            tmp_path / f"store/company_data/{part.partition}"
+        )
+        ids = stored.index.get_level_values("companyid")
+        assert part.n_rows == len(stored)
+        assert (part.first_company, part.last_company) == (ids.min(), ids.max())
+        assert part.end_date == stored.index.get_level_values("date").max()
+    report = json.loads(tmp_path.joinpath("store/run_report.json").read_text())
+    stages = {stage["name"]: stage for stage in report["stages"]}
+    assert list(stages) == [
+        "load",
+        "downcast",
+        "resample",
+        "store",
+        "load_market",
+        "correlate",
+        "write",
+    ]
+    assert stages["correlate"]["calls"] == len(manifest.partitions)
+
+
+def test_pipeline_statistics(tmp_path, testfiles):
+    expected = pd.read_csv(
+        testfiles / "expected_results_small.csv",
+        parse_dates=["date"],
+        index_col=["companyid", "date"],
+    )
+    write_dataset(
+        tmp_path, "2016-01-01", "2023-03-24", n_companies=6, n_dates=1000
+    )
+    statistics = [Statistic.CORR, Statistic.BETA, Statistic.VOL]
+    run_pipeline(tmp_path, window=[63, 524], statistics=statistics)
+    actual = pd.read_csv(
+        tmp_path / "store/result_corr.csv",
+        parse_dates=["date"],
+        index_col=["companyid", "date"],
+    )
+    assert list(actual.columns) == [
+        "corr_63",
+        "corr_524",
+        "beta_63",
+        "beta_524",
+        "vol_63",
+        "vol_524",
+    ]
+    # rows are kept as soon as the shortest window is full
+    assert actual["corr_63"].notna().all()
+    assert len(actual) > len(expected)
+    assert_series_equal(
+        actual["corr_524"].dropna(), expected["returns"], check_names=False
+    )
+
+
+def test_pipeline_min_periods(tmp_path, testfiles):
+    expected = pd.read_csv(
+        testfiles / "expected_results_small.csv",
+        parse_dates=["date"],
+        index_col=["companyid", "date"],
+    )
+    write_dataset(
+        tmp_path, "2016-01-01", "2023-03-24", n_companies=6, n_dates=1000
+    )
+    run_pipeline(tmp_path, min_periods=100)
+    actual = pd.read_csv(
+        tmp_path / "store/result_corr.csv",
+        parse_dates=["date"],
+        index_col=["companyid", "date"],
+    )
+    # partial windows start after 100 rows, full windows are unchanged
+    assert len(actual) == len(expected) + 6 * (524 - 100)
+    assert_frame_equal(actual.loc[expected.index], expected)
+    with pytest.raises(ValueError, match="min_periods"):
+        run_pipeline(tmp_path, min_periods=1000)
+
+
+@pytest.mark.parametrize("engine", list(Engine))
+def test_pipeline_validate_precision(tmp_path, engine):
+    write_dataset(
+        tmp_path, "2020-01-01", "2023-03-24", n_companies=80, n_dates=300
+    )
+    statistics = [Statistic.CORR, Statistic.BETA, Statistic.VOL]
+    params = dict(engine=engine, window=63, statistics=statistics)
+    run_pipeline(tmp_path, **params)
+    results = tmp_path.joinpath("store/result_corr.csv").read_bytes()
+    run_pipeline(tmp_path, validate_precision=True, **params)
+    # the results don't change
+    assert tmp_path.joinpath("store/result_corr.csv").read_bytes() == results
+    report = json.loads((tmp_path / "store" / PRECISION_FILE).read_text())
+    assert report["value_dtype"] == "float32"
+    assert len(report["companies"]) == PRECISION_SAMPLE
+    assert set(report["statistics"]) == {"corr_63", "beta_63", "vol_63"}
+    for stats in report["statistics"].values():
+        assert stats["n_values"] > 0
+        assert stats["n_missing"] == 0
+        assert stats["n_infinite"] == 0
+        assert stats["max_abs_error"] < 1e-6
+
+
+@pytest.mark.parametrize(
+    "params", [{"window": 5000}, {"companies": [999]}, {"start": "2030-01-01"}]
+)
+def test_pipeline_without_results(tmp_path, params):
+    write_dataset(
+        tmp_path, "2022-01-01", "2023-03-24", n_companies=4, n_dates=200
+    )
+    run_pipeline(tmp_path, window=20)
+    output = tmp_path / "store/result_corr.csv"
+    assert len(output.read_text().splitlines()) > 1
+    # results of the previous run are not left behind
+    run_pipeline(tmp_path, **{"window": 20, **params})
+    assert output.read_text() == "companyid,date,returns\n"
+
+
+def test_pipeline_subset(tmp_path):
+    full_dir, subset_dir = tmp_path / "full", tmp_path / "subset"
+    for data_dir in full_dir, subset_dir:
+        write_dataset(
+            data_dir, "2018-01-01", "2023-03-24", n_companies=40, n_dates=800
+        )
+    run_pipeline(full_dir, partition_rows=10_000)
+    run_pipeline(
+        subset_dir,
+        partition_rows=10_000,
+        companies=[3, 30],
+        start="2022-06-01",
+        end="2023-01-31",
+    )
+
+    def read_results(data_dir):
+        return pd.read_csv(
+            data_dir / "store/result_corr.csv",
+            parse_dates=["date"],
+            index_col=["companyid", "date"],
+        )
+
+    expected = read_results(full_dir).loc[[3, 30]]
+    dates = expected.index.get_level_values("date")
+    expected = expected[(dates >= "2022-06-01") & (dates <= "2023-01-31")]
+    assert len(expected) > 0
+    assert_frame_equal(read_results(subset_dir), expected)
+
+
+def test_pipeline_out_of_core(tmp_path):
+    full_dir, chunked_dir = tmp_path / "full", tmp_path / "chunked"
+    for data_dir in full_dir, chunked_dir:
+        write_dataset(
+            data_dir, "2018-01-01", "2023-03-24", n_companies=40, n_dates=800
+        )
+    run_pipeline(full_dir, partition_rows=10_000)
+    # leave room for batches of at most 25000 of the ~54000 resampled rows
+    memory_limit = max_rss_bytes() + 25_000 * BATCH_ROW_BYTES
+    run_pipeline(
+        chunked_dir,
+        partition_rows=10_000,
+        memory_limit=memory_limit,
+        profile=True,
+    )
+    assert cmp(
+        full_dir / "store/result_corr.csv",
+        chunked_dir / "store/result_corr.csv",
+        shallow=False,
+    ), "Files are different!"
+    assert load_manifest(chunked_dir / "store") == load_manifest(
+        full_dir / "store"
+    )
+    report = json.loads(
+        chunked_dir.joinpath("store/run_report.json").read_text()
+    )
+    stages = {stage["name"]: stage for stage in report["stages"]}
+    assert stages["resample"]["calls"] > 1
+
+
+def test_pipeline_out_of_core_pickle(tmp_path):
+    write_dataset(
+        tmp_path,
+        "2022-01-01",
+        "2023-03-24",
+        n_companies=4,
+        n_dates=200,
+        dataset_format=DatasetFormat.PICKLE,
+    )
+    with pytest.raises(ValueError, match="parquet or feather"):
+        run_pipeline(tmp_path, memory_limit=2**30)
+    assert not tmp_path.joinpath("store").exists()
+
+
+def test_pipeline_cache(tmp_path):
+    cached_dir, fresh_dir = tmp_path / "cached", tmp_path / "fresh"
+    for data_dir in cached_dir, fresh_dir:
+        write_dataset(
+            data_dir, "2018-01-01", "2023-03-24", n_companies=40, n_dates=800
+        )
+
+    def run_stages(data_dir, **kwargs):
+        run_pipeline(data_dir, partition_rows=10_000, profile=True, **kwargs)
+        report = json.loads(
+            data_dir.joinpath("store/run_report.json").read_text()
+        )
+        return {stage["name"] for stage in report["stages"]}
+
+    assert "resample" in run_stages(cached_dir)
+    n_partitions = len(load_manifest(cached_dir / "store").partitions)
+    cache_dir = cached_dir / "store/cache"
+    assert len(list(cache_dir.glob("*.parquet"))) == n_partitions
+    # nothing changed: the store, the market and the statistics are reused
+    assert not {"resample", "load_market"} & run_stages(cached_dir)
+    assert len(list(cache_dir.glob("*.parquet"))) == n_partitions
+    # a new window only recalculates the statistics
+    assert "resample" not in run_stages(cached_dir, window=63)
+    assert len(list(cache_dir.glob("*.parquet"))) == 2 * n_partitions
+    # results read back from the cache are the same
+    run_stages(cached_dir, window=63)
+    run_stages(fresh_dir, window=63, cache=False)
+    assert not fresh_dir.joinpath("store/cache").exists()
+    assert cmp(
+        cached_dir / "store/result_corr.csv",
+        fresh_dir / "store/result_corr.csv",
+        shallow=False,
+    ), "Files are different!"
+    # new input data invalidates the store
+    write_dataset(
+        cached_dir, "2018-01-01", "2023-03-24", n_companies=41, n_dates=800
+    )
+    assert "resample" in run_stages(cached_dir, window=63)
+    # a tiny cache keeps no statistics
+    run_stages(cached_dir, window=63, cache_bytes=0)
+    assert not list(cache_dir.glob("*.parquet"))
+
+
+def fail_after(monkeypatch, name, n_calls):
+    """Make a pipeline function fail after some calls, like a killed run."""
+    func = getattr(pipeline, name)
+    calls = []
+
+    def failing(*args, **kwargs):
+        if len(calls) == n_calls:
+            raise RuntimeError(f"{name} failed")
+        calls.append(1)
+        return func(*args, **kwargs)
+
+    monkeypatch.setattr(pipeline, name, failing)
+
+
+def read_report(data_dir):
+    report = json.loads(data_dir.joinpath("store/run_report.json").read_text())
+    return {stage["name"]: stage for stage in report["stages"]}
+
+
+def test_pipeline_resume(tmp_path, monkeypatch):
+    full_dir, resumed_dir = tmp_path / "full", tmp_path / "resumed"
+    for data_dir in full_dir, resumed_dir:
+        write_dataset(
+            data_dir, "2018-01-01", "2023-03-24", n_companies=40, n_dates=800
+        )
+    run_pipeline(full_dir, partition_rows=10_000)
+    with monkeypatch.context() as patch:
+        fail_after(patch, "_partition_stats", 2)
+        with pytest.raises(RuntimeError, match="failed"):
+            run_pipeline(resumed_dir, partition_rows=10_000)
+    # the store and the first partitions are done
+    run_pipeline(resumed_dir, partition_rows=10_000, profile=True)
+    stages = read_report(resumed_dir)
+    assert "resample" not in stages
+    n_partitions = len(load_manifest(resumed_dir / "store").partitions)
+    assert len(list(resumed_dir.glob("store/cache/*.parquet"))) == n_partitions
+    assert cmp(
+        full_dir / "store/result_corr.csv",
+        resumed_dir / "store/result_corr.csv",
+        shallow=False,
+    ), "Files are different!"
+
+
+def test_pipeline_resume_out_of_core(tmp_path, monkeypatch):
+    full_dir, resumed_dir = tmp_path / "full", tmp_path / "resumed"
+    for data_dir in full_dir, resumed_dir:
+        write_dataset(
+            data_dir, "2018-01-01", "2023-03-24", n_companies=40, n_dates=800
+        )
+    run_pipeline(full_dir, partition_rows=10_000)
+    memory_limit = max_rss_bytes() + 25_000 * BATCH_ROW_BYTES
+    with monkeypatch.context() as patch:
+        fail_after(patch, "resample_company_returns", 1)
+        with pytest.raises(RuntimeError, match="failed"):
+            run_pipeline(
+                resumed_dir, partition_rows=10_000, memory_limit=memory_limit
+            )
+    run_pipeline(
+        resumed_dir,
+        partition_rows=10_000,
+        memory_limit=memory_limit,
+        profile=True,
+    )
+    # the plan and the first batch are not done again
+    stages = read_report(resumed_dir)
+    assert "summary" not in stages
+    n_batches = len(list(resumed_dir.glob("store/checkpoints/store-batch-*")))
+    assert stages["resample"]["calls"] == n_batches - 1
+    assert load_manifest(resumed_dir / "store") == load_manifest(
+        full_dir / "store"
+    )
+    assert cmp(
+        full_dir / "store/result_corr.csv",
+        resumed_dir / "store/result_corr.csv",
+        shallow=False,
+    ), "Files are different!"
@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+
+from etl_pipeline_example.bdays import (
+    from_bday_offsets,
+    is_bday_freq,
+    to_bday_offsets,
+)
+
+
+def test_bday_offsets_round_trip():
+    dates = pd.bdate_range("1960-01-01", "2030-12-31")
+    offsets = to_bday_offsets(dates)
+    assert offsets.dtype == np.int32
+    assert (np.diff(offsets) == 1).all()
+    assert offsets[dates == pd.Timestamp("1970-01-01")] == 0
+    assert (from_bday_offsets(offsets) == dates.values).all()
+    days = from_bday_offsets(offsets, "D")
+    assert days.dtype == np.dtype("datetime64[D]")
+    assert (days == dates.values).all()
+
+
+def test_bday_offsets_weekend():
+    """Check that weekend dates fall into the previous business day."""
+    dates = pd.to_datetime(["2023-02-17", "2023-02-18", "2023-02-19 13:00"])
+    assert (to_bday_offsets(dates) == to_bday_offsets(dates[:1])[0]).all()
+
+
+def test_is_bday_freq():
+    assert is_bday_freq("B")
+    assert is_bday_freq(pd.offsets.BDay())
+    assert not is_bday_freq("D")
+    assert not is_bday_freq("2B")
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+
+from etl_pipeline_example.bench import (
+    BenchStage,
+    _measure,
+    bench_load,
+    bench_suite,
+    compare_results,
+)
+from etl_pipeline_example.dataset import DatasetFormat
+from etl_pipeline_example.log_utils import reset_peak_rss
+
+
+def test_bench_load(tmp_path):
+    formats = [DatasetFormat.PARQUET, DatasetFormat.PICKLE]
+    results = bench_load(tmp_path, n_companies=10, n_dates=50, formats=formats)
+    assert [r["format"] for r in results] == ["parquet", "pkl"]
+    for r in results:
+        assert r["seconds"] > 0
+        assert r["peak_rss_mb"] >= 0
+
+
+def allocate(n_bytes: int) -> float:
+    """Allocate and touch some memory, then release it."""
+    return np.ones(n_bytes // 8).sum()
+
+
+def test_measure_after_preparation():
+    if not reset_peak_rss():
+        pytest.skip("the peak RSS can't be reset")
+    # a preparation peak larger than the measured one
+    allocate(400_000_000)
+    res = _measure(allocate, 100_000_000)
+    assert 80 < res["peak_rss_mb"] < 200
+
+
+def test_bench_suite(tmp_path):
+    stages = [BenchStage.RESAMPLE, BenchStage.STORE, BenchStage.PIPELINE]
+    results = bench_suite(tmp_path, scales=[4], n_dates=300, stages=stages)
+    assert set(results["environment"]) >= {"python", "pandas", "pyarrow"}
+    measured = [r["stage"] for r in results["results"]]
+    assert measured == ["generate", "resample", "store", "pipeline"]
+    assert {r["n_companies"] for r in results["results"]} == {4}
+    store_dir = tmp_path / "companies-4" / "bench_store" / "company_data"
+    assert list(store_dir.rglob("*.parquet"))
+    for r in results["results"]:
+        assert r["seconds"] > 0
+    pipeline_stages = [s["name"] for s in results["results"][-1]["stages"]]
+    assert "correlate" in pipeline_stages
+
+
+def test_compare_results():
+    def results(*measurements):
+        return {
+            "results": [
+                {"n_companies": 10, "stage": stage, **m}
+                for stage, m in measurements
+            ]
+        }
+
+    baseline = results(
+        ("load", {"seconds": 1.0, "peak_rss_mb": 100.0}),
+        ("resample", {"seconds": 0.01, "peak_rss_mb": 0.1}),
+    )
+    current = results(
+        ("load", {"seconds": 1.1, "peak_rss_mb": 150.0}),
+        ("resample", {"seconds": 0.02, "peak_rss_mb": 0.5}),
+        ("correlate", {"seconds": 5.0, "peak_rss_mb": 500.0}),
+    )
+    assert compare_results(baseline, current) == [
+        "load of 10 companies: peak_rss_mb 100.00 -> 150.00"
+    ]
+    assert compare_results(baseline, current, tolerance=0.6) == []
+
+    def pipeline(seconds, correlate_seconds, store_rss_mb):
+        stages = [
+            {
+                "name": "correlate",
+                "wall_seconds": correlate_seconds,
+                "peak_rss_mb": 200.0,
+            },
+            {
+                "name": "store",
+                "wall_seconds": 0.01,
+                "peak_rss_mb": store_rss_mb,
+            },
+        ]
+        measurement = {"seconds": seconds, "peak_rss_mb": 300.0}
+        return results(("pipeline", {**measurement, "stages": stages}))
+
+    # a stage regression hidden by the rest of the pipeline
+    assert compare_results(
+        pipeline(10.0, 2.0, 0.5), pipeline(10.5, 3.0, 0.9)
+    ) == ["pipeline/correlate of 10 companies: wall_seconds 2.00 -> 3.00"]
+    assert compare_results(
+        pipeline(10.0, 2.0, 100.0), pipeline(10.0, 2.0, 130.0)
+    ) == ["pipeline/store of 10 companies: peak_rss_mb 100.00 -> 130.00"]
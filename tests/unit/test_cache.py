@@ -0,0 +1,88 @@
+import os
+
+import pandas as pd
+from pandas._testing import assert_frame_equal
+
+from etl_pipeline_example.cache import StageCache, cache_key, fingerprint
+
+
+def test_fingerprint(tmp_path):
+    path = tmp_path / "data.bin"
+    assert fingerprint(path)["size"] is None
+    path.write_bytes(b"abc")
+    stat = path.stat()
+    assert fingerprint(path) == {
+        "path": str(path),
+        "size": 3,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert cache_key(fingerprint(path)) != cache_key(
+        {"path": str(path), "size": 3, "mtime_ns": stat.st_mtime_ns}
+    )
+    # content hashes don't change with the modification time
+    assert fingerprint(path, content=True)["sha256"] == (
+        "ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad"
+    )
+
+
+def test_fingerprint_directory(tmp_path):
+    path = tmp_path / "shards"
+    path.mkdir()
+    path.joinpath("part-0").write_bytes(b"ab")
+    path.joinpath("part-1").write_bytes(b"c")
+    res = fingerprint(path)
+    assert res["size"] == 3 and res["n_files"] == 2
+    # the same contents as a single file
+    assert fingerprint(path, content=True)["sha256"] == (
+        "ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad"
+    )
+    path.joinpath("part-2").write_bytes(b"")
+    assert cache_key(fingerprint(path)) != cache_key(res)
+
+
+def test_cache_key():
+    start = pd.Timestamp("2023-01-02")
+    assert cache_key("a", [1, 2], start) == cache_key("a", [1, 2], start)
+    assert cache_key("a", [1, 2]) != cache_key("a", [2, 1])
+    assert cache_key({"x": 1, "y": 2}) == cache_key({"y": 2, "x": 1})
+
+
+def _stats(n_rows: int) -> pd.DataFrame:
+    index = pd.MultiIndex.from_product(
+        [[1, 2], pd.bdate_range("2023-01-02", periods=n_rows // 2)],
+        names=["companyid", "date"],
+    )
+    return pd.DataFrame(
+        {"returns": range(len(index))}, index=index, dtype="float32"
+    )
+
+
+def test_stage_cache(tmp_path):
+    cache = StageCache(tmp_path / "cache")
+    assert cache.load("correlate", "k1") is None
+    cache.save("correlate", "k1", _stats(10))
+    assert cache.contains("correlate", "k1")
+    assert_frame_equal(cache.load("correlate", "k1"), _stats(10))
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert not StageCache(tmp_path / "cache", enabled=False).contains(
+        "correlate", "k1"
+    )
+    cache.clear()
+    assert not cache.contains("correlate", "k1")
+    assert cache.size() == 0
+
+
+def test_stage_cache_eviction(tmp_path):
+    cache = StageCache(tmp_path)
+    for n_key, key in enumerate(["k1", "k2", "k3"]):
+        cache.save("correlate", key, _stats(1000))
+        os.utime(cache.path("correlate", key), ns=(n_key, n_key))
+    # using an entry makes it the most recently used
+    cache.load("correlate", "k1")
+    entry_bytes = cache.path("correlate", "k2").stat().st_size
+    cache.max_bytes = 2 * entry_bytes
+    assert cache.evict() == 1
+    assert not cache.contains("correlate", "k2")
+    assert cache.contains("correlate", "k1")
+    assert cache.evict() == 0
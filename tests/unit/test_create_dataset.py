@@ -1,12 +1,20 @@
+import numpy as np
 import pandas as pd
+import pytest
 from pandas._testing import assert_index_equal, assert_series_equal
 
 from etl_pipeline_example.create_dataset import (
     company_data,
     date_index,
+    iter_company_data,
     returns_data,
     write_dataset,
 )
+from etl_pipeline_example.dataset import (
+    DatasetFormat,
+    company_summary,
+    read_company_returns,
+)
 
 
 def test_date_index_default_args():
@@ -20,7 +28,7 @@ def test_create_default_dates():
     expected_dates = date_index()
     cd = company_data(n_companies=1, n_dates=len(expected_dates))
     cd_dates = cd.index.get_level_values(1)
-    assert set(cd_dates) == set(expected_dates)  # order is randomized
+    assert set(cd_dates) == set(expected_dates)
     ret = returns_data()
     assert_index_equal(ret.index, expected_dates)
 
@@ -60,30 +68,30 @@ def test_write_dataset(tmp_path):
         name="returns",
         index=pd.MultiIndex.from_tuples(
             [
+                (0, pd.Timestamp("2022-01-17")),
                 (0, pd.Timestamp("2022-01-20")),
-                (0, pd.Timestamp("2022-01-19")),
-                (1, pd.Timestamp("2022-01-20")),
-                (1, pd.Timestamp("2022-01-10")),
-                (2, pd.Timestamp("2022-01-13")),
-                (2, pd.Timestamp("2022-01-18")),
+                (1, pd.Timestamp("2022-01-14")),
+                (1, pd.Timestamp("2022-01-17")),
+                (2, pd.Timestamp("2022-01-10")),
+                (2, pd.Timestamp("2022-01-17")),
             ],
             names=["companyid", "date"],
         ),
-        data=[0.03285, 0.0134, 0.01889, -0.001, 0.005720839515684686, -0.0073],
+        data=[-0.00645, -0.01286, -0.00332, -0.00095, -0.00411, 0.01345],
     )
     expected_mkt = pd.Series(
         name="returns",
         index=pd.bdate_range("2022-01-10", "2022-01-20", name="date"),
         data=[
-            0.00378,
-            -0.0054,
-            0.00193,
-            -0.0136,
-            0.0060,
-            -0.0122,
-            0.00004,
-            -0.0009,
-            -0.0064,
+            -0.00005,
+            0.00837,
+            0.00593,
+            0.00579,
+            0.01295,
+            -0.00964,
+            -0.00502,
+            -0.01057,
+            -0.00086,
         ],
     )
     write_dataset(
@@ -93,8 +101,69 @@ def test_write_dataset(tmp_path):
         n_companies=3,
         n_dates=2,
         random_seed=12,
+        dataset_format=DatasetFormat.PICKLE,
     )
     actual_comp = pd.read_pickle(tmp_path / "company_returns.pkl")
     actual_mkt = pd.read_pickle(tmp_path / "market_returns.pkl")
     assert_series_equal(actual_comp, expected_comp, atol=1e-4)
     assert_series_equal(actual_mkt, expected_mkt, atol=1e-4)
+
+
+def test_create_companies_reproducible():
+    """Check that the returns of a company only depend on the seed and on the
+    company id, and that the global random state is not used.
+    """
+    dates = date_index("2020-01-01", "2020-12-31")
+    few = company_data(dates, n_companies=3, n_dates=20, random_seed=7)
+    np.random.seed(1)
+    many = company_data(dates, n_companies=300, n_dates=20, random_seed=7)
+    assert_series_equal(many.loc[:2], few)
+    other = company_data(dates, n_companies=3, n_dates=20, random_seed=8)
+    assert not other.equals(few)
+
+
+def test_iter_company_data():
+    dates = date_index("2020-01-01", "2020-12-31")
+    chunks = list(iter_company_data(dates, n_companies=300, n_dates=20))
+    assert [len(c) for c in chunks] == [256 * 20, 44 * 20]
+    expected = company_data(dates, n_companies=300, n_dates=20)
+    assert_series_equal(pd.concat(chunks), expected, check_index_type=False)
+
+
+def test_create_companies_too_many_dates():
+    dates = date_index("2020-01-01", "2020-01-31")
+    with pytest.raises(ValueError, match="Cannot sample"):
+        company_data(dates, n_companies=1, n_dates=len(dates) + 1)
+
+
+@pytest.mark.parametrize("fmt", [DatasetFormat.PARQUET, DatasetFormat.FEATHER])
+def test_write_dataset_shards(tmp_path, fmt):
+    params = dict(
+        history_start="2020-01-01",
+        history_end="2020-12-31",
+        n_companies=600,
+        n_dates=20,
+        dataset_format=fmt,
+        shard_companies=256,
+    )
+    serial, parallel = tmp_path / "serial", tmp_path / "parallel"
+    path, _ = write_dataset(serial, **params)
+    write_dataset(parallel, n_workers=2, **params)
+    assert path.is_dir()
+    shards = sorted(p.name for p in path.iterdir())
+    assert shards == [f"part-0000{i}.{fmt.value}" for i in range(3)]
+    # shards only depend on the seed, not on the number of workers
+    for name in shards:
+        assert (serial / path.name / name).read_bytes() == (
+            parallel / path.name / name
+        ).read_bytes()
+
+    dates = date_index("2020-01-01", "2020-12-31")
+    expected = company_data(dates, n_companies=600, n_dates=20)
+    actual = read_company_returns(serial)
+    assert_series_equal(actual, expected, check_index_type=False)
+    assert company_summary(serial)["n_rows"].eq(20).all()
+    # a smaller dataset replaces the shards with a single file
+    write_dataset(serial, **{**params, "n_companies": 200})
+    assert path.is_file()
+    assert len(read_company_returns(serial)) == 200 * 20
@@ -0,0 +1,107 @@
+import pandas as pd
+import pytest
+from pandas._testing import assert_series_equal
+
+from etl_pipeline_example.create_dataset import (
+    company_data,
+    date_index,
+    returns_data,
+)
+from etl_pipeline_example.dataset import (
+    DatasetFormat,
+    company_returns_series,
+    company_returns_table,
+    company_summary,
+    dataset_paths,
+    detect_format,
+    is_sorted,
+    read_company_returns,
+    read_market_returns,
+    write_returns,
+)
+
+
+@pytest.fixture(scope="module")
+def returns() -> tuple[pd.Series, pd.Series]:
+    dates = date_index("2022-01-01", "2022-12-31")
+    return company_data(dates, n_companies=20, n_dates=100), returns_data(dates)
+
+
+@pytest.mark.parametrize("fmt", list(DatasetFormat))
+def test_round_trip(tmp_path, returns, fmt):
+    comp, market = returns
+    assert detect_format(tmp_path) is None
+    assert write_returns(comp, market, tmp_path, fmt) == dataset_paths(
+        tmp_path, fmt
+    )
+    assert detect_format(tmp_path) == fmt
+    actual_comp = read_company_returns(tmp_path)
+    assert_series_equal(
+        actual_comp.sort_index(), comp.sort_index(), check_index_type=False
+    )
+    assert_series_equal(read_market_returns(tmp_path), market, check_freq=False)
+
+
+@pytest.mark.parametrize("fmt", list(DatasetFormat))
+def test_read_filtered(tmp_path, returns, fmt):
+    comp, market = returns
+    write_returns(comp, market, tmp_path, fmt)
+    actual = read_company_returns(
+        tmp_path, companies=[3, 7], start="2022-03-01", end="2022-06-30"
+    )
+    ids = comp.index.get_level_values("companyid")
+    dates = comp.index.get_level_values("date")
+    expected = comp[
+        ids.isin([3, 7]) & (dates >= "2022-03-01") & (dates <= "2022-06-30")
+    ]
+    assert_series_equal(
+        actual.sort_index(), expected.sort_index(), check_index_type=False
+    )
+
+
+def test_columnar_preferred(tmp_path, returns):
+    comp, market = returns
+    write_returns(comp, market, tmp_path, DatasetFormat.PICKLE)
+    write_returns(comp, market, tmp_path, DatasetFormat.FEATHER)
+    assert detect_format(tmp_path) == DatasetFormat.FEATHER
+
+
+def test_missing_dataset(tmp_path):
+    with pytest.raises(FileNotFoundError, match="No company and market data"):
+        read_company_returns(tmp_path)
+
+
+def test_is_sorted(returns):
+    comp, _ = returns
+    assert is_sorted(comp.sort_index().index)
+    shuffled = comp.sample(frac=1, random_state=0)
+    assert is_sorted(shuffled.index) == shuffled.index.is_monotonic_increasing
+    by_date = comp.swaplevel().sort_index().swaplevel()
+    assert not is_sorted(by_date.index)
+
+
+def test_table_round_trip(returns):
+    comp, _ = returns
+    table = company_returns_table(comp)
+    assert str(table.schema.field("date").type) == "date32[day]"
+    actual = company_returns_series(table)
+    assert_series_equal(actual, comp.sort_index(), check_index_type=False)
+
+
+@pytest.mark.parametrize("fmt", [DatasetFormat.PARQUET, DatasetFormat.FEATHER])
+def test_company_summary(tmp_path, returns, fmt):
+    comp, market = returns
+    write_returns(comp, market, tmp_path, fmt)
+    summary = company_summary(tmp_path, companies=range(3, 8))
+    dates = comp.loc[3:7].reset_index("date")["date"].groupby(level=0)
+    assert list(summary.index) == [3, 4, 5, 6, 7]
+    assert (summary["n_rows"] == dates.size()).all()
+    assert (summary["first_date"] == dates.min()).all()
+    assert (summary["last_date"] == dates.max()).all()
+    assert company_summary(tmp_path, companies=[100]).empty
+
+
+def test_company_summary_pickle(tmp_path, returns):
+    write_returns(*returns, tmp_path, DatasetFormat.PICKLE)
+    with pytest.raises(NotImplementedError, match="Not a columnar format"):
+        company_summary(tmp_path)
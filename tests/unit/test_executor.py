@@ -0,0 +1,109 @@
+import os
+import threading
+import time
+
+import pytest
+
+from etl_pipeline_example.executor import (
+    BackgroundWriter,
+    map_ordered,
+    prefetch,
+)
+
+_offset = 0
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.001)
+
+
+def set_offset(offset):
+    global _offset
+    _offset = offset
+
+
+def add_offset(x):
+    return x + _offset, os.getpid()
+
+
+@pytest.mark.parametrize("n_workers", [1, 3])
+def test_map_ordered(n_workers):
+    results = list(
+        map_ordered(
+            add_offset,
+            range(20),
+            n_workers=n_workers,
+            initializer=set_offset,
+            initargs=(100,),
+            max_pending=4,
+        )
+    )
+    assert [r for r, _ in results] == list(range(100, 120))
+    pids = {pid for _, pid in results}
+    assert (os.getpid() in pids) == (n_workers == 1)
+
+
+def test_map_ordered_invalid_workers():
+    with pytest.raises(ValueError, match="Invalid number of workers"):
+        list(map_ordered(add_offset, range(3), n_workers=0))
+
+
+@pytest.mark.parametrize("depth", [0, 1, 3])
+def test_prefetch(depth):
+    produced = []
+
+    def items():
+        for i in range(10):
+            produced.append(i)
+            yield i, threading.get_ident()
+
+    # the queue is full, and one more item is waiting to be queued
+    ahead = depth + 1 if depth else 0
+    consumed = []
+    for i, thread_id in prefetch(items(), depth):
+        assert (thread_id == threading.get_ident()) == (depth == 0)
+        wait_for(lambda: len(produced) >= min(10, i + 1 + ahead))
+        assert len(produced) <= i + 1 + ahead
+        consumed.append(i)
+    assert consumed == list(range(10))
+
+
+def test_prefetch_error():
+    def items():
+        yield 1
+        raise OSError("read failed")
+
+    iterator = prefetch(items())
+    assert next(iterator) == 1
+    with pytest.raises(OSError, match="read failed"):
+        next(iterator)
+
+
+def test_prefetch_close():
+    iterator = prefetch(iter(range(100)), depth=2)
+    assert next(iterator) == 0
+    iterator.close()
+    assert not any(t.name == "prefetch" for t in threading.enumerate())
+
+
+@pytest.mark.parametrize("max_pending", [0, 2])
+def test_background_writer(max_pending):
+    written = []
+    with BackgroundWriter(written.append, max_pending) as writer:
+        for i in range(10):
+            writer.submit(i)
+    assert written == list(range(10))
+
+
+def test_background_writer_error():
+    def write(item):
+        if item == 3:
+            raise OSError("disk full")
+
+    writer = BackgroundWriter(write)
+    with pytest.raises(OSError, match="disk full"):
+        for i in range(10):
+            writer.submit(i)
+        writer.close()
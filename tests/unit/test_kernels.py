@@ -0,0 +1,193 @@
+import importlib.util
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from etl_pipeline_example.kernels import (
+    Kernel,
+    block_rows,
+    window_comoments,
+    window_comoments_loop,
+)
+
+HAS_NUMBA = importlib.util.find_spec("numba") is not None
+
+
+def random_returns(
+    n_dates: int, n_companies: int, nan_ratio: float = 0.0, trend: float = 0.0
+) -> tuple[np.ndarray, np.ndarray]:
+    """Create company and market returns, around a trending level."""
+    rng = np.random.default_rng(5)
+    level = trend * np.linspace(0, 1, n_dates)
+    x = level[:, np.newaxis] + rng.normal(0, 0.01, (n_dates, n_companies))
+    y = level + rng.normal(0, 0.01, n_dates)
+    x[rng.random(x.shape) < nan_ratio] = np.nan
+    y[rng.random(n_dates) < nan_ratio] = np.nan
+    # a company listed late, with missing returns at first
+    x[: n_dates // 3, 0] = np.nan
+    return x, y
+
+
+def exact_corr(x: np.ndarray, y: np.ndarray, window: int) -> np.ndarray:
+    """Calculate correlations window by window, with two passes each."""
+    res = np.full(x.shape, np.nan)
+    for t in range(window - 1, len(x)):
+        for j in range(x.shape[1]):
+            wx, wy = x[t - window + 1 : t + 1, j], y[t - window + 1 : t + 1]
+            valid = ~(np.isnan(wx) | np.isnan(wy))
+            if valid.sum() > 1:
+                dx = wx[valid] - wx[valid].mean()
+                dy = wy[valid] - wy[valid].mean()
+                res[t, j] = dx @ dy / np.sqrt((dx @ dx) * (dy @ dy))
+    return res
+
+
+def corr(moments: tuple) -> np.ndarray:
+    n, cxy, cxx, cyy = moments
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return cxy / np.sqrt(np.maximum(cxx, 0) * np.maximum(cyy, 0))
+
+
+@pytest.mark.parametrize("window", [1, 5, 40])
+def test_window_comoments_matches_pandas(window):
+    x, y = random_returns(300, 3, nan_ratio=0.1)
+    numpy_moments = window_comoments(x, y, [window], Kernel.NUMPY, 64)
+    loop_moments = window_comoments_loop(x, y, window, 64)
+    for j in range(x.shape[1]):
+        pairs = pd.DataFrame({"x": x[:, j], "y": y})
+        pairs[pairs.isna().any(axis=1)] = np.nan
+        rolling = pairs["x"].rolling(window, min_periods=0)
+        expected_n = rolling.count().to_numpy()
+        expected_cov = rolling.cov(pairs["y"]).to_numpy() * (expected_n - 1)
+        for n, cxy, cxx, cyy in (numpy_moments[window], loop_moments):
+            np.testing.assert_array_equal(n[:, j], expected_n)
+            # the late company has empty windows, without moments
+            for moment in (cxy, cxx, cyy):
+                np.testing.assert_array_equal(
+                    np.isnan(moment[:, j]), expected_n == 0
+                )
+            has_cov = expected_n > 1
+            np.testing.assert_allclose(
+                cxy[has_cov, j], expected_cov[has_cov], rtol=0, atol=1e-15
+            )
+
+
+def test_window_comoments_long_history():
+    """Check that rounding errors don't build up over 6000 dates."""
+    x, y = random_returns(6000, 2, nan_ratio=0.02, trend=10.0)
+    window = 20
+    expected = exact_corr(x, y, window)
+    has_corr = ~np.isnan(expected)
+    numpy_corr = corr(window_comoments(x, y, [window], Kernel.NUMPY)[window])
+    loop_corr = corr(window_comoments_loop(x, y, window))
+    for actual in (numpy_corr, loop_corr):
+        assert np.abs(actual - expected)[has_corr].max() < 1e-6
+
+
+def test_window_comoments_shared_windows():
+    x, y = random_returns(500, 2, nan_ratio=0.05)
+    shared = window_comoments(x, y, [10, 100], Kernel.NUMPY, 128)
+    for window in (10, 100):
+        alone = window_comoments(x, y, [window], Kernel.NUMPY, 128)[window]
+        for actual, expected in zip(shared[window], alone):
+            np.testing.assert_allclose(actual, expected, atol=1e-15)
+
+
+def test_window_comoments_row_ranges():
+    x, y = random_returns(1000, 2, nan_ratio=0.05)
+    x32 = x.astype(np.float32)
+    windows = [10, 100]
+    # float32 returns are accumulated in float64
+    expected = window_comoments(
+        x32.astype(np.float64), y, windows, Kernel.NUMPY, 128
+    )
+    n_block = block_rows(windows, 128)
+    assert n_block == 400
+    parts = [
+        window_comoments(
+            x32, y, windows, Kernel.NUMPY, 128, start=start, stop=start + n
+        )
+        for start, n in [(0, 400), (400, 400), (800, 200)]
+    ]
+    for window in windows:
+        for i, moment in enumerate(expected[window]):
+            actual = np.concatenate([part[window][i] for part in parts])
+            assert actual.dtype == np.float64
+            np.testing.assert_array_equal(actual, moment)
+
+
+@pytest.mark.skipif(HAS_NUMBA, reason="numba is installed")
+def test_window_comoments_without_numba():
+    x, y = random_returns(50, 2)
+    expected = window_comoments(x, y, [10], Kernel.NUMPY)[10]
+    actual = window_comoments(x, y, [10], Kernel.AUTO)[10]
+    for a, b in zip(actual, expected):
+        np.testing.assert_array_equal(a, b)
+    with pytest.raises(ImportError, match="numba"):
+        window_comoments(x, y, [10], Kernel.NUMBA)
+
+
+@pytest.mark.skipif(not HAS_NUMBA, reason="numba is not installed")
+def test_window_comoments_numba():
+    x, y = random_returns(500, 3, nan_ratio=0.05)
+    expected = window_comoments(x, y, [10, 100], Kernel.NUMPY)
+    actual = window_comoments(x, y, [10, 100], Kernel.NUMBA)
+    for window in (10, 100):
+        for a, b in zip(actual[window], expected[window]):
+            np.testing.assert_allclose(a, b, atol=1e-12)
+
+
+def loop_kernel(x, y, windows, recompute_rows):
+    return {w: window_comoments_loop(x, y, w, recompute_rows) for w in windows}
+
+
+def numba_kernel(x, y, windows, recompute_rows):
+    return window_comoments(x, y, windows, Kernel.NUMBA, recompute_rows)
+
+
+def numpy_kernel(x, y, windows, recompute_rows):
+    return window_comoments(x, y, windows, Kernel.NUMPY, recompute_rows)
+
+
+@pytest.mark.parametrize(
+    "kernel",
+    [
+        numpy_kernel,
+        loop_kernel,
+        pytest.param(
+            numba_kernel,
+            marks=pytest.mark.skipif(
+                not HAS_NUMBA, reason="numba is not installed"
+            ),
+        ),
+    ],
+)
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+def test_window_comoments_constant_stretch(kernel, dtype):
+    x, y = random_returns(400, 3, nan_ratio=0.05)
+    x, y = x.astype(dtype), y.astype(dtype)
+    # zero filled and constant company returns, and a constant market
+    x[150:250, 1] = 0.0
+    x[150:250, 2] = 0.01
+    y[300:] = 0.02
+    # valid rows just before and after the stretches
+    x[[149, 250], 1:] = y[[149, 250, 299]] = -0.01
+    window = 20
+    n, cxy, cxx, cyy = kernel(x, y, [window], 64)[window]
+    # windows within the stretches, whatever their missing values
+    const_x = np.zeros(x.shape, dtype=bool)
+    const_x[169:250, 1:] = True
+    const_y = np.zeros(x.shape, dtype=bool)
+    const_y[319:] = True
+    has_rows = n > 0
+    np.testing.assert_array_equal(cxx[const_x & has_rows], 0.0)
+    np.testing.assert_array_equal(cyy[const_y & has_rows], 0.0)
+    np.testing.assert_array_equal(cxy[(const_x | const_y) & has_rows], 0.0)
+    # windows overlapping the stretches still vary
+    assert (cxx[168, 1:] > 0).all() and (cxx[250, 1:] > 0).all()
+    assert (cyy[318] > 0).all()
+    # the numpy kernel finds the same constant windows
+    expected = numpy_kernel(x, y, [window], 64)[window]
+    for actual, moment in zip((n, cxy, cxx, cyy), expected):
+        np.testing.assert_allclose(actual, moment, rtol=0, atol=1e-12)
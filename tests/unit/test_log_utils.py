@@ -1,16 +1,23 @@
+import json
 import logging
+import tracemalloc
 from typing import Any
 
+import numpy as np
 import pandas as pd
 
-from etl_pipeline_example.log_utils import log_mem_usage, setup_logging
+from etl_pipeline_example.log_utils import (
+    RunProfiler,
+    log_mem_usage,
+    setup_logging,
+)
 
 
 def test_setup_logging(monkeypatch):
     called = False
     args_match = False
     expected_args = {
-        "level": logging.DEBUG,
+        "level": logging.INFO,
         "format": Any,
         "style": "{",
         "handlers": Any,
@@ -71,3 +78,35 @@ def test_log_mem_usage_df(monkeypatch, caplog):
     with caplog.at_level(logging.WARNING):
         log_mem_usage(test_logger, df, "test df", level=logging.WARNING)
     assert caplog.record_tuples == [expected_log_tuple]
+
+
+def test_run_profiler(tmp_path):
+    profiler = RunProfiler(trace_memory=True)
+    with profiler.stage("alloc"):
+        data = np.ones(1_000_000)
+    del data
+    items = list(profiler.iterate("produce", iter(range(3))))
+    assert items == [0, 1, 2]
+    alloc, produce = profiler.stages.values()
+    assert (alloc.name, alloc.calls) == ("alloc", 1)
+    assert alloc.wall_seconds > 0
+    assert alloc.peak_rss_mb > 0
+    assert alloc.traced_peak_mb >= 8
+    assert (produce.name, produce.calls) == ("produce", 3)
+    assert not tracemalloc.is_tracing()
+
+    path = tmp_path / "report/run.json"
+    profiler.write_report(path)
+    report = json.loads(path.read_text())
+    assert report["wall_seconds"] >= alloc.wall_seconds
+    assert [s["name"] for s in report["stages"]] == ["alloc", "produce"]
+
+
+def test_run_profiler_disabled(tmp_path):
+    profiler = RunProfiler(enabled=False)
+    with profiler.stage("stage"):
+        pass
+    assert list(profiler.iterate("produce", range(2))) == [0, 1]
+    assert profiler.stages == {}
+    profiler.write_report(tmp_path / "run.json")
+    assert not tmp_path.joinpath("run.json").exists()
@@ -0,0 +1,159 @@
+import argparse
+import json
+import re
+import subprocess
+import sys
+from typing import Dict
+
+import pandas as pd
+import pytest
+
+from etl_pipeline_example.__main__ import main, parse_bytes
+
+# startup budget of the command line, far below the time to import pandas
+IMPORT_BUDGET_US = 250_000
+
+
+def import_times(*args: str) -> Dict[str, int]:
+    """Run python with some arguments, and get the cumulative import times."""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    times = {}
+    for line in stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \|\s+(\S+)", line)
+        if match:
+            times[match[2]] = int(match[1])
+    return times
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [("1000", 1000), ("2G", 2**31), ("512MiB", 2**29), ("1.5k", 1536)],
+)
+def test_parse_bytes(value, expected):
+    assert parse_bytes(value) == expected
+
+
+def test_parse_bytes_invalid():
+    with pytest.raises(argparse.ArgumentTypeError, match="Invalid size"):
+        parse_bytes("2 apples")
+
+
+def test_generate_and_run(tmp_path):
+    workdir = tmp_path / "work"
+    assert (
+        main(
+            [
+                "generate",
+                str(workdir),
+                "--n-companies",
+                "6",
+                "--n-dates",
+                "300",
+                "--history-start",
+                "2020-01-01",
+                "--history-end",
+                "2021-12-31",
+            ]
+        )
+        == 0
+    )
+    report = tmp_path / "report.json"
+    assert (
+        main(
+            [
+                "run",
+                str(workdir),
+                "--window",
+                "63",
+                "--statistics",
+                "corr",
+                "beta",
+                "--output-format",
+                "parquet",
+                "--report",
+                str(report),
+                "--log-level",
+                "WARNING",
+            ]
+        )
+        == 0
+    )
+    results = pd.read_parquet(workdir / "store/result_corr.parquet")
+    assert list(results.columns) == ["corr_63", "beta_63"]
+    assert results.index.get_level_values("companyid").nunique() == 6
+    assert json.loads(report.read_text())["stages"]
+
+
+def test_query(tmp_path, capsys):
+    with pytest.raises(SystemExit, match="No indexed results"):
+        main(["query", str(tmp_path)])
+    main(
+        [
+            "generate",
+            str(tmp_path),
+            "--n-companies",
+            "4",
+            "--n-dates",
+            "300",
+            "--history-start",
+            "2020-01-01",
+            "--history-end",
+            "2021-12-31",
+        ]
+    )
+    main(["run", str(tmp_path), "--window", "63", "--output-format", "indexed"])
+    capsys.readouterr()
+    assert (
+        main(
+            ["query", str(tmp_path), "--companies", "2", "--end", "2021-06-30"]
+        )
+        == 0
+    )
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == "companyid,date,returns"
+    assert lines[1].startswith("2,") and lines[-1].startswith("2,2021-06-30,")
+
+
+def test_run_by_default(tmp_path):
+    # the run command can be omitted, and creates data when there is none
+    with pytest.raises(SystemExit, match="Not a directory"):
+        main([str(tmp_path / "missing")])
+    with pytest.raises(SystemExit):
+        main(["run", str(tmp_path), "--engine", "numpy"])
+
+
+def test_import_time():
+    times = import_times("-c", "import etl_pipeline_example.__main__")
+    assert not {"numpy", "pandas", "pyarrow"} & times.keys()
+    assert times["etl_pipeline_example.__main__"] < IMPORT_BUDGET_US
+
+
+@pytest.mark.parametrize("module", ["pipeline", "create_dataset"])
+def test_command_module_import_time(module):
+    """Check the import time of command modules, beyond the libraries."""
+    # the calculations need numpy, pandas and pyarrow anyway
+    times = import_times(
+        "-c",
+        f"import numpy, pandas, pyarrow; import etl_pipeline_example.{module}",
+    )
+    assert times[f"etl_pipeline_example.{module}"] < IMPORT_BUDGET_US
+
+
+@pytest.mark.parametrize(
+    "command, used, unused",
+    [
+        ("generate", "create_dataset", ["pipeline", "store", "bench"]),
+        ("run", "pipeline", ["create_dataset", "bench"]),
+    ],
+)
+def test_command_imports(command, used, unused):
+    """Check that commands don't import the modules of other commands."""
+    times = import_times("-m", "etl_pipeline_example", command, "--help")
+    assert f"etl_pipeline_example.{used}" in times
+    for module in unused:
+        assert f"etl_pipeline_example.{module}" not in times
@@ -0,0 +1,70 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+from pandas._testing import assert_series_equal
+
+from etl_pipeline_example.create_dataset import date_index, returns_data
+from etl_pipeline_example.market import MarketSeries
+
+
+def market_returns() -> pd.Series:
+    returns = returns_data(date_index("2021-01-01", "2022-12-31"))
+    # a missing business day
+    return pd.to_numeric(returns.drop(returns.index[10]), downcast="float")
+
+
+def test_market_series_round_trip():
+    returns = market_returns()
+    market = MarketSeries.from_series(returns)
+    assert market.values.dtype == np.float32
+    assert len(market) == len(returns) + 1
+    assert np.isnan(market.values[10])
+    assert_series_equal(market.to_series().dropna(), returns)
+
+
+def test_market_series_weekends():
+    returns = pd.Series(
+        [1.0, 2.0, 3.0],
+        index=pd.DatetimeIndex(
+            ["2023-02-17", "2023-02-18", "2023-02-20"], name="date"
+        ),
+    )
+    market = MarketSeries.from_series(returns)
+    np.testing.assert_array_equal(market.values, [1.0, 3.0])
+
+
+def test_market_series_reindex():
+    returns = market_returns()
+    market = MarketSeries.from_series(returns)
+    for dates in (
+        returns.index[5:300],
+        pd.bdate_range("2020-12-01", "2021-03-01"),
+        pd.DatetimeIndex(
+            ["2022-12-30", "2021-06-05", "2021-06-07", "2030-01-01"]
+        ),
+    ):
+        np.testing.assert_array_equal(
+            market.reindex(dates), returns.reindex(dates).to_numpy()
+        )
+    # contiguous days inside the series are a view
+    window = market.window(market.first_day + 5, 100)
+    assert np.shares_memory(window, market.values)
+    np.testing.assert_array_equal(
+        market.window(market.first_day - 2, 3)[:2], np.nan
+    )
+
+
+def test_market_series_memory_map(tmp_path):
+    market = MarketSeries.from_series(market_returns())
+    path = tmp_path / "market.arrow"
+    market.write(path)
+    mapped = MarketSeries.open(path)
+    assert mapped.first_day == market.first_day
+    np.testing.assert_array_equal(mapped.values, market.values)
+    assert not mapped.values.flags.writeable
+    # mapped series are pickled as their path
+    assert len(pickle.dumps(mapped)) < 500 < len(pickle.dumps(market))
+    unpickled = pickle.loads(pickle.dumps(mapped))
+    assert unpickled.path == path
+    np.testing.assert_array_equal(unpickled.values, market.values)
@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+from pandas._testing import assert_series_equal
+
+from etl_pipeline_example.create_dataset import company_data, date_index
+from etl_pipeline_example.panel import CompanyPanel
+
+
+def business_day_returns() -> pd.Series:
+    returns = company_data(date_index("2021-01-01", "2022-12-31"), 5, 120)
+    return pd.to_numeric(returns, downcast="float")
+
+
+def test_panel_series_round_trip():
+    returns = business_day_returns()
+    panel = CompanyPanel.from_series(returns.sample(frac=1, random_state=3))
+    assert panel.n_companies == 5
+    assert len(panel) == len(returns)
+    assert panel.values.dtype == np.float32
+    assert panel.days.dtype == np.int32
+    np.testing.assert_array_equal(panel.counts, [120] * 5)
+    assert_series_equal(panel.to_series(), returns, check_index_type=False)
+
+
+def test_panel_table_round_trip():
+    returns = business_day_returns()
+    panel = CompanyPanel.from_series(returns)
+    table = panel.to_table()
+    assert table.schema.field("date").type == pa.date32()
+    assert table.schema.field("companyid").type == pa.int32()
+    # rows in any order are sorted by company and date
+    shuffled = table.take(np.random.default_rng(3).permutation(len(table)))
+    actual = CompanyPanel.from_table(shuffled)
+    for name in CompanyPanel.__slots__:
+        np.testing.assert_array_equal(
+            getattr(actual, name), getattr(panel, name)
+        )
+
+
+def test_panel_companies():
+    panel = CompanyPanel.from_series(business_day_returns())
+    days, values = panel.company(2)
+    assert np.shares_memory(values, panel.values)
+    np.testing.assert_array_equal(values, panel.values[240:360])
+    part = panel.companies(1, 3)
+    assert np.shares_memory(part.days, panel.days)
+    np.testing.assert_array_equal(part.company_ids, panel.company_ids[1:3])
+    np.testing.assert_array_equal(part.indptr, [0, 120, 240])
+    np.testing.assert_array_equal(part.company(1)[0], days)
+
+
+def test_panel_memory():
+    returns = business_day_returns()
+    panel = CompanyPanel.from_series(returns)
+    # int32 offsets and float32 values, plus a pointer per company
+    assert panel.nbytes == len(panel) * 8 + panel.n_companies * 16 + 8
+    assert panel.memory_usage() < returns.memory_usage(deep=True)
+
+
+def test_panel_invalid():
+    with pytest.raises(ValueError, match="companies"):
+        CompanyPanel(np.array([1, 2]), np.array([0, 1]), [1], [0.0])
+    with pytest.raises(ValueError, match="rows"):
+        CompanyPanel(np.array([1]), np.array([0, 2]), [1], [0.0])
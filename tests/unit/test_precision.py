@@ -0,0 +1,69 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+from etl_pipeline_example.precision import (
+    precision_report,
+    sample_companies,
+    to_value_dtype,
+    value_dtype,
+    write_precision_report,
+)
+
+
+def test_value_dtype():
+    assert value_dtype(np.float16) == np.float32
+    assert value_dtype(np.int64) == np.float64
+    assert value_dtype(np.float64) == np.float64
+    values = np.array([1e10 + 0.123, np.nan])
+    # unlike pd.to_numeric, the dtype doesn't depend on the values
+    assert pd.to_numeric(values, downcast="float").dtype == np.float64
+    assert to_value_dtype(values).dtype == np.float32
+    series = pd.Series(values.astype(np.float32))
+    assert to_value_dtype(series) is not series
+    assert np.shares_memory(to_value_dtype(series), series)
+
+
+def test_sample_companies():
+    ids = np.arange(10, 1010, 10)
+    np.testing.assert_array_equal(sample_companies(ids[:5]), ids[:5])
+    sample = sample_companies(ids, 8)
+    assert len(sample) == 8
+    assert sample[0] == ids[0] and sample[-1] == ids[-1]
+    assert np.all(np.diff(sample) > 0)
+
+
+def test_precision_report(tmp_path):
+    reference = pd.DataFrame(
+        {"corr_5": [np.nan, 0.5, -0.25, 0.0], "vol_5": [np.nan, 1, 2, 4]}
+    )
+    actual = reference.astype(np.float32)
+    actual.loc[3, "vol_5"] = np.nan
+    actual.loc[1, "corr_5"] = 0.5001
+    actual.loc[2, "corr_5"] = -np.inf
+    report = precision_report(actual, reference)
+    assert report["corr_5"]["n_values"] == 2
+    assert report["corr_5"]["n_missing"] == 0
+    assert report["corr_5"]["n_infinite"] == 1
+    np.testing.assert_allclose(
+        report["corr_5"]["max_abs_error"], 1e-4, rtol=1e-3
+    )
+    np.testing.assert_allclose(
+        report["corr_5"]["max_rel_error"], 2e-4, rtol=1e-3
+    )
+    assert report["vol_5"] == {
+        "n_values": 2,
+        "max_abs_error": 0.0,
+        "max_rel_error": 0.0,
+        "n_missing": 1,
+        "n_infinite": 0,
+    }
+
+    path = tmp_path / "store" / "precision.json"
+    write_precision_report(path, report, np.array([3, 7]))
+    data = json.loads(path.read_text())
+    assert data["value_dtype"] == "float32"
+    assert data["moment_dtype"] == "float64"
+    assert data["companies"] == [3, 7]
+    assert data["statistics"] == report
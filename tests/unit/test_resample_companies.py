@@ -1,14 +1,19 @@
 import numpy as np
 import pandas as pd
+import pytest
 from pandas._testing import assert_series_equal
 
+from etl_pipeline_example.create_dataset import company_data, date_index
+from etl_pipeline_example.panel import CompanyPanel
 from etl_pipeline_example.pipeline import (
+    Engine,
     ResampleStrategy,
     resample_company_returns,
 )
 
 
-def test_resample_company_single():
+@pytest.mark.parametrize("engine", list(Engine))
+def test_resample_company_single(engine):
     """Check that resampling returns for a single company works."""
     company_idx_names = ["companyid", "date"]
     company_dates = [
@@ -23,7 +28,7 @@ def test_resample_company_single():
         [[0], pd.date_range("2023-02-13", "2023-02-23", freq="B")],
         names=company_idx_names,
     )
-    company_data = pd.Series(
+    returns = pd.Series(
         name="returns", data=[0.05, -0.03, 0.02], index=company_idx
     )
     expected = pd.Series(
@@ -42,13 +47,13 @@ def test_resample_company_single():
         index=company_resampled_idx,
     )
     actual = resample_company_returns(
-        company_data, target_freq="B", strategy=ResampleStrategy.NA_FILL
+        returns, "B", ResampleStrategy.NA_FILL, engine
     )
     assert_series_equal(actual, expected)
 
     expected2 = expected.fillna(0)
     actual2 = resample_company_returns(
-        company_data, target_freq="B", strategy=ResampleStrategy.ZERO_FILL
+        returns, "B", ResampleStrategy.ZERO_FILL, engine
     )
     assert_series_equal(actual2, expected2)
 
@@ -68,8 +73,70 @@ def test_resample_company_single():
         index=company_resampled_idx,
     )
     actual3 = resample_company_returns(
-        company_data,
-        target_freq="B",
-        strategy=ResampleStrategy.INTERPOLATE_LINEAR,
+        returns, "B", ResampleStrategy.INTERPOLATE_LINEAR, engine
     )
     assert_series_equal(actual3, expected3, atol=1e-3)
+
+
+@pytest.mark.parametrize("strategy", list(ResampleStrategy))
+def test_resample_dense_matches_pandas(strategy):
+    dates = date_index("2020-01-01", "2022-12-31")
+    returns = company_data(dates, n_companies=20, n_dates=200)
+    returns = pd.to_numeric(returns, downcast="float")
+    # add some weekend returns, to be summed with the friday ones
+    weekend = returns.iloc[::50]
+    weekend.index = pd.MultiIndex.from_arrays(
+        [
+            weekend.index.get_level_values("companyid"),
+            weekend.index.get_level_values("date").shift(2, freq="D"),
+        ],
+        names=returns.index.names,
+    )
+    returns = pd.concat([returns, weekend]).sample(frac=1, random_state=3)
+    expected = resample_company_returns(returns, "B", strategy)
+    actual = resample_company_returns(returns, "B", strategy, Engine.DENSE)
+    assert_series_equal(actual, expected, check_index_type=False)
+
+
+@pytest.mark.parametrize("strategy", list(ResampleStrategy))
+def test_resample_panel(strategy):
+    returns = company_data(date_index("2020-01-01", "2021-12-31"), 10, 150)
+    returns = pd.to_numeric(returns, downcast="float")
+    panel = CompanyPanel.from_series(returns)
+    actual = resample_company_returns(panel, "B", strategy, Engine.DENSE)
+    assert isinstance(actual, CompanyPanel)
+    expected = resample_company_returns(returns, "B", strategy)
+    assert_series_equal(actual.to_series(), expected, check_index_type=False)
+    # the pandas engine resamples panels to series
+    actual = resample_company_returns(panel, "B", strategy, Engine.PANDAS)
+    assert_series_equal(actual, expected)
+
+
+def test_resample_dense_interpolate_by_company():
+    """Check that interpolation never uses values of a different company."""
+    dates = pd.to_datetime(["2023-02-13", "2023-02-15", "2023-02-17"])
+    idx = pd.MultiIndex.from_arrays(
+        [[0, 0, 1, 1, 1], dates[[0, 2, 0, 1, 2]]], names=["companyid", "date"]
+    )
+    returns = pd.Series([1.0, 3.0, np.NaN, 2.0, np.NaN], index=idx)
+    actual = resample_company_returns(
+        returns, "B", ResampleStrategy.INTERPOLATE_LINEAR, Engine.DENSE
+    )
+    expected = pd.Series(
+        [1.0, 1.5, 2.0, 2.5, 3.0, np.NaN, np.NaN, 2.0, 2.0, 2.0],
+        index=pd.MultiIndex.from_product(
+            [[0, 1], pd.bdate_range("2023-02-13", "2023-02-17")],
+            names=["companyid", "date"],
+        ),
+    )
+    assert_series_equal(actual, expected)
+
+
+def test_resample_dense_other_freq():
+    """Check that the dense engine falls back to pandas for other freqs."""
+    returns = company_data(date_index("2022-01-01", "2022-12-31"), 3, 100)
+    expected = resample_company_returns(returns, "W", ResampleStrategy.NA_FILL)
+    actual = resample_company_returns(
+        returns, "W", ResampleStrategy.NA_FILL, Engine.DENSE
+    )
+    assert_series_equal(actual, expected)
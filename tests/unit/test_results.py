@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pandas._testing import assert_frame_equal
+
+from etl_pipeline_example.results import ResultStore
+from etl_pipeline_example.sinks import OutputFormat, result_sink
+
+
+@pytest.fixture
+def results() -> pd.DataFrame:
+    index = pd.MultiIndex.from_product(
+        [[3, 5, 8, 13], pd.bdate_range("2023-02-13", periods=6, name="date")],
+        names=["companyid", "date"],
+    )
+    return pd.DataFrame(
+        {
+            "corr_5": np.arange(len(index)) / 7,
+            "beta_5": np.arange(len(index)) / 3,
+        },
+        index=index,
+        dtype="float32",
+    )
+
+
+def write(path, chunks, append=False):
+    with result_sink(path, "res", OutputFormat.INDEXED, append) as sink:
+        for chunk in chunks:
+            sink.write(chunk)
+    return sink
+
+
+def test_indexed_sink(tmp_path, results):
+    # chunks split a company, and may not be sorted
+    chunks = [results.iloc[:9], results.iloc[9:9], results.iloc[9:][::-1]]
+    sink = write(tmp_path, chunks)
+    assert sink.path == tmp_path / "res"
+    assert sink.n_rows == len(results)
+    with ResultStore(sink.path) as store:
+        assert len(store) == len(results)
+        np.testing.assert_array_equal(store.company_ids, [3, 5, 8, 13])
+        assert_frame_equal(store.get_corr(store.company_ids), results)
+        csv_path = tmp_path / "res.csv"
+        assert store.to_csv(csv_path) == len(results)
+        assert csv_path.read_text() == results.to_csv()
+
+
+@pytest.mark.parametrize(
+    "company_ids, start, end",
+    [
+        (5, None, None),
+        ([13, 3], "2023-02-14", "2023-02-16"),
+        ([5, 8], "2023-02-16", None),
+        ([8], None, "2023-02-13"),
+        ([3, 4], "2023-02-18", "2023-02-19"),
+        ([99], None, None),
+    ],
+)
+def test_result_store_lookup(tmp_path, results, company_ids, start, end):
+    sink = write(tmp_path, [results.iloc[:9], results.iloc[9:]])
+    ids = np.atleast_1d(company_ids)
+    expected = results[results.index.get_level_values("companyid").isin(ids)]
+    expected = expected.loc[(slice(None), slice(start, end)), :]
+    with ResultStore(sink.path) as store:
+        actual = store.get_corr(company_ids, start, end)
+    assert_frame_equal(actual, expected, check_index_type=not expected.empty)
+
+
+def test_result_store_append(tmp_path, results):
+    dates = results.index.get_level_values("date")
+    old, new = results[dates < "2023-02-16"], results[dates >= "2023-02-16"]
+    write(tmp_path, [old.iloc[:6], old.iloc[6:]])
+    sink = write(tmp_path, [new], append=True)
+    assert sorted(p.name for p in sink.path.glob("segment-*")) == [
+        "segment-0.arrow",
+        "segment-1.arrow",
+    ]
+    with ResultStore(sink.path) as store:
+        assert_frame_equal(store.get_corr([3, 5, 8, 13]), results)
+        assert_frame_equal(
+            store.get_corr(8, "2023-02-15", "2023-02-16"),
+            results.loc[(8, slice("2023-02-15", "2023-02-16")), :],
+        )
+    # a new run replaces all the segments
+    sink = write(tmp_path, [new])
+    assert len(list(sink.path.glob("segment-*"))) == 1
+    with ResultStore(sink.path) as store:
+        assert_frame_equal(store.get_corr([3, 5, 8, 13]), new)
+
+
+def test_result_store_missing(tmp_path):
+    with pytest.raises(FileNotFoundError, match="No indexed results"):
+        ResultStore(tmp_path)
+    with ResultStore(write(tmp_path, []).path) as store:
+        assert len(store) == 0
+        assert store.get_corr([1]).empty
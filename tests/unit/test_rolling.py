@@ -0,0 +1,332 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pandas._testing import assert_frame_equal, assert_series_equal
+
+from etl_pipeline_example import rolling
+from etl_pipeline_example.create_dataset import date_index
+from etl_pipeline_example.kernels import Kernel, compiled_comoments
+from etl_pipeline_example.market import MarketSeries
+from etl_pipeline_example.panel import CompanyPanel
+from etl_pipeline_example.pipeline import (
+    Engine,
+    ResampleStrategy,
+    resample_company_returns,
+    rolling_corr,
+    rolling_stats,
+)
+from etl_pipeline_example.rolling import (
+    CORR_TOLERANCE,
+    Statistic,
+    rolling_corr_dense,
+    rolling_stats_dense,
+    rolling_stats_matrix,
+    stat_column,
+)
+
+
+def random_company_data(
+    n_companies: int = 8,
+    n_dates: int = 300,
+    nan_ratio: float = 0.0,
+    dtype: str = "float32",
+) -> tuple[pd.DataFrame, pd.Series]:
+    """Create company data with uneven date ranges, and the market data."""
+    rng = np.random.default_rng(3)
+    dates = pd.bdate_range("2010-01-01", periods=n_dates, name="date")
+    companies = []
+    for i in range(n_companies):
+        start = rng.integers(0, n_dates // 3)
+        end = rng.integers(n_dates // 2, n_dates)
+        values = rng.normal(0, 0.01, end - start).astype(dtype)
+        values[rng.random(len(values)) < nan_ratio] = np.nan
+        idx = pd.MultiIndex.from_product(
+            [[i], dates[start:end]], names=["companyid", "date"]
+        )
+        companies.append(pd.Series(values, index=idx, name="returns"))
+    market = pd.Series(
+        rng.normal(0, 0.01, n_dates).astype(dtype),
+        index=dates,
+        name="returns",
+    )
+    return pd.concat(companies).to_frame(), market
+
+
+def assert_matches_pandas(
+    actual: pd.DataFrame, expected: pd.DataFrame, atol: float = CORR_TOLERANCE
+) -> None:
+    """Check that statistics are missing for the same windows, and close."""
+    assert_frame_equal(actual.isna(), expected.isna())
+    assert_frame_equal(actual, expected, check_exact=False, atol=atol)
+
+
+def test_rolling_corr_dense_trivial():
+    dates = date_index("2010-01-01", "2010-01-31")
+    n_dates = len(dates)
+    company_idx = pd.MultiIndex.from_product(
+        [[0, 1], dates], names=["companyid", "date"]
+    )
+    company_values = [*range(n_dates), *range(n_dates, 0, -1)]
+    company_returns = pd.Series(
+        name="returns", data=company_values, index=company_idx
+    )
+    market_returns = pd.Series(
+        name="returns", index=dates, data=list(range(n_dates))
+    )
+    actual = rolling_corr_dense(company_returns, market_returns, 5)
+    expected_data = [np.NaN] * 4 + [1] * 17 + [np.NaN] * 4 + [-1] * 17
+    expected = pd.Series(name="returns", data=expected_data, index=company_idx)
+    assert_series_equal(actual, expected)
+
+
+@pytest.mark.parametrize("window", [3, 20, 100])
+@pytest.mark.parametrize("nan_ratio", [0.0, 0.02])
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+def test_rolling_corr_dense_matches_pandas(window, nan_ratio, dtype):
+    company_data, market_data = random_company_data(
+        nan_ratio=nan_ratio, dtype=dtype
+    )
+    actual = rolling_corr_dense(company_data, market_data, window)
+    expected = rolling_corr(company_data, market_data, window)
+    # pandas repeats each row for every company, missing in all but one copy
+    expected = expected.groupby(level=["companyid", "date"]).first()
+    if dtype == "float32":
+        # pandas calculates float64 correlations of float32 returns
+        assert actual.dtypes.eq(np.float32).all()
+        expected = expected.astype(np.float32)
+    assert_matches_pandas(actual, expected)
+
+
+def test_rolling_corr_dense_sorts_companies():
+    company_data, market_data = random_company_data(n_companies=3)
+    groups = [g for _, g in company_data.groupby(level="companyid")]
+    shuffled = pd.concat(reversed(groups))
+    actual = rolling_corr_dense(shuffled, market_data, 10)
+    expected = rolling_corr_dense(company_data, market_data, 10)
+    assert_frame_equal(actual, expected)
+
+
+def test_rolling_dense_market_series():
+    company_data, market_data = random_company_data(nan_ratio=0.02)
+    # a missing market day
+    market_data = market_data.drop(market_data.index[50])
+    market = MarketSeries.from_series(market_data)
+    assert_frame_equal(
+        rolling_corr_dense(company_data, market, 20),
+        rolling_corr_dense(company_data, market_data, 20),
+    )
+    panel = CompanyPanel.from_series(company_data["returns"])
+    statistics = list(Statistic)
+    assert_frame_equal(
+        rolling_stats_dense(panel, market, [5, 20], statistics),
+        rolling_stats_dense(panel, market_data, [5, 20], statistics),
+    )
+
+
+def test_rolling_corr_dense_irregular_dates():
+    company_data, market_data = random_company_data(n_companies=2)
+    # drop a date from the first company only
+    irregular = company_data.drop(company_data.index[10])
+    with pytest.raises(ValueError, match="not contiguous"):
+        rolling_corr_dense(irregular, market_data, 10)
+    expected = rolling_corr(irregular, market_data, 10)
+    actual = rolling_corr(irregular, market_data, 10, engine=Engine.DENSE)
+    assert_frame_equal(actual, expected)
+
+
+@pytest.mark.parametrize("nan_ratio", [0.0, 0.02])
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+def test_rolling_stats_dense_matches_pandas(nan_ratio, dtype):
+    company_data, market_data = random_company_data(
+        nan_ratio=nan_ratio, dtype=dtype
+    )
+    windows, statistics = [3, 20, 100], list(Statistic)
+    expected = rolling_stats(
+        company_data["returns"], market_data, windows, statistics
+    )
+    actual = rolling_stats_dense(
+        company_data["returns"], market_data, windows, statistics
+    )
+    assert list(actual.columns) == [
+        stat_column(stat, window) for stat in statistics for window in windows
+    ]
+    if dtype == "float32":
+        assert actual.dtypes.eq(np.float32).all()
+        expected = expected.astype(np.float32)
+    assert_matches_pandas(actual, expected)
+
+
+def test_rolling_stats_dense_panel():
+    company_data, market_data = random_company_data(nan_ratio=0.02)
+    windows, statistics = [3, 20], list(Statistic)
+    expected = rolling_stats_dense(
+        company_data["returns"], market_data, windows, statistics
+    )
+    panel = CompanyPanel.from_series(company_data["returns"])
+    actual = rolling_stats_dense(panel, market_data, windows, statistics)
+    assert_frame_equal(actual, expected, check_index_type=False)
+
+    # panels with gaps fall back to pandas
+    gaps = CompanyPanel.from_series(company_data["returns"].iloc[::2])
+    with pytest.raises(ValueError, match="not contiguous"):
+        rolling_stats_dense(gaps, market_data, windows, statistics)
+    expected = rolling_stats(
+        company_data["returns"].iloc[::2], market_data, windows, statistics
+    )
+    actual = rolling_stats(
+        gaps, market_data, windows, statistics, engine=Engine.DENSE
+    )
+    assert_frame_equal(actual, expected, check_index_type=False)
+
+
+def test_rolling_stats_matrix_float32(monkeypatch):
+    rng = np.random.default_rng(4)
+    # several blocks of rows
+    x = rng.normal(0, 0.01, (2500, 3)).astype(np.float32)
+    y = rng.normal(0, 0.01, 2500).astype(np.float32)
+    x[rng.random(x.shape) < 0.05] = np.nan
+    windows, statistics = [3, 20], list(Statistic)
+    # blocks of 1024 rows by 2 companies
+    monkeypatch.setattr(rolling, "BLOCK_CELLS", 2048)
+    actual = rolling_stats_matrix(x, y, windows, statistics)
+    monkeypatch.undo()
+    expected = rolling_stats_matrix(
+        x.astype(np.float64), y.astype(np.float64), windows, statistics
+    )
+    for key, stat in actual.items():
+        assert stat.dtype == np.float32
+        assert expected[key].dtype == np.float64
+        np.testing.assert_array_equal(stat, expected[key].astype(np.float32))
+
+
+@pytest.mark.parametrize(
+    "kernel",
+    [
+        Kernel.NUMPY,
+        pytest.param(
+            Kernel.NUMBA,
+            marks=pytest.mark.skipif(
+                compiled_comoments() is None, reason="numba is not installed"
+            ),
+        ),
+    ],
+)
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+def test_rolling_stats_matrix_constant_stretch(kernel, dtype):
+    rng = np.random.default_rng(6)
+    x = rng.normal(0, 0.01, (400, 2)).astype(dtype)
+    y = rng.normal(0, 0.01, 400).astype(dtype)
+    # zero filled and constant company returns, and a constant market
+    x[150:250, 0] = 0.0
+    x[150:250, 1] = 0.01
+    y[300:] = 0.02
+    res = rolling_stats_matrix(x, y, [20], list(Statistic), kernel=kernel)
+    corr, beta = res[Statistic.CORR, 20], res[Statistic.BETA, 20]
+    cov, vol = res[Statistic.COV, 20], res[Statistic.VOL, 20]
+    assert np.isnan(corr[169:250]).all() and np.isnan(corr[319:]).all()
+    assert np.isnan(beta[319:]).all()
+    assert np.isfinite(beta[169:250]).all()
+    has_var = np.ones(corr.shape, dtype=bool)
+    has_var[:19] = has_var[169:250] = has_var[319:] = False
+    assert np.isfinite(corr[has_var]).all()
+    np.testing.assert_array_equal(cov[169:250], 0.0)
+    np.testing.assert_array_equal(cov[319:], 0.0)
+    np.testing.assert_array_equal(vol[169:250], 0.0)
+    # pandas has no correlation for windows of zeros either
+    expected = pd.Series(x[:300, 0]).rolling(20).corr(pd.Series(y[:300]))
+    np.testing.assert_array_equal(
+        np.isnan(corr[:300, 0]), expected.isna().to_numpy()
+    )
+
+
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+def test_rolling_stats_constant_stretch(dtype):
+    company_data, market_data = random_company_data(dtype=dtype)
+    returns = company_data["returns"].copy()
+    company = returns.index.get_level_values("companyid")
+    stretch = returns.groupby(level="companyid").cumcount().between(10, 69)
+    # zero filled and constant company returns, and a constant market
+    returns[stretch & (company == 0)] = 0.0
+    returns[stretch & (company == 1)] = np.dtype(dtype).type(0.01)
+    market_data.iloc[200:] = np.dtype(dtype).type(0.02)
+    windows, statistics = [3, 20], list(Statistic)
+    expected = rolling_stats(returns, market_data, windows, statistics)
+    actual = rolling_stats_dense(returns, market_data, windows, statistics)
+    for stats in (expected, actual):
+        assert not np.isinf(stats.to_numpy()).any()
+    assert actual["corr_20"].loc[[0, 1]].isna().sum() >= 2 * (19 + 41)
+    if dtype == "float32":
+        expected = expected.astype(np.float32)
+    assert_matches_pandas(actual, expected)
+
+
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+def test_rolling_stats_dense_zero_fill(dtype):
+    company_data, market_data = random_company_data(nan_ratio=0.02, dtype=dtype)
+    returns = company_data["returns"]
+    position = returns.groupby(level="companyid").cumcount()
+    # gaps longer than the windows, zero filled when resampling
+    returns = returns[~position.between(20, 59)]
+    windows, statistics = [5, 20], list(Statistic)
+    results = {}
+    for engine in Engine:
+        resampled = resample_company_returns(
+            returns, "B", ResampleStrategy.ZERO_FILL, engine
+        )
+        results[engine] = rolling_stats(
+            resampled, market_data, windows, statistics, engine
+        )
+    actual, expected = results[Engine.DENSE], results[Engine.PANDAS]
+    assert actual["corr_20"].isna().sum() > 8 * (19 + 21)
+    if dtype == "float32":
+        assert actual.dtypes.eq(np.float32).all()
+        expected = expected.astype(np.float32)
+    assert_matches_pandas(actual, expected)
+
+
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+def test_rolling_stats_dense_shares_moments(dtype):
+    company_data, market_data = random_company_data(dtype=dtype)
+    stats = rolling_stats_dense(
+        company_data["returns"], market_data, [20], list(Statistic)
+    )
+    corr = rolling_corr_dense(company_data["returns"], market_data, 20)
+    assert_series_equal(stats["corr_20"], corr, check_names=False)
+    market_vol = market_data.rolling(20).std()
+    market_vol = market_vol.reindex(stats.index.get_level_values("date"))
+    beta = stats["corr_20"] * stats["vol_20"] / market_vol.to_numpy()
+    if dtype == "float64":
+        np.testing.assert_allclose(stats["beta_20"], beta, rtol=1e-9)
+    else:
+        assert stats.dtypes.eq(np.float32).all()
+        # corr, vol and beta are each rounded to float32
+        np.testing.assert_allclose(stats["beta_20"], beta, rtol=1e-6)
+
+
+@pytest.mark.parametrize("min_periods", [1, 2, 15])
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+def test_rolling_stats_dense_min_periods(min_periods, dtype):
+    company_data, market_data = random_company_data(nan_ratio=0.1, dtype=dtype)
+    windows, statistics = [3, 20], list(Statistic)
+    expected = rolling_stats(
+        company_data["returns"],
+        market_data,
+        windows,
+        statistics,
+        min_periods=min(min_periods, 3),
+    )
+    actual = rolling_stats_dense(
+        company_data["returns"],
+        market_data,
+        windows,
+        statistics,
+        min(min_periods, 3),
+    )
+    if dtype == "float32":
+        assert actual.dtypes.eq(np.float32).all()
+        expected = expected.astype(np.float32)
+    assert_matches_pandas(actual, expected)
+    with pytest.raises(ValueError, match="min_periods"):
+        rolling_stats_dense(
+            company_data["returns"], market_data, [3, 20], statistics, 15
+        )
@@ -0,0 +1,90 @@
+import pandas as pd
+import pyarrow as pa
+import pytest
+from pandas._testing import assert_frame_equal
+
+from etl_pipeline_example.sinks import OutputFormat, result_sink
+
+
+@pytest.fixture
+def results() -> pd.DataFrame:
+    index = pd.MultiIndex.from_product(
+        [[0, 1, 2], pd.bdate_range("2023-02-13", periods=4, name="date")],
+        names=["companyid", "date"],
+    )
+    return pd.DataFrame(
+        {"returns": [i / 7 for i in range(len(index))]},
+        index=index,
+        dtype="float32",
+    )
+
+
+def chunks(data: pd.DataFrame):
+    yield data.iloc[:4]
+    yield data.iloc[4:4]
+    yield data.iloc[4:]
+
+
+def test_csv_sink(tmp_path, results):
+    with result_sink(tmp_path, "res", OutputFormat.CSV) as sink:
+        for chunk in chunks(results):
+            sink.write(chunk)
+    assert sink.path == tmp_path / "res.csv"
+    assert sink.n_rows == len(results)
+    expected = results.to_csv()
+    assert sink.path.read_text() == expected
+
+
+def test_parquet_sink(tmp_path, results):
+    with result_sink(tmp_path, "res", OutputFormat.PARQUET) as sink:
+        for chunk in chunks(results):
+            sink.write(chunk)
+    assert sink.path == tmp_path / "res.parquet"
+    assert_frame_equal(pd.read_parquet(sink.path), results)
+
+
+def test_arrow_sink(tmp_path, results):
+    with result_sink(tmp_path, "res", OutputFormat.ARROW) as sink:
+        for chunk in chunks(results):
+            sink.write(chunk)
+    assert sink.path == tmp_path / "res.arrow"
+    with pa.memory_map(str(sink.path)) as source:
+        actual = pa.ipc.open_file(source).read_pandas()
+    assert_frame_equal(actual, results)
+
+
+def test_csv_sink_append(tmp_path, results):
+    for chunk in chunks(results):
+        with result_sink(tmp_path, "res", OutputFormat.CSV, True) as sink:
+            sink.write(chunk)
+    assert sink.path.read_text() == results.to_csv()
+
+
+def test_parquet_sink_append(tmp_path, results):
+    paths = []
+    for chunk in results.iloc[:4], results.iloc[4:]:
+        with result_sink(tmp_path, "res", OutputFormat.PARQUET, True) as sink:
+            sink.write(chunk)
+        paths.append(sink.path)
+    assert paths == [tmp_path / "res.parquet", tmp_path / "res.1.parquet"]
+    actual = pd.concat(map(pd.read_parquet, paths))
+    assert_frame_equal(actual, results)
+
+
+@pytest.mark.parametrize(
+    "output_format", [OutputFormat.CSV, OutputFormat.PARQUET]
+)
+def test_sink_without_results(tmp_path, results, output_format):
+    with result_sink(tmp_path, "res", output_format) as sink:
+        sink.write(results)
+    # earlier results are replaced, even without any new ones
+    with result_sink(tmp_path, "res", output_format, columns=["returns"]):
+        pass
+    if output_format == OutputFormat.CSV:
+        assert sink.path.read_text() == results.iloc[:0].to_csv()
+    else:
+        assert_frame_equal(pd.read_parquet(sink.path), results.iloc[:0])
+    # but not when appending
+    with result_sink(tmp_path, "res", output_format, append=True):
+        pass
+    assert list(tmp_path.iterdir()) == [sink.path]
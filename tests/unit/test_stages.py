@@ -0,0 +1,103 @@
+import threading
+
+import pytest
+
+from etl_pipeline_example.stages import Checkpoints, StageGraph
+
+
+def test_checkpoints(tmp_path):
+    checkpoints = Checkpoints(tmp_path / "checkpoints")
+    assert not checkpoints.is_done("store", "a")
+    checkpoints.mark_done("store", "a", {"batches": [0, 3]})
+    checkpoints.mark_done("store-batch-0", "a")
+    assert checkpoints.is_done("store", "a")
+    assert not checkpoints.is_done("store", "b")
+    assert checkpoints.load("store", "a") == {"batches": [0, 3]}
+    assert checkpoints.load("store", "b") is None
+    checkpoints.clear("store-batch-")
+    assert not checkpoints.is_done("store-batch-0", "a")
+    assert checkpoints.is_done("store", "a")
+    checkpoints.clear()
+    assert not checkpoints.is_done("store", "a")
+
+    disabled = Checkpoints(tmp_path / "disabled", enabled=False)
+    disabled.mark_done("store", "a")
+    assert not disabled.is_done("store", "a")
+    assert not disabled.checkpoint_dir.exists()
+
+
+def test_stage_graph_outputs():
+    calls = []
+
+    def stage(name, *args):
+        calls.append(name)
+        return name + "".join(args)
+
+    graph = StageGraph()
+    graph.add("a", lambda: stage("a"))
+    graph.add("b", lambda a: stage("b", a), ["a"])
+    graph.add("c", lambda: stage("c"))
+    graph.add("d", lambda b, c: stage("d", b, c), ["b", "c"])
+    assert graph.run() == {"d": "dbac"}
+    assert calls == ["a", "b", "c", "d"]
+    # only the stages needed
+    assert graph.run(["b"]) == {"b": "ba"}
+    assert calls[4:] == ["a", "b"]
+    with pytest.raises(ValueError, match="Unknown inputs"):
+        graph.add("e", lambda x: x, ["x"])
+    with pytest.raises(ValueError, match="Duplicate"):
+        graph.add("a", lambda: None)
+
+
+def test_stage_graph_resume(tmp_path):
+    calls = []
+
+    def build(fail):
+        def stage(name, *args):
+            if name == fail:
+                raise RuntimeError(f"{name} failed")
+            calls.append(name)
+            return len(args)
+
+        graph = StageGraph(Checkpoints(tmp_path))
+        graph.add("load", lambda: stage("load"))
+        graph.add(
+            "store",
+            lambda data: stage("store", data),
+            ["load"],
+            key="k1",
+            load=lambda: "from disk",
+        )
+        graph.add("market", lambda: stage("market"))
+        graph.add(
+            "correlate",
+            lambda s, m: stage("correlate", s, m),
+            ["store", "market"],
+        )
+        return graph
+
+    with pytest.raises(RuntimeError, match="correlate failed"):
+        build(fail="correlate").run()
+    assert calls == ["load", "store", "market"]
+    # the store is done: it is loaded, and its input is not needed
+    graph = build(fail="load")
+    assert graph.plan() == {"store": False, "market": True, "correlate": True}
+    assert graph.run() == {"correlate": 2}
+    assert calls[3:] == ["market", "correlate"]
+    # a new key runs the store again
+    graph.stages["store"].key = "k2"
+    assert graph.plan()["store"]
+
+
+def test_stage_graph_threads():
+    # both stages must run at the same time to get past the barrier
+    barrier = threading.Barrier(2, timeout=10)
+    graph = StageGraph(n_threads=2)
+    graph.add("a", lambda: barrier.wait() >= 0)
+    graph.add("b", lambda: barrier.wait() >= 0)
+    graph.add("c", lambda a, b: a and b, ["a", "b"])
+    assert graph.run() == {"c": True}
+
+    graph.add("d", lambda c: 1 / 0, ["c"])
+    with pytest.raises(ZeroDivisionError):
+        graph.run(["d"])
@@ -0,0 +1,155 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import pytest
+from pandas._testing import assert_series_equal
+
+from etl_pipeline_example.dataset import filter_expression
+from etl_pipeline_example.panel import CompanyPanel
+from etl_pipeline_example.store import (
+    PartitionManifest,
+    StoreState,
+    load_manifest,
+    load_state,
+    plan_partitions,
+    read_partition,
+    read_partition_panel,
+    save_manifest,
+    save_state,
+    write_partitions,
+)
+
+
+def test_store_state_round_trip(tmp_path):
+    assert load_state(tmp_path) is None
+    state = StoreState(params={"window": 10, "strategy": "na-fill"})
+    watermarks = pd.Series(
+        pd.to_datetime(["2023-01-02", "2023-01-05", "2023-01-04"]),
+        index=[0, 1, 2],
+    )
+    state.update(watermarks)
+    save_state(tmp_path, state)
+    assert load_state(tmp_path) == state
+
+    state.update(watermarks.iloc[:1] + pd.Timedelta(days=7))
+    assert state.company_watermarks[0] == pd.Timestamp("2023-01-09")
+    assert state.company_watermarks[1] == pd.Timestamp("2023-01-05")
+
+
+def test_plan_partitions():
+    row_counts = pd.Series([5, 3, 4, 10, 1, 1], index=[7, 2, 3, 4, 5, 9])
+    # first rows are 0, 3, 7, 17, 18, 23 in company id order
+    np.testing.assert_array_equal(plan_partitions(row_counts, 10), [2, 5, 9])
+    np.testing.assert_array_equal(plan_partitions(row_counts, 100), [2])
+    np.testing.assert_array_equal(
+        plan_partitions(row_counts, 1), [2, 3, 4, 5, 7, 9]
+    )
+    assert len(plan_partitions(row_counts.iloc[:0], 10)) == 0
+    with pytest.raises(ValueError, match="partition size"):
+        plan_partitions(row_counts, 0)
+
+
+def test_partition_manifest(tmp_path):
+    assert load_manifest(tmp_path) is None
+    manifest = PartitionManifest.from_plan(np.array([2, 5]))
+    np.testing.assert_array_equal(
+        manifest.partition_of(np.array([0, 2, 4, 5, 100])), [0, 0, 0, 1, 1]
+    )
+    index = pd.MultiIndex.from_arrays(
+        [[2, 2, 4, 5], pd.to_datetime(["2023-01-02", "2023-01-03"] * 2)],
+        names=["companyid", "date"],
+    )
+    company_data = pd.Series(np.ones(4), index=index)
+    manifest.record(company_data, np.array([0, 0, 0, 1]))
+    first, second = manifest.partitions
+    assert (first.first_company, first.last_company, first.n_rows) == (2, 4, 3)
+    assert first.start_date == pd.Timestamp("2023-01-02")
+    assert first.max_window() == 2
+    assert (second.first_company, second.last_company) == (5, 5)
+    assert second.max_window() == 1
+
+    # a new company appended to the last partition
+    index = pd.MultiIndex.from_arrays(
+        [[8], pd.to_datetime(["2023-01-09"])], names=["companyid", "date"]
+    )
+    manifest.record(pd.Series([1.0], index=index), np.array([1]))
+    assert (second.last_company, second.n_rows) == (8, 2)
+    assert second.max_window() == 5
+
+    save_manifest(tmp_path, manifest)
+    assert load_manifest(tmp_path) == manifest
+
+
+def test_read_partition(tmp_path):
+    dates = pd.bdate_range("2023-01-02", periods=50, name="date")
+    index = pd.MultiIndex.from_product(
+        [range(10), dates], names=["companyid", "date"]
+    )
+    company_data = pd.Series(
+        np.arange(len(index), dtype="float32"), index=index, name="returns"
+    )
+    table = pa.Table.from_pandas(company_data.to_frame())
+    pq.write_table(table, tmp_path / "part-0.parquet", row_group_size=50)
+
+    actual = read_partition(tmp_path, companies=[2, 7], start=dates[40])
+    expected = company_data.loc[[2, 7]]
+    expected = expected[expected.index.get_level_values("date") >= dates[40]]
+    assert_series_equal(actual, expected)
+
+    # only the row groups of the companies requested are read
+    fragment = next(ds.dataset(tmp_path, format="parquet").get_fragments())
+    filter_expr = filter_expression([2, 7], None, None, pa.timestamp("ns"))
+    assert len(fragment.split_by_row_group(filter_expr)) == 2
+
+
+def test_partition_manifest_select():
+    manifest = PartitionManifest.from_plan(np.array([0, 5, 10]))
+    manifest.record(
+        pd.Series(
+            np.ones(3),
+            index=pd.MultiIndex.from_arrays(
+                [
+                    [1, 6, 12],
+                    pd.to_datetime(["2020-01-01", "2021-01-01", "2022-01-03"]),
+                ],
+                names=["companyid", "date"],
+            ),
+        ),
+        np.array([0, 1, 2]),
+    )
+    assert [p.partition for p in manifest.select()] == [0, 1, 2]
+    assert [p.partition for p in manifest.select(companies=[6, 11])] == [1, 2]
+    assert [p.partition for p in manifest.select(start="2021-01-01")] == [1, 2]
+    assert [p.partition for p in manifest.select(end="2020-06-01")] == [0]
+
+
+def test_write_partitions_panel(tmp_path):
+    dates = pd.bdate_range("2023-01-02", periods=20, name="date")
+    index = pd.MultiIndex.from_product(
+        [range(6), dates], names=["companyid", "date"]
+    )
+    company_data = pd.Series(
+        np.arange(len(index), dtype="float32"), index=index, name="returns"
+    )
+    panel = CompanyPanel.from_series(company_data)
+    manifest = PartitionManifest.from_plan(np.array([0, 3]))
+    partitions = np.repeat(
+        manifest.partition_of(panel.company_ids), panel.counts
+    )
+    write_partitions(panel, tmp_path, partitions)
+    manifest.record(panel, partitions)
+    assert [p.n_rows for p in manifest.partitions] == [60, 60]
+    assert manifest.partitions[1].end_date == dates[-1]
+
+    assert_series_equal(
+        read_partition(tmp_path / "1"),
+        company_data.loc[[3, 4, 5]],
+        check_index_type=False,
+    )
+    actual = read_partition_panel(tmp_path / "0", companies=[1], start=dates[5])
+    np.testing.assert_array_equal(actual.company_ids, [1])
+    np.testing.assert_array_equal(
+        actual.values, company_data.loc[1].to_numpy()[5:]
+    )